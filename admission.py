@@ -0,0 +1,127 @@
+"""
+Допуск запросов на генерацию по оценке времени ожидания.
+
+Когда провайдер LLM замедляется, запросы копятся перед RateLimiter и семафором, и каждый
+ждёт до таймаута обработчика (GENERATION_TIMEOUT): пользователь смотрит на «Генерирую...»,
+а потом получает «Время ожидания истекло», хотя слот так и не освободился для тех, кто
+успел бы. Контроллер заранее оценивает, когда будет готов новый запрос:
+
+    ожидание = (запросы впереди / пропускная способность) + время обработки запроса
+
+Запросы впереди - ждущие лимитов и выполняющиеся сверх свободных слотов. Время обработки -
+скользящее среднее (EWMA) по завершённым запросам. Пропускная способность - EWMA наблюдаемой
+частоты завершений, пока очередь не пуста, но не больше, чем позволяют слоты и лимит в минуту.
+
+Решение decide():
+- "admit"  - запрос успеет за GENERATION_TIMEOUT, выполняется как обычно;
+- "defer"  - не успеет, но будет готов за ADMISSION_MAX_WAIT: пользователю сразу сообщают
+             оценку и предлагают прислать пост, когда он будет готов;
+- "reject" - ждать дольше ADMISSION_MAX_WAIT: пользователю сразу предлагают повторить позже.
+
+Так слоты достаются запросам, которые ещё могут успеть, а не тем, что всё равно упрутся в таймаут.
+
+Настройки окружения:
+    GENERATION_TIMEOUT   - сколько пользователь ждёт ответа в чате, секунд (45)
+    ADMISSION_MAX_WAIT   - максимальное ожидание отложенной генерации, секунд (600)
+"""
+import os
+import time
+
+from metrics import ADMISSION_DECISIONS, ADMISSION_ESTIMATED_WAIT
+
+GENERATION_TIMEOUT = float(os.environ.get("GENERATION_TIMEOUT", 45))
+ADMISSION_MAX_WAIT = float(os.environ.get("ADMISSION_MAX_WAIT", 600))
+
+class AdmissionController:
+    """Оценка ожидания запроса к LLM и решение о его допуске"""
+
+    def __init__(self, requests_per_minute, concurrency, alpha=0.2, initial_service_time=10.0, idle_reset=60.0):
+        """
+        :param requests_per_minute: Лимит запросов в минуту (как у RateLimiter)
+        :param concurrency: Число одновременных запросов (как у семафора)
+        :param alpha: Вес нового наблюдения в скользящих средних
+        :param initial_service_time: Время обработки запроса до первых наблюдений, секунд
+        :param idle_reset: После такого простоя наблюдаемая частота завершений забывается
+        """
+        self.requests_per_minute = requests_per_minute
+        self.concurrency = concurrency
+        self.alpha = alpha
+        self.idle_reset = idle_reset
+        self.waiting = 0  # Запросы, ждущие RateLimiter или слот
+        self.running = 0  # Запросы, выполняющиеся в данный момент
+        self.service_time = initial_service_time
+        self.observed_rate = None  # Завершений в секунду, пока очередь не пуста
+        self.last_finished_at = None
+        self.stats = {"admit": 0, "defer": 0, "reject": 0}
+
+    def started(self):
+        """Запрос получил слот и начал выполняться"""
+        self.waiting -= 1
+        self.running += 1
+
+    def finished(self, service_time):
+        """
+        Запрос завершился (успешно, с ошибкой или по таймауту).
+
+        :param service_time: Сколько секунд запрос выполнялся после получения слота
+        """
+        self.running -= 1
+        self.service_time += self.alpha * (service_time - self.service_time)
+        now = time.monotonic()
+        if self.last_finished_at is not None and now - self.last_finished_at > self.idle_reset:
+            self.observed_rate = None
+        # Частоту завершений показывают только интервалы, когда запросы ждали своей очереди
+        busy = self.waiting > 0 or self.running >= self.concurrency - 1
+        if busy and self.last_finished_at is not None and now > self.last_finished_at:
+            rate = 1 / (now - self.last_finished_at)
+            self.observed_rate = rate if self.observed_rate is None else self.observed_rate + self.alpha * (rate - self.observed_rate)
+        self.last_finished_at = now
+
+    def throughput(self):
+        """Ожидаемая пропускная способность, запросов в секунду"""
+        capacity = min(self.concurrency / max(self.service_time, 0.1), self.requests_per_minute / 60)
+        if self.observed_rate is None:
+            return capacity
+        return min(capacity, self.observed_rate)
+
+    def estimate_wait(self):
+        """Через сколько секунд будет готов запрос, поставленный в очередь сейчас"""
+        ahead = self.waiting + max(0, self.running + 1 - self.concurrency)
+        return ahead / self.throughput() + self.service_time
+
+    def decide(self, deadline=GENERATION_TIMEOUT, max_wait=ADMISSION_MAX_WAIT):
+        """
+        Решает, принимать ли запрос на генерацию.
+
+        :param deadline: Сколько пользователь ждёт ответа в чате
+        :param max_wait: Сколько готов ждать отложенный запрос
+        :return: (решение "admit", "defer" или "reject"; оценка ожидания в секундах)
+        """
+        wait = self.estimate_wait()
+        if wait <= deadline:
+            decision = "admit"
+        elif wait <= max_wait:
+            decision = "defer"
+        else:
+            decision = "reject"
+        self.stats[decision] += 1
+        ADMISSION_DECISIONS.labels(decision).inc()
+        ADMISSION_ESTIMATED_WAIT.set(wait)
+        return decision, wait
+
+    def snapshot(self):
+        """Состояние для health-эндпоинта"""
+        return {
+            "estimated_wait_s": round(self.estimate_wait(), 1),
+            "service_time_s": round(self.service_time, 1),
+            "throughput_per_min": round(self.throughput() * 60, 1),
+            "waiting": self.waiting,
+            "running": self.running,
+            "decisions": dict(self.stats)
+        }
+
+def format_wait(seconds):
+    """Оценка ожидания для сообщения пользователю"""
+    if seconds < 90:
+        return f"около {max(10, int(round(seconds, -1)))} секунд"
+    return f"около {int(round(seconds / 60))} мин"
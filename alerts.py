@@ -0,0 +1,204 @@
+"""
+Отправка уведомлений администратору в Telegram.
+
+Один фоновый поток и один пул HTTP-соединений на процесс. send() только кладёт
+уведомление в очередь и сразу возвращается, поэтому поток мониторинга не ждёт сеть.
+Уведомления копятся в течение окна, одинаковые (по ключу) склеиваются со счётчиком
+повторов, а для каждого ключа действует пауза в зависимости от важности.
+Критические уведомления отправляются без ожидания окна.
+
+    from alerts import alert_dispatcher
+    alert_dispatcher.send("⚠️ CPU 95%", severity="warning", key="cpu", chat_id=admin_chat_id)
+"""
+import os
+import time
+import queue
+import logging
+import threading
+
+import requests
+
+from telegram_transport import TELEGRAM_API_BASE
+
+logger = logging.getLogger("alerts")
+
+# Минимальная пауза между уведомлениями с одним ключом, секунды
+SEVERITY_COOLDOWNS = {
+    "info": 3600,
+    "warning": 300,
+    "critical": 60
+}
+SEVERITY_ICONS = {"info": "ℹ️", "warning": "⚠️", "critical": "🚨"}
+
+class AlertDispatcher:
+    """Очередь уведомлений администратору с пакетной отправкой"""
+
+    def __init__(self, batch_window=10, max_queue=1000, cooldowns=None, api_base=TELEGRAM_API_BASE):
+        """
+        :param batch_window: Сколько секунд копить уведомления перед отправкой
+        :param max_queue: Размер очереди; при переполнении новые уведомления отбрасываются
+        :param cooldowns: Паузы по важности, по умолчанию SEVERITY_COOLDOWNS
+        :param api_base: Адрес Bot API
+        """
+        self.batch_window = batch_window
+        self.cooldowns = cooldowns or SEVERITY_COOLDOWNS
+        self.api_base = api_base.rstrip("/")
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.last_sent = {}  # {(chat_id, ключ): время последней отправки}
+        self.stats = {"queued": 0, "sent": 0, "suppressed": 0, "dropped": 0, "failed": 0}
+        self.session = None
+        self.thread = None
+        self.lock = threading.Lock()
+        self._token = None
+
+    def _ensure_started(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name="alert-dispatcher", daemon=True)
+                self.thread.start()
+
+    def send(self, text, severity="warning", key=None, chat_id=None):
+        """
+        Ставит уведомление в очередь, не блокируя вызывающий поток.
+
+        :param text: Текст уведомления
+        :param severity: info, warning или critical
+        :param key: Ключ для склейки повторов и паузы (по умолчанию - первая строка текста)
+        :param chat_id: Чат администратора (по умолчанию ADMIN_CHAT_ID)
+        :return: False, если уведомление некуда или невозможно поставить в очередь
+        """
+        chat_id = chat_id or os.getenv("ADMIN_CHAT_ID")
+        if not chat_id:
+            return False
+        alert = {
+            "text": text,
+            "severity": severity if severity in self.cooldowns else "warning",
+            "key": key or text.split("\n", 1)[0],
+            "chat_id": str(chat_id),
+            "time": time.time()
+        }
+        try:
+            self.queue.put_nowait(alert)
+        except queue.Full:
+            self.stats["dropped"] += 1
+            return False
+        self.stats["queued"] += 1
+        self._ensure_started()
+        return True
+
+    def flush(self, timeout=10):
+        """Ждёт отправки всего, что уже в очереди (например, перед завершением процесса)"""
+        if self.thread is None or not self.thread.is_alive():
+            return
+        deadline = time.time() + timeout
+        try:
+            self.queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        while self.queue.unfinished_tasks and time.time() < deadline:
+            time.sleep(0.05)
+
+    def _run(self):
+        while True:
+            first = self.queue.get()
+            batch = [] if first is None else [first]
+            urgent = first is None or first["severity"] == "critical"
+            deadline = time.time() + self.batch_window
+            processed = 1
+            # Копим уведомления в течение окна; критическое или flush() отправляют сразу
+            while not urgent:
+                try:
+                    alert = self.queue.get(timeout=max(0.0, deadline - time.time()))
+                except queue.Empty:
+                    break
+                processed += 1
+                if alert is None or alert["severity"] == "critical":
+                    urgent = True
+                if alert is not None:
+                    batch.append(alert)
+            # Всё, что уже лежит в очереди, уходит тем же пакетом
+            while True:
+                try:
+                    alert = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                processed += 1
+                if alert is not None:
+                    batch.append(alert)
+            try:
+                self._dispatch(batch)
+            except Exception as e:
+                logger.error(f"Ошибка при отправке уведомлений: {e}")
+            for _ in range(processed):
+                self.queue.task_done()
+
+    def _dispatch(self, batch):
+        """Склеивает повторы, применяет паузы и отправляет по сообщению на чат"""
+        grouped = {}
+        for alert in batch:
+            group = grouped.setdefault(alert["chat_id"], {})
+            entry = group.get(alert["key"])
+            if entry is None:
+                group[alert["key"]] = {**alert, "count": 1}
+            else:
+                entry["count"] += 1
+                entry["text"] = alert["text"]  # Самая свежая версия текста
+                if alert["severity"] == "critical":
+                    entry["severity"] = "critical"
+
+        now = time.time()
+        for chat_id, alerts in grouped.items():
+            parts = []
+            for key, alert in alerts.items():
+                last = self.last_sent.get((chat_id, key), 0)
+                if now - last < self.cooldowns[alert["severity"]]:
+                    self.stats["suppressed"] += alert["count"]
+                    continue
+                self.last_sent[(chat_id, key)] = now
+                text = alert["text"]
+                if not text.startswith(tuple(SEVERITY_ICONS.values())):
+                    text = f"{SEVERITY_ICONS[alert['severity']]} {text}"
+                if alert["count"] > 1:
+                    text += f"\n(повторов за {self.batch_window} с: {alert['count']})"
+                parts.append(text)
+            if parts:
+                if self._post(chat_id, "\n\n".join(parts)):
+                    self.stats["sent"] += len(parts)
+                else:
+                    self.stats["failed"] += len(parts)
+
+    def _get_token(self):
+        if self._token is None:
+            self._token = os.getenv("BOT_TOKEN")
+            if not self._token:
+                from config import BOT_TOKEN
+                self._token = BOT_TOKEN
+        return self._token
+
+    def _post(self, chat_id, text, attempts=2):
+        """Отправляет сообщение через Bot API; соединение переиспользуется между отправками"""
+        if self.session is None:
+            self.session = requests.Session()
+        url = f"{self.api_base}/bot{self._get_token()}/sendMessage"
+        # Лимит Telegram на длину сообщения
+        payload = {"chat_id": chat_id, "text": text[:4096], "disable_web_page_preview": True}
+        for attempt in range(1, attempts + 1):
+            try:
+                response = self.session.post(url, json=payload, timeout=(5, 10))
+                if response.status_code == 429:
+                    retry_after = response.json().get("parameters", {}).get("retry_after", 5)
+                    logger.warning(f"Telegram ограничил отправку уведомлений, повтор через {retry_after} с")
+                    time.sleep(min(retry_after, 30))
+                    continue
+                if response.ok:
+                    logger.info(f"Уведомление отправлено в Telegram (chat_id: {chat_id})")
+                    return True
+                logger.error(f"Telegram отклонил уведомление: {response.status_code} {response.text[:200]}")
+                return False
+            except requests.RequestException as e:
+                logger.error(f"Ошибка при отправке уведомления (попытка {attempt}): {e}")
+                time.sleep(attempt)
+        return False
+
+# Глобальный диспетчер уведомлений процесса
+alert_dispatcher = AlertDispatcher(batch_window=float(os.getenv("ALERT_BATCH_WINDOW", "10")))
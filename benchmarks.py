@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+"""
+Микробенчмарки горячих путей бота на чистом Python.
+
+Покрывает форматтеры текста, подбор хэштегов, ограничение размера поста,
+выборку знаний о РДДМ и операции SessionManager на 10 тыс. - 1 млн сессий.
+Результаты выводятся в JSON и могут сравниваться с сохранённым базовым прогоном:
+
+    python benchmarks.py --save baseline.json
+    python benchmarks.py --baseline baseline.json --threshold 0.2
+    python benchmarks.py --sessions 10000,100000,1000000 --filter session
+
+При замедлении любого бенчмарка больше порога скрипт завершается с кодом 1.
+"""
+import gc
+import sys
+import json
+import time
+import timeit
+import logging
+import platform
+import argparse
+from datetime import datetime, timedelta
+
+from session_manager import SessionManager, UserState, PostSize, GenerationMode
+
+# Реалистичные посты каждого размера с разметкой, которую возвращает модель
+POSTS = {
+    PostSize.SMALL: (
+        "🌱 **Экологический десант «Первых»**\n\n"
+        "В субботу ребята из первичного отделения школы №12 вышли на субботник в парк Победы. "
+        "Собрали 40 мешков мусора и высадили 15 молодых клёнов!\n\n"
+        "#ДвижениеПервых #ЭкологияПервых #ДвижениеПервых59"
+    ),
+    PostSize.MEDIUM: (
+        "🎉 **Волонтёры «Движения Первых» поздравили ветеранов!**\n\n"
+        "Накануне Дня Победы активисты Пермского края навестили ветеранов Великой Отечественной войны "
+        "и тружеников тыла. Ребята подготовили праздничный концерт, вручили открытки, сделанные своими руками, "
+        "и помогли с уборкой во дворе.\n\n"
+        "«Для нас это не просто акция, а возможность сказать спасибо тем, кто подарил нам мирное небо», — "
+        "говорит председатель первичного отделения Анна Смирнова.\n\n"
+        "Присоединяйся к добрым делам: [будьвдвижении.рф](https://будьвдвижении.рф)\n\n"
+        "#ДвижениеПервых #ВолонтёрствоПервых #ДвижениеПервых59"
+    ),
+    PostSize.LARGE: (
+        "🏆 **Итоги регионального этапа «Большой перемены»**\n\n"
+        "Больше 300 школьников из 25 муниципалитетов Пермского края приняли участие в региональном этапе "
+        "конкурса. Три дня участники решали кейсы от партнёров движения, защищали собственные проекты "
+        "и знакомились с наставниками из ведущих вузов и предприятий региона.\n\n"
+        "Особенно ярко выступили команды из Березников и Кунгура: их проекты по развитию школьных "
+        "медиацентров и экологическому просвещению жюри отметило специальными призами. "
+        "Победители получат путёвки в «Артек» и возможность представить свои идеи на всероссийском уровне.\n\n"
+        "*Что дальше?* Уже в следующем месяце стартует приём заявок на смену «Лидеры Первых», "
+        "а первичные отделения запускают клубы по интересам: от робототехники до журналистики.\n\n"
+        "«Каждый из вас доказал, что может менять мир вокруг себя. Главное — не останавливаться!» — "
+        "обратилась к участникам руководитель регионального отделения.\n\n"
+        "Подробности и положение конкурса: [bolshayaperemena.online](https://bolshayaperemena.online)\n\n"
+        "||А ещё победителей ждёт сюрприз от партнёров!||\n\n"
+        "#ДвижениеПервых #ОбразованиеПервых #ДвижениеПервых59"
+    ),
+}
+
+TOPICS = [
+    "Экологическая акция и субботник в парке",
+    "Волонтёры поздравили ветеранов с Днём Победы",
+    "Спортивные соревнования школьных команд",
+    "Профориентация: встреча с профессионалами",
+    "Туристический поход первичного отделения",
+]
+
+SIZE_RANGES = {PostSize.SMALL: (200, 400), PostSize.MEDIUM: (400, 800), PostSize.LARGE: (800, 1200)}
+
+def measure(func, repeat, min_time):
+    """
+    Измеряет время одного вызова функции.
+
+    :return: Словарь с лучшим и медианным временем вызова в наносекундах
+    """
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    number = max(1, int(number * min_time / 0.2))
+    times = sorted(t / number * 1e9 for t in timer.repeat(repeat=repeat, number=number))
+    return {"ns": round(times[0], 1), "median_ns": round(times[len(times) // 2], 1), "loops": number}
+
+def measure_once(setup, func, repeat):
+    """Измеряет однократную операцию, для которой каждый раз нужно заново готовить данные"""
+    times = []
+    for _ in range(repeat):
+        state = setup()
+        gc.collect()
+        started = time.perf_counter_ns()
+        func(state)
+        times.append(time.perf_counter_ns() - started)
+    times.sort()
+    return {"ns": round(times[0], 1), "median_ns": round(times[len(times) // 2], 1), "loops": 1}
+
+def text_benchmarks():
+    from text_formatting import format_to_html, escape_markdown, format_message_text
+
+    for size, post in POSTS.items():
+        yield f"format_to_html[{size.value}]", lambda post=post: format_to_html(post)
+        yield f"escape_markdown[{size.value}]", lambda post=post: escape_markdown(post)
+        yield f"format_message_text[{size.value}]", lambda post=post: format_message_text(post)
+
+def llm_client_benchmarks():
+    from llm_client import LLMClient
+    from rddm_info import get_rddm_knowledge
+
+    client = LLMClient()
+    yield "get_relevant_hashtags", lambda: [client._get_relevant_hashtags(topic) for topic in TOPICS]
+    for size, post in POSTS.items():
+        min_size, max_size = SIZE_RANGES[size]
+        # Ответ модели длиннее лимита - самый дорогой путь с поиском места обрезки
+        oversized = post + "\n\n" + post
+        yield f"enforce_size_limits[{size.value}]", lambda text=oversized, a=min_size, b=max_size: client._enforce_size_limits(text, a, b)
+    yield "get_rddm_knowledge[none]", lambda: get_rddm_knowledge()
+    yield "get_rddm_knowledge[topics]", lambda: [get_rddm_knowledge(topic) for topic in TOPICS]
+
+def fill_sessions(count, expired_share=0.0):
+    """Создаёт SessionManager с заданным числом сессий, часть из которых истекла"""
+    manager = SessionManager()
+    now = datetime.now()
+    expired_before = now - manager.session_timeout - timedelta(minutes=1)
+    expired_count = int(count * expired_share)
+    for user_id in range(count):
+        session = UserState()
+        session.user_id = user_id
+        session.stage = "wait_for_changes"
+        session.mode = GenerationMode.NO_TEMPLATE
+        session.current_post = POSTS[PostSize.MEDIUM]
+        session.last_activity = expired_before if user_id < expired_count else now
+        manager.sessions[user_id] = session
+    return manager
+
+def session_benchmarks(sizes, repeat):
+    for count in sizes:
+        manager = fill_sessions(count)
+        user_ids = list(range(0, count, max(1, count // 1000)))
+
+        yield f"session.get_session[{count}]", lambda m=manager, ids=user_ids: [m.get_session(i) for i in ids], len(user_ids)
+        yield f"session.update_session[{count}]", lambda m=manager, ids=user_ids: [m.update_session(i, stage="idle") for i in ids], len(user_ids)
+        # Периодическая очистка, когда истекших сессий нет: чистый проход по словарю
+        yield f"session.clean_expired[{count},0%]", lambda m=manager: m.clean_expired_sessions(), 1
+        del manager
+        gc.collect()
+
+        # Очистка с 10% истекших сессий: каждый прогон требует новых данных
+        result = measure_once(lambda c=count: fill_sessions(c, 0.1), lambda m: m.clean_expired_sessions(), repeat)
+        yield f"session.clean_expired[{count},10%]", result, 1
+
+def run(args):
+    results = {}
+    sizes = [int(size) for size in args.sessions.split(",") if size]
+
+    def selected(name):
+        return not args.filter or args.filter in name
+
+    for name, func in list(text_benchmarks()) + list(llm_client_benchmarks()):
+        if selected(name):
+            results[name] = measure(func, args.repeat, args.min_time)
+            print(f"{name}: {results[name]['ns'] / 1000:.2f} мкс", file=sys.stderr)
+
+    if any(selected(f"session.{op}") for op in ("get_session", "update_session", "clean_expired")):
+        for name, func, ops in session_benchmarks(sizes, args.repeat):
+            if not selected(name):
+                continue
+            result = func if isinstance(func, dict) else measure(func, args.repeat, args.min_time)
+            # Время на одну операцию с сессией, а не на всю пачку
+            result = {key: round(value / ops, 1) if key.endswith("ns") else value for key, value in result.items()}
+            results[name] = result
+            print(f"{name}: {result['ns'] / 1000:.2f} мкс", file=sys.stderr)
+
+    return {
+        "meta": {
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "platform": platform.platform(),
+            "timestamp": int(time.time()),
+            "repeat": args.repeat,
+        },
+        "results": results,
+    }
+
+def compare(report, baseline, threshold):
+    """
+    Сравнивает результаты с базовым прогоном.
+
+    :return: Список бенчмарков, замедлившихся больше порога
+    """
+    regressions = []
+    for name, result in report["results"].items():
+        base = baseline.get("results", {}).get(name)
+        if not base or not base["ns"]:
+            continue
+        ratio = result["ns"] / base["ns"]
+        result["baseline_ns"] = base["ns"]
+        result["ratio"] = round(ratio, 3)
+        if ratio > 1 + threshold:
+            regressions.append(name)
+            print(f"РЕГРЕССИЯ {name}: {base['ns']:.0f} -> {result['ns']:.0f} нс (x{ratio:.2f})", file=sys.stderr)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Микробенчмарки горячих путей бота")
+    parser.add_argument("--sessions", default="10000,100000", help="Размеры SessionManager через запятую")
+    parser.add_argument("--repeat", type=int, default=5, help="Число повторов каждого замера")
+    parser.add_argument("--min-time", type=float, default=0.2, help="Минимальная длительность одного повтора, с")
+    parser.add_argument("--filter", help="Запускать только бенчмарки, содержащие подстроку")
+    parser.add_argument("--save", help="Сохранить результаты в JSON-файл")
+    parser.add_argument("--baseline", help="JSON-файл базового прогона для сравнения")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Допустимое замедление относительно базы (0.2 = 20%%)")
+    args = parser.parse_args()
+
+    # Логи в горячих путях не должны попадать в вывод, но их форматирование измеряется
+    logging.disable(logging.CRITICAL)
+
+    report = run(args)
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            regressions = compare(report, json.load(f), args.threshold)
+        report["regressions"] = regressions
+
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            f.write(output)
+    print(output)
+    sys.exit(1 if regressions else 0)
+
+if __name__ == "__main__":
+    main()
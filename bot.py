@@ -1,3 +1,6 @@
+import time
+# Отсчёт времени запуска начинается до импорта aiogram: он занимает большую часть запуска
+STARTUP_STARTED = time.perf_counter()
 import asyncio
 import logging
 from aiogram import Bot, Dispatcher, Router, types
@@ -7,30 +10,143 @@ from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.exceptions import TelegramNetworkError, TelegramBadRequest
 import re
 import os
+import signal
 import socket
 import json
-import time
 import aiohttp
 
+from log_setup import setup_logging, dropped_records
+
+# Логирование настраивается до импорта модулей, которые пишут в лог при загрузке
+setup_logging()
+
 from config import BOT_TOKEN
-from session_manager import SessionManager, UserState, GenerationMode, PostSize
+from session_manager import SessionManager, UserState, GenerationMode, PostSize, worker_snapshot_path
 from llm_client import LLMClient
+from text_formatting import format_to_html
+from post_editor import EditSession
+from fallback_generator import fallback_generator
+from config import EDIT_HISTORY_MAX_TURNS, FIRST_DRAFT_DELAY
+from metrics import registry, CONTENT_TYPE, BACKLOG_UPDATES, HANDLER_DURATION, HANDLER_ERRORS, SESSIONS, TELEGRAM_API_DURATION, TELEGRAM_API_ERRORS, LOG_DROPPED, LLM_QUEUE_DEPTH
+from tracing import start_trace, span, recent_traces
+from loop_watchdog import loop_watchdog
+from profiling import add_profiling_routes
+from stats_segment import StatsWriter, segment_path, PUBLISH_INTERVAL, FLAG_ACCEPTING, FLAG_DRAINING
+from admission import GENERATION_TIMEOUT, ADMISSION_MAX_WAIT, format_wait
+from update_backlog import UpdateOffset, prepare_backlog, update_user_id, update_chat_id
+from telegram_transport import create_bot_session
 
-# Настройка логирования
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Инициализация бота
-bot = Bot(token=BOT_TOKEN)
+# Инициализация бота: адрес Bot API и пул соединений - из telegram_transport
+bot = Bot(token=BOT_TOKEN, session=create_bot_session())
 
 # Инициализация диспетчера и хранилища состояний
 storage = MemoryStorage()
 dp = Dispatcher(storage=storage)
 router = Router()
 
+# Плавный перезапуск: сколько ждать начатые генерации и куда сохранить сессии для нового процесса
+DRAIN_TIMEOUT = float(os.environ.get("DRAIN_TIMEOUT", 25))
+SESSION_SNAPSHOT_PATH = os.environ.get("SESSION_SNAPSHOT_PATH", "sessions_snapshot.json")
+IN_FLIGHT_UPDATES = {}  # {update_id: chat_id}
+worker_state = {"polling": False, "draining": False, "last_update_id": None, "last_update_at": None, "updates_total": 0,
+                "backlog_last_update_id": None}
+
+# Разбивка времени запуска по этапам (мс) для лога и health-эндпоинта
+startup_timings = {"phases": {}, "ready_ms": None, "first_update_ms": None}
+_startup_mark = STARTUP_STARTED
+
+def mark_startup(phase):
+    """Записывает длительность этапа запуска с предыдущей отметки"""
+    global _startup_mark
+    now = time.perf_counter()
+    startup_timings["phases"][phase] = round((now - _startup_mark) * 1000, 1)
+    _startup_mark = now
+
+def _since_start_ms():
+    return round((time.perf_counter() - STARTUP_STARTED) * 1000, 1)
+
+# Режим воркера (workers.py): обновления своей доли пользователей приходят от фронта в POST /update
+WORKER_INDEX = int(os.environ["BOT_WORKER_INDEX"]) if os.environ.get("BOT_WORKER_INDEX") else None
+WORKER_COUNT = int(os.environ.get("BOT_WORKERS", 1))
+# Воркер сохраняет сессии в свой файл, фронт потом собирает их в SESSION_SNAPSHOT_PATH
+WORKER_SNAPSHOT_PATH = SESSION_SNAPSHOT_PATH if WORKER_INDEX is None else worker_snapshot_path(SESSION_SNAPSHOT_PATH, WORKER_INDEX)
+FED_UPDATE_TASKS = set()  # Обработка обновлений, полученных от фронта
+
+# Номер последнего обработанного обновления переживает перезапуск (у воркеров его хранит фронт)
+update_offset = UpdateOffset() if WORKER_INDEX is None else None
+BACKLOG_CHAINS = {}  # {user_id: задача разбора накопленных за время простоя обновлений пользователя}
+
 # Создаем отдельный маршрутизатор для отладочных команд (с меньшим приоритетом)
 debug_router = Router(name="debug_router")
 
+async def update_trace_middleware(handler, update, data):
+    """Открывает трассу на всё время обработки обновления"""
+    user = data.get("event_from_user")
+    chat = data.get("event_chat")
+    # Обновления в обработке: при плавном перезапуске их дожидаются или предупреждают пользователя
+    IN_FLIGHT_UPDATES[update.update_id] = chat.id if chat else None
+    worker_state["last_update_id"] = max(worker_state["last_update_id"] or 0, update.update_id)
+    worker_state["last_update_at"] = time.time()
+    worker_state["updates_total"] += 1
+    if startup_timings["first_update_ms"] is None:
+        startup_timings["first_update_ms"] = _since_start_ms()
+        logger.info(f"Первое обновление через {startup_timings['first_update_ms']} мс после запуска")
+    try:
+        with start_trace(update.event_type, user.id if user else None):
+            return await handler(update, data)
+    finally:
+        IN_FLIGHT_UPDATES.pop(update.update_id, None)
+        advance_update_offset()
+
+def advance_update_offset():
+    """Обработаны все обновления до самого раннего из тех, что ещё в обработке"""
+    if update_offset is not None:
+        update_offset.advance(min(IN_FLIGHT_UPDATES) - 1 if IN_FLIGHT_UPDATES else worker_state["last_update_id"])
+
+async def backlog_order_middleware(handler, update, data):
+    """Новые обновления пользователя ждут разбора его накопленных обновлений, чтобы не нарушить порядок"""
+    user = data.get("event_from_user")
+    chain = BACKLOG_CHAINS.get(user.id) if user else None
+    if chain is not None and update.update_id > worker_state["backlog_last_update_id"]:
+        await asyncio.wait({chain})
+    return await handler(update, data)
+
+async def handler_metrics_middleware(handler, event, data):
+    """Замеряет время работы обработчика обновления для /metrics"""
+    handler_object = data.get("handler")
+    name = handler_object.callback.__name__ if handler_object else "unknown"
+    started = time.perf_counter()
+    try:
+        with span(f"handler.{name}"):
+            return await handler(event, data)
+    except Exception:
+        HANDLER_ERRORS.labels(name).inc()
+        raise
+    finally:
+        HANDLER_DURATION.labels(name).observe(time.perf_counter() - started)
+
+async def telegram_api_metrics_middleware(make_request, bot, method):
+    """Замеряет вызовы Bot API и считает ошибки по методам"""
+    name = method.__api_method__
+    started = time.perf_counter()
+    try:
+        with span(f"telegram.{name}"):
+            return await make_request(bot, method)
+    except Exception as e:
+        TELEGRAM_API_ERRORS.labels(name, type(e).__name__).inc()
+        raise
+    finally:
+        TELEGRAM_API_DURATION.labels(name).observe(time.perf_counter() - started)
+
+# Внутренние middleware диспетчера действуют на обработчики всех вложенных маршрутизаторов
+dp.update.outer_middleware(update_trace_middleware)
+dp.update.outer_middleware(backlog_order_middleware)
+dp.message.middleware(handler_metrics_middleware)
+dp.callback_query.middleware(handler_metrics_middleware)
+bot.session.middleware(telegram_api_metrics_middleware)
+
 # Важно: включаем router в диспетчер ПЕРЕД регистрацией других обработчиков
 dp.include_router(router)  # Основной маршрутизатор с приоритетом по умолчанию
 
@@ -67,6 +183,8 @@ dp.include_router(debug_router)
 # Инициализация менеджера сессий и клиента LLM
 session_manager = SessionManager()
 llm_client = LLMClient()
+SESSIONS.set_function(lambda: len(session_manager.sessions))
+LOG_DROPPED.set_function(dropped_records)
 
 # Главное меню с кнопками команд
 main_keyboard = ReplyKeyboardMarkup(
@@ -89,153 +207,6 @@ size_keyboard = InlineKeyboardMarkup(inline_keyboard=[
     [InlineKeyboardButton(text="Длинный пост (800-1200 символов)", callback_data="size:large")]
 ])
 
-# Список специальных символов, которые нужно экранировать в MarkdownV2
-SPECIAL_CHARS = ['_', '*', '[', ']', '(', ')', '~', '`', '>', '#', '+', '-', '=', '|', '{', '}', '.', '!']
-
-def escape_markdown(text):
-    """Экранирует специальные символы для MarkdownV2, но сохраняет форматирование md-разметки"""
-    # Сначала защищаем существующую разметку
-    # Защищаем **жирный**
-    bold_pattern = r'(\*\*)(.*?)(\*\*)'
-    protected_text = re.sub(bold_pattern, lambda m: f"BOLD_START{m.group(2)}BOLD_END", text)
-    
-    # Защищаем `код`
-    code_pattern = r'(`)(.*?)(`)'
-    protected_text = re.sub(code_pattern, lambda m: f"CODE_START{m.group(2)}CODE_END", protected_text)
-    
-    # Защищаем ```блок кода```
-    code_block_pattern = r'(```)(.*?)(```)'
-    protected_text = re.sub(code_block_pattern, lambda m: f"CODE_BLOCK_START{m.group(2)}CODE_BLOCK_END", protected_text)
-    
-    # Защищаем ~~зачеркнутый~~
-    strike_pattern = r'(~~)(.*?)(~~)'
-    protected_text = re.sub(strike_pattern, lambda m: f"STRIKE_START{m.group(2)}STRIKE_END", protected_text)
-    
-    # Защищаем ||скрытый текст||
-    spoiler_pattern = r'(\|\|)(.*?)(\|\|)'
-    protected_text = re.sub(spoiler_pattern, lambda m: f"SPOILER_START{m.group(2)}SPOILER_END", protected_text)
-    
-    # Защищаем [ссылка](URL)
-    link_pattern = r'(\[)(.*?)(\])(\()(.*?)(\))'
-    protected_text = re.sub(link_pattern, lambda m: f"LINK_TEXT_START{m.group(2)}LINK_TEXT_END{m.group(4)}LINK_URL{m.group(6)}", protected_text)
-    
-    # Экранируем все специальные символы
-    for char in SPECIAL_CHARS:
-        protected_text = protected_text.replace(char, f'\\{char}')
-    
-    # Восстанавливаем защищенную разметку
-    result = protected_text.replace("BOLD_START", "**").replace("BOLD_END", "**")
-    result = result.replace("CODE_START", "`").replace("CODE_END", "`")
-    result = result.replace("CODE_BLOCK_START", "```").replace("CODE_BLOCK_END", "```")
-    result = result.replace("STRIKE_START", "~~").replace("STRIKE_END", "~~")
-    result = result.replace("SPOILER_START", "||").replace("SPOILER_END", "||")
-    result = result.replace("LINK_TEXT_START", "[").replace("LINK_TEXT_END", "]")
-    result = result.replace("LINK_URL", "(").replace("(LINK_URL", "(")
-    
-    return result
-
-def format_message_text(text):
-    """Подготавливает текст с учетом ограничений Markdown в Telegram"""
-    # Преобразование блоков кода и скрытого текста в HTML, так как они не поддерживаются в MarkdownV2
-    
-    # Преобразование ```блок кода``` в <pre>блок кода</pre>
-    code_block_pattern = r'```(.*?)```'
-    html_with_code_blocks = re.sub(code_block_pattern, r'<pre>\1</pre>', text, flags=re.DOTALL)
-    
-    # Преобразование ||скрытый текст|| в <tg-spoiler>скрытый текст</tg-spoiler>
-    spoiler_pattern = r'\|\|(.*?)\|\|'
-    html_text = re.sub(spoiler_pattern, r'<tg-spoiler>\1</tg-spoiler>', html_with_code_blocks)
-    
-    # Остальная Markdown-разметка поддерживается в MarkdownV2
-    # Экранируем специальные символы для MarkdownV2
-    markdown_types = ['**', '`', '~~', '[', ']', '(', ')']
-    
-    for md_type in markdown_types:
-        html_text = html_text.replace(md_type, f'\\{md_type}')
-    
-    # Экранируем другие специальные символы
-    for char in ['.', '!', '+', '-', '=', '>', '#', '|', '{', '}']:
-        html_text = html_text.replace(char, f'\\{char}')
-    
-    # Восстанавливаем Markdown-разметку
-    html_text = html_text.replace('\\*\\*', '**')
-    html_text = html_text.replace('\\`', '`')
-    html_text = html_text.replace('\\~\\~', '~~')
-    
-    # Восстанавливаем ссылки
-    link_pattern = r'\\\[\s*(.*?)\s*\\\]\\\(\s*(.*?)\s*\\\)'
-    html_text = re.sub(link_pattern, r'[\1](\2)', html_text)
-    
-    return html_text
-
-def format_to_html(text):
-    """Конвертирует Markdown-разметку в HTML для использования в Telegram"""
-    # Сначала экранируем специальные HTML-символы
-    html_text = text.replace('&', '&amp;')
-    html_text = html_text.replace('<', '&lt;').replace('>', '&gt;')
-    
-    # Сохраняем плейсхолдеры для разметки, чтобы избежать проблем с вложенными тегами
-    placeholders = {}
-    
-    # Функция для создания уникальных плейсхолдеров
-    def placeholder(match, prefix):
-        nonlocal placeholders
-        content = match.group(1)
-        placeholder_id = f"__{prefix}_{len(placeholders)}__"
-        placeholders[placeholder_id] = content
-        return placeholder_id
-    
-    # Заменяем Markdown на плейсхолдеры
-    # **жирный** -> __bold_0__
-    bold_pattern = r'\*\*(.*?)\*\*'
-    html_text = re.sub(bold_pattern, lambda m: placeholder(m, "bold"), html_text)
-    
-    # `код` -> __code_0__
-    code_pattern = r'`(.*?)`'
-    html_text = re.sub(code_pattern, lambda m: placeholder(m, "code"), html_text)
-    
-    # ```блок кода``` -> __codeblock_0__
-    code_block_pattern = r'```(.*?)```'
-    html_text = re.sub(code_block_pattern, lambda m: placeholder(m, "codeblock"), html_text, flags=re.DOTALL)
-    
-    # ~~зачеркнутый~~ -> __strike_0__
-    strike_pattern = r'~~(.*?)~~'
-    html_text = re.sub(strike_pattern, lambda m: placeholder(m, "strike"), html_text)
-    
-    # ||скрытый текст|| -> __spoiler_0__
-    spoiler_pattern = r'\|\|(.*?)\|\|'
-    html_text = re.sub(spoiler_pattern, lambda m: placeholder(m, "spoiler"), html_text)
-    
-    # [ссылка](URL) -> __link_0__
-    link_pattern = r'\[(.*?)\]\((.*?)\)'
-    
-    def link_placeholder(match):
-        text = match.group(1)
-        url = match.group(2)
-        placeholder_id = f"__link_{len(placeholders)}__"
-        placeholders[placeholder_id] = (text, url)
-        return placeholder_id
-    
-    html_text = re.sub(link_pattern, link_placeholder, html_text)
-    
-    # Заменяем плейсхолдеры на HTML-теги
-    for placeholder_id, content in placeholders.items():
-        if placeholder_id.startswith("__bold_"):
-            html_text = html_text.replace(placeholder_id, f"<b>{content}</b>")
-        elif placeholder_id.startswith("__code_"):
-            html_text = html_text.replace(placeholder_id, f"<code>{content}</code>")
-        elif placeholder_id.startswith("__codeblock_"):
-            html_text = html_text.replace(placeholder_id, f"<pre>{content}</pre>")
-        elif placeholder_id.startswith("__strike_"):
-            html_text = html_text.replace(placeholder_id, f"<s>{content}</s>")
-        elif placeholder_id.startswith("__spoiler_"):
-            html_text = html_text.replace(placeholder_id, f"<tg-spoiler>{content}</tg-spoiler>")
-        elif placeholder_id.startswith("__link_"):
-            text, url = content
-            html_text = html_text.replace(placeholder_id, f'<a href="{url}">{text}</a>')
-    
-    return html_text
-
 # Глобальный флаг для предотвращения двойной отправки
 POST_ALREADY_SENT = {}
 
@@ -298,6 +269,77 @@ async def process_mode_selection(callback_query: CallbackQuery):
     # Отвечаем на callback до начала генерации
     await callback_query.answer()
 
+async def generate_with_first_draft(generation, topic, post_size, status_message):
+    """Ожидает генерацию поста; если она затягивается, показывает локальный черновик"""
+    task = asyncio.ensure_future(generation)
+    if FIRST_DRAFT_DELAY > 0:
+        done, _ = await asyncio.wait({task}, timeout=FIRST_DRAFT_DELAY)
+        if not done:
+            draft = fallback_generator.generate(topic, post_size)
+            try:
+                await status_message.edit_text(f"⏳ Нейросеть ещё пишет пост, а вот быстрый черновик:\n\n{draft}")
+            except Exception as e:
+                logger.error(f"Не удалось показать черновик: {e}")
+    return await task
+
+def generate_post(session, topic, post_size):
+    """Запрос генерации поста в режиме сессии: по шаблону или только по теме"""
+    if session.mode == GenerationMode.TEMPLATE and hasattr(session, 'template_post') and session.template_post:
+        return llm_client.generate_from_template(
+            template_post=session.template_post,
+            topic=topic,
+            post_size=post_size,
+            language="ru"
+        )
+    return llm_client.generate_without_template(
+        topic=topic,
+        post_size=post_size,
+        language="ru"
+    )
+
+async def send_generated_post(message, user_id, generated_post):
+    """Отправляет сгенерированный пост и кнопки действий с ним"""
+    # Сохраняем сгенерированный пост, история правок относится к предыдущему посту
+    session_manager.update_session(user_id, current_post=generated_post, edit_session=None)
+    
+    # Устанавливаем флаг, что сообщение ещё не отправлялось
+    POST_ALREADY_SENT[user_id] = False
+    
+    try:
+        # Попытка отправить с HTML форматированием
+        with span("format_to_html"):
+            html_text = format_to_html(generated_post)
+        sent_message = await message.answer(html_text, parse_mode="HTML")
+        # Запоминаем ID сообщения с постом
+        session_manager.update_session(user_id, current_post_message_id=sent_message.message_id)
+        # Помечаем что сообщение отправлено
+        POST_ALREADY_SENT[user_id] = True
+    except Exception as e:
+        # Только если HTML отправка не удалась, пробуем обычный текст
+        logger.error(f"Ошибка при отправке HTML: {e}")
+        if not POST_ALREADY_SENT.get(user_id, False):
+            sent_message = await message.answer(generated_post)
+            session_manager.update_session(user_id, current_post_message_id=sent_message.message_id)
+    
+    # Создаем инлайн-кнопки для действий с постом
+    actions_keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="✏️ Изменить пост", callback_data="action:edit")],
+        [InlineKeyboardButton(text="🚀 Создать новый пост", callback_data="action:new")]
+    ])
+    
+    await message.answer(
+        "Что делаем дальше?",
+        reply_markup=actions_keyboard
+    )
+
+# Кнопка отложенной генерации: пост придёт отдельным сообщением, когда будет готов
+notify_keyboard = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="🔔 Прислать, когда будет готов", callback_data="notify:ready")]
+])
+
+# Пользователи, чья отложенная генерация уже в очереди
+DEFERRED_GENERATIONS = set()
+
 @router.callback_query(lambda c: c.data.startswith("size:"))
 async def process_size_selection(callback_query: CallbackQuery):
     """Обработчик выбора размера поста"""
@@ -329,6 +371,24 @@ async def process_size_selection(callback_query: CallbackQuery):
     # Важно: отвечаем на callback сразу, до начала генерации
     await callback_query.answer()
     
+    # Запрос, который не успеет до таймаута, не занимает очередь: пользователь сразу узнаёт оценку
+    decision, wait = llm_client.admission.decide()
+    if decision != "admit" and session.last_topic:
+        logger.info(f"Генерация для {user_id} не допущена ({decision}), оценка ожидания {wait:.0f} с")
+        if decision == "defer":
+            await callback_query.message.edit_text(
+                f"🚦 Сейчас много запросов к нейросети: пост будет готов {format_wait(wait)}. "
+                "Ждать в чате не нужно - нажмите кнопку, и я пришлю пост, когда он будет готов.",
+                reply_markup=notify_keyboard
+            )
+        else:
+            await callback_query.message.edit_text(
+                f"🚦 Сейчас слишком много запросов к нейросети: пост был бы готов не раньше чем {format_wait(wait)}. "
+                "Пожалуйста, выберите размер поста ещё раз немного позже.",
+                reply_markup=size_keyboard
+            )
+        return
+    
     # Редактируем сообщение с информацией о начале генерации
     status_message = await callback_query.message.edit_text("Понял! Генерирую ваш пост...")
     
@@ -342,71 +402,19 @@ async def process_size_selection(callback_query: CallbackQuery):
             
         logger.info(f"Генерация поста для пользователя {user_id}. Тема: {topic}, Размер: {post_size}")
         
-        # Использование разных методов в зависимости от режима
-        if session.mode == GenerationMode.TEMPLATE and hasattr(session, 'template_post') and session.template_post:
-            try:
-                generated_post = await asyncio.wait_for(
-                    llm_client.generate_from_template(
-                        template_post=session.template_post, 
-                        topic=topic,
-                        post_size=post_size,
-                        language="ru"
-                    ),
-                    timeout=45  # 45 секунд таймаут
-                )
-            except asyncio.TimeoutError:
-                logger.error(f"Таймаут при генерации поста по шаблону для {user_id}")
-                await status_message.edit_text("⌛ Время ожидания истекло. Пожалуйста, попробуйте еще раз или выберите другой размер поста.")
-                return
-        else:
-            try:
-                generated_post = await asyncio.wait_for(
-                    llm_client.generate_without_template(
-                        topic=topic,
-                        post_size=post_size,
-                        language="ru"
-                    ),
-                    timeout=45  # 45 секунд таймаут
-                )
-            except asyncio.TimeoutError:
-                logger.error(f"Таймаут при генерации поста без шаблона для {user_id}")
-                await status_message.edit_text("⌛ Время ожидания истекло. Пожалуйста, попробуйте еще раз или выберите другой размер поста.")
-                return
-        
-        # Сохраняем сгенерированный пост
-        session_manager.update_session(user_id, current_post=generated_post)
+        try:
+            generated_post = await asyncio.wait_for(
+                generate_with_first_draft(generate_post(session, topic, post_size), topic, post_size, status_message),
+                timeout=GENERATION_TIMEOUT
+            )
+        except asyncio.TimeoutError:
+            logger.error(f"Таймаут при генерации поста для {user_id}")
+            await status_message.edit_text("⌛ Время ожидания истекло. Пожалуйста, попробуйте еще раз или выберите другой размер поста.")
+            return
         
         # Отправляем результат
         await status_message.edit_text("✅ Генерация завершена!")
-        
-        # Устанавливаем флаг, что сообщение ещё не отправлялось
-        POST_ALREADY_SENT[user_id] = False
-        
-        try:
-            # Попытка отправить с HTML форматированием
-            html_text = format_to_html(generated_post)
-            sent_message = await callback_query.message.answer(html_text, parse_mode="HTML")
-            # Запоминаем ID сообщения с постом
-            session_manager.update_session(user_id, current_post_message_id=sent_message.message_id)
-            # Помечаем что сообщение отправлено
-            POST_ALREADY_SENT[user_id] = True
-        except Exception as e:
-            # Только если HTML отправка не удалась, пробуем обычный текст
-            logger.error(f"Ошибка при отправке HTML: {e}")
-            if not POST_ALREADY_SENT.get(user_id, False):
-                sent_message = await callback_query.message.answer(generated_post)
-                session_manager.update_session(user_id, current_post_message_id=sent_message.message_id)
-        
-        # Создаем инлайн-кнопки для действий с постом
-        actions_keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="✏️ Изменить пост", callback_data="action:edit")],
-            [InlineKeyboardButton(text="🚀 Создать новый пост", callback_data="action:new")]
-        ])
-        
-        await callback_query.message.answer(
-            "Что делаем дальше?",
-            reply_markup=actions_keyboard
-        )
+        await send_generated_post(callback_query.message, user_id, generated_post)
         
     except Exception as e:
         logger.error(f"Ошибка при генерации поста: {e}")
@@ -415,6 +423,55 @@ async def process_size_selection(callback_query: CallbackQuery):
             "Пожалуйста, попробуйте еще раз или выберите другой размер поста."
         )
 
+@router.callback_query(lambda c: c.data == "notify:ready")
+async def process_notify_request(callback_query: CallbackQuery):
+    """Отложенная генерация: пост приходит новым сообщением, когда готов, без таймаута чата"""
+    user_id = callback_query.from_user.id
+    await callback_query.answer()
+    
+    if user_id in DEFERRED_GENERATIONS:
+        await callback_query.message.edit_text("🔔 Ваш пост уже в очереди, я пришлю его, когда он будет готов.")
+        return
+    
+    session = session_manager.get_session(user_id)
+    topic = session.last_topic
+    post_size = session.post_size or PostSize.MEDIUM
+    if not topic:
+        await callback_query.message.edit_text("❌ Не указана тема для генерации. Пожалуйста, начните сначала.")
+        return
+    
+    # Очередь могла вырасти, пока пользователь решал
+    decision, wait = llm_client.admission.decide(deadline=ADMISSION_MAX_WAIT)
+    if decision == "reject":
+        await callback_query.message.edit_text(
+            f"🚦 Очередь выросла: пост был бы готов не раньше чем {format_wait(wait)}. "
+            "Пожалуйста, выберите размер поста ещё раз немного позже.",
+            reply_markup=size_keyboard
+        )
+        return
+    
+    status_message = await callback_query.message.edit_text(f"🔔 Хорошо, пришлю пост, когда он будет готов ({format_wait(wait)}).")
+    logger.info(f"Отложенная генерация для {user_id}, оценка ожидания {wait:.0f} с")
+    DEFERRED_GENERATIONS.add(user_id)
+    try:
+        generated_post = await asyncio.wait_for(
+            generate_with_first_draft(generate_post(session, topic, post_size), topic, post_size, status_message),
+            timeout=ADMISSION_MAX_WAIT
+        )
+        await status_message.edit_text("✅ Пост готов!")
+        # Новое сообщение, а не правка прежнего: о нём придёт уведомление
+        await send_generated_post(callback_query.message, user_id, generated_post)
+    except asyncio.TimeoutError:
+        logger.error(f"Таймаут отложенной генерации для {user_id}")
+        await callback_query.message.answer("⌛ Не удалось дождаться нейросети. Пожалуйста, попробуйте ещё раз позже.")
+    except Exception as e:
+        logger.error(f"Ошибка при отложенной генерации поста: {e}")
+        await callback_query.message.answer(
+            f"❌ Произошла ошибка при генерации поста: {str(e)}. Пожалуйста, попробуйте еще раз."
+        )
+    finally:
+        DEFERRED_GENERATIONS.discard(user_id)
+
 @router.callback_query(lambda c: c.data.startswith("action:"))
 async def process_post_action(callback_query: CallbackQuery):
     """Обработчик действий с постом"""
@@ -457,7 +514,8 @@ async def cmd_change(message: Message, user_id: int):
     
     # Показываем текущий пост и запрашиваем изменения
     try:
-        html_text = format_to_html(session.current_post)
+        with span("format_to_html"):
+            html_text = format_to_html(session.current_post)
         post_message = await message.answer(f"Текущий пост:\n\n{html_text}", parse_mode="HTML")
         # Сохраняем ID сообщения с текущим постом
         session_manager.update_session(user_id, current_post_message_id=post_message.message_id)
@@ -541,13 +599,17 @@ async def process_message(message: Message):
             # Отправляем сообщение о редактировании
             processing_msg = await message.answer("⏳ Редактирую пост согласно вашим пожеланиям... Это может занять до 30 секунд.")
             
+            # История правок поста: модель видит предыдущие запросы пользователя
+            edit_session = user_state.edit_session or EditSession(max_turns=EDIT_HISTORY_MAX_TURNS)
+            
             try:
                 # Вызываем редактирование с таймаутом
                 try:
                     edited_text = await asyncio.wait_for(
                         llm_client.modify_post(
                             current_post=user_state.current_post,
-                            modification_request=edit_request
+                            modification_request=edit_request,
+                            edit_session=edit_session
                         ),
                         timeout=45  # 45 секунд на всё редактирование
                     )
@@ -557,8 +619,8 @@ async def process_message(message: Message):
                     await message.answer("⌛ Время ожидания истекло. Пожалуйста, попробуйте еще раз с более простым запросом.")
                     return
                     
-                # Сохраняем отредактированный пост
-                session_manager.update_session(user_id, current_post=edited_text)
+                # Сохраняем отредактированный пост вместе с историей правок
+                session_manager.update_session(user_id, current_post=edited_text, edit_session=edit_session)
                 
                 # Удаляем сообщение о редактировании
                 await processing_msg.delete()
@@ -600,34 +662,209 @@ async def cancel_active_requests():
     except Exception as e:
         logger.error(f"Ошибка при отмене запросов: {e}")
 
-# Функция проверки работоспособности API
-async def test_api_connection():
-    """Проверяет доступность API методом отправки тестового запроса."""
-    logger.info("Проверка подключения к API...")
+async def drain_and_stop():
+    """
+    Плавная остановка по SIGTERM: больше не принимаем обновления, ждём начатые генерации
+    не дольше DRAIN_TIMEOUT, предупреждаем тех, чьи запросы не успели, и сохраняем сессии
+    для процесса, который продолжит работу.
+    """
+    if worker_state["draining"]:
+        return
+    worker_state["draining"] = True
+    logger.info(f"Плавная остановка: новые обновления не принимаются, в обработке {len(IN_FLIGHT_UPDATES)}")
+    
+    try:
+        await dp.stop_polling()
+    except RuntimeError:
+        pass  # polling ещё не запущен
+    
+    # Подтверждаем полученные обновления, чтобы новый процесс не обработал их повторно;
+    # воркер обновления не запрашивает, их подтверждает фронт
+    if WORKER_INDEX is None and worker_state["last_update_id"] is not None:
+        try:
+            await bot.get_updates(offset=worker_state["last_update_id"] + 1, limit=1, timeout=0)
+        except Exception as e:
+            logger.warning(f"Не удалось подтвердить обновления: {e}")
+    
+    pending = set(dp._handle_update_tasks) | FED_UPDATE_TASKS | set(BACKLOG_CHAINS.values())
+    if pending:
+        _, pending = await asyncio.wait(pending, timeout=DRAIN_TIMEOUT)
+    if pending:
+        logger.warning(f"За {DRAIN_TIMEOUT} с не завершено {len(pending)} обновлений, отменяем")
+        chat_ids = {chat_id for chat_id in IN_FLIGHT_UPDATES.values() if chat_id is not None}
+        for task in pending:
+            task.cancel()
+        await cancel_active_requests()
+        for chat_id in chat_ids:
+            try:
+                await bot.send_message(chat_id, "⏳ Бот обновляется, запрос прерван. Пожалуйста, повторите его через несколько секунд.")
+            except Exception as e:
+                logger.warning(f"Не удалось предупредить чат {chat_id}: {e}")
+    
     try:
+        session_manager.save_snapshot(WORKER_SNAPSHOT_PATH)
+    except Exception as e:
+        logger.error(f"Не удалось сохранить сессии: {e}")
+    
+    # Все полученные обновления подтверждены, а чьи не успели - предупреждены
+    if update_offset is not None:
+        update_offset.advance(worker_state["last_update_id"])
+        update_offset.save()
+
+async def wait_for_handoff():
+    """
+    При плавном перезапуске ждёт, пока прежний процесс (SUPERVISOR_HANDOFF_PID) допишет
+    сессии и завершится: Telegram отдаёт обновления только одному получателю.
+    """
+    handoff_pid = int(os.environ.get("SUPERVISOR_HANDOFF_PID", 0))
+    if not handoff_pid:
+        return
+    logger.info(f"Ожидание завершения прежнего процесса бота (PID {handoff_pid})")
+    deadline = time.monotonic() + DRAIN_TIMEOUT + 15
+    while time.monotonic() < deadline:
         try:
-            # Простой запрос для проверки соединения с таймаутом 10 секунд
-            await asyncio.wait_for(
-                llm_client.generate_without_template(
-                    topic="тестовый запрос",
-                    post_size=PostSize.SMALL
-                ), 
-                timeout=10.0
+            os.kill(handoff_pid, 0)
+        except ProcessLookupError:
+            break
+        except PermissionError:
+            pass
+        await asyncio.sleep(0.1)
+    else:
+        logger.warning(f"Прежний процесс {handoff_pid} не завершился за отведённое время, начинаем polling")
+
+async def process_fed_update(data):
+    """Обрабатывает обновление, переданное фронтом, как это делает polling"""
+    try:
+        await dp.feed_raw_update(bot, data)
+    except Exception as e:
+        logger.error(f"Ошибка при обработке обновления {data.get('update_id')} от фронта: {e}")
+
+def feed_update(data):
+    """
+    Запускает обработку обновления от фронта в отдельной задаче. Фронт передаёт обновления
+    одного воркера по очереди, поэтому задачи создаются в порядке получения от Telegram,
+    как и при polling.
+    """
+    task = asyncio.create_task(process_fed_update(data))
+    FED_UPDATE_TASKS.add(task)
+    task.add_done_callback(FED_UPDATE_TASKS.discard)
+    return task
+
+async def process_backlog_chain(updates):
+    """Обрабатывает накопленные обновления одного пользователя по очереди"""
+    try:
+        for update in updates:
+            try:
+                await dp.feed_raw_update(bot, update)
+            except Exception as e:
+                logger.error(f"Ошибка при обработке накопленного обновления {update['update_id']}: {e}")
+    finally:
+        # Не начатые из-за остановки обновления больше не в обработке
+        for update in updates:
+            IN_FLIGHT_UPDATES.pop(update["update_id"], None)
+
+async def drain_backlog():
+    """
+    Забирает обновления, накопившиеся за время простоя, и запускает их разбор вместо
+    drop_pending_updates: разных пользователей одновременно, одного - по очереди.
+    Уже обработанные, устаревшие и повторные нажатия кнопок отбрасываются.
+    """
+    offset = update_offset.saved + 1 if update_offset.saved is not None else None
+    updates = []
+    try:
+        # Запрос со следующим offset подтверждает полученные, последний пустой ответ - конец очереди
+        while True:
+            batch = await bot.get_updates(offset=offset, limit=100, timeout=0, request_timeout=15)
+            if not batch:
+                break
+            updates.extend(update.model_dump(mode="json", by_alias=True, exclude_none=True) for update in batch)
+            offset = batch[-1].update_id + 1
+    except Exception as e:
+        logger.error(f"Ошибка при получении накопленных обновлений: {e}")
+    if not updates:
+        return
+    
+    kept, stats = prepare_backlog(updates, update_offset.saved)
+    for outcome in ("processed_before", "expired", "collapsed"):
+        BACKLOG_UPDATES.labels(outcome).inc(stats[outcome])
+    BACKLOG_UPDATES.labels("processed").inc(len(kept))
+    worker_state["last_update_id"] = max(worker_state["last_update_id"] or 0, updates[-1]["update_id"])
+    worker_state["backlog_last_update_id"] = updates[-1]["update_id"]
+    
+    chains = {}
+    for update in kept:
+        chains.setdefault(update_user_id(update), []).append(update)
+        # До начала обработки обновление считается в обработке: номер не сохранится раньше времени
+        IN_FLIGHT_UPDATES[update["update_id"]] = update_chat_id(update)
+    for user_id, user_updates in chains.items():
+        task = asyncio.create_task(process_backlog_chain(user_updates))
+        BACKLOG_CHAINS[user_id] = task
+        task.add_done_callback(lambda _, user_id=user_id: BACKLOG_CHAINS.pop(user_id, None))
+    advance_update_offset()
+    logger.info(f"Накоплено обновлений: {stats['received']} (уже обработано {stats['processed_before']}, "
+                f"устарело {stats['expired']}, повторных нажатий {stats['collapsed']}), "
+                f"разбираем {len(kept)} от {len(chains)} пользователей")
+
+async def publish_stats(writer):
+    """Публикует счётчики бота в общую память для simple_server и фронта"""
+    while True:
+        try:
+            flags = (FLAG_ACCEPTING if worker_state["polling"] else 0) | (FLAG_DRAINING if worker_state["draining"] else 0)
+            writer.publish(
+                flags=flags,
+                last_update_at=worker_state["last_update_at"],
+                updates_total=worker_state["updates_total"],
+                active_requests=len(llm_client.active_requests),
+                llm_queue=LLM_QUEUE_DEPTH.get(),
+                sessions=len(session_manager.sessions),
+                in_flight_updates=len(IN_FLIGHT_UPDATES),
+                loop_lag_ms=loop_watchdog.lag_ms(),
+                loop_lag_max_ms=loop_watchdog.max_lag_ms(),
+                loop_stalls=loop_watchdog.stall_count
             )
-            
-            logger.info("Тестовый запрос к API выполнен успешно!")
-            return True
-        except asyncio.TimeoutError:
-            logger.error("Тестовый запрос к API превысил таймаут (10 секунд)")
-            return False
+        except Exception as e:
+            logger.error(f"Ошибка при публикации счётчиков: {e}")
+        await asyncio.sleep(PUBLISH_INTERVAL)
+
+async def prepare_polling():
+    """
+    Готовит polling одной проверкой webhook: при активном webhook getUpdates не работает.
+    Одновременно запрашивается getMe, который aiogram иначе выполнит перед первым getUpdates.
+    """
+    async def check_webhook():
+        webhook_info = await bot.get_webhook_info(request_timeout=10)
+        if webhook_info.url:
+            logger.warning(f"Обнаружен активный webhook: {webhook_info.url}, удаляем")
+            await bot.delete_webhook(request_timeout=10)
+        else:
+            logger.info("Webhook не активен, работаем в режиме polling")
+    
+    results = await asyncio.gather(check_webhook(), bot.me(), return_exceptions=True)
+    for name, result in zip(("проверке webhook", "запросе getMe"), results):
+        if isinstance(result, Exception):
+            logger.error(f"Ошибка при {name}: {result}")
+
+# Результат проверки доступности API LLM при запуске: {url: {"reachable", "status", "ms"}}
+llm_probe_results = None
+
+async def probe_llm_endpoints():
+    """Фоновая проверка доступности API LLM: без генерации, поэтому не тратит лимиты и токены"""
+    global llm_probe_results
+    if llm_client.cassette is not None and llm_client.cassette.replaying:
+        return
+    try:
+        llm_probe_results = await llm_client.probe_endpoints()
     except Exception as e:
-        logger.error(f"Тестовый запрос к API не удался: {e}")
-        return False
+        logger.error(f"Ошибка при проверке API: {e}")
+        return
+    reachable = sum(1 for result in llm_probe_results.values() if result["reachable"])
+    if reachable:
+        logger.info(f"API доступен по {reachable} из {len(llm_probe_results)} URL, первым используется {llm_client.api_urls[0]}")
+    else:
+        logger.warning("API недоступен ни по одному URL, бот будет отвечать локальными черновиками")
 
 if __name__ == "__main__":
-    # Устанавливаем уровень логирования, чтобы видеть все сообщения
-    logging.basicConfig(level=logging.INFO, 
-                       format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    mark_startup("imports")
     logger.info("===== Запуск бота =====")
     
     # Логируем параметры окружения
@@ -653,50 +890,14 @@ if __name__ == "__main__":
     import asyncio
     
     async def run_all():
-        # Проверяем и удаляем webhook с помощью прямых запросов к API
-        logger.info("Проверяем статус webhook...")
-        try:
-            # Получаем информацию о текущем webhook
-            webhook_info = await bot.get_webhook_info()
-            if webhook_info.url:
-                logger.warning(f"Обнаружен активный webhook: {webhook_info.url}")
-                
-                # Удаляем webhook через API бота
-                logger.info("Удаляю webhook через API...")
-                await bot.delete_webhook(drop_pending_updates=True)
-                
-                # Повторно проверяем статус webhook
-                webhook_info = await bot.get_webhook_info()
-                if webhook_info.url:
-                    logger.error(f"Webhook всё ещё активен после попытки удаления: {webhook_info.url}")
-                    logger.warning("Пробую альтернативный метод удаления webhook...")
-                    
-                    # Используем альтернативный метод - прямой HTTP запрос
-                    import aiohttp
-                    delete_url = f"https://api.telegram.org/bot{BOT_TOKEN}/deleteWebhook?drop_pending_updates=true"
-                    async with aiohttp.ClientSession() as session:
-                        async with session.get(delete_url) as response:
-                            response_json = await response.json()
-                            if response.status == 200 and response_json.get('ok'):
-                                logger.info("Webhook успешно удален через прямой HTTP запрос!")
-                            else:
-                                logger.error(f"Не удалось удалить webhook: {response_json}")
-                else:
-                    logger.info("Webhook успешно удален!")
-            else:
-                logger.info("Webhook не активен, продолжаем работу в режиме polling.")
-        except Exception as e:
-            logger.error(f"Ошибка при проверке/удалении webhook: {e}")
+        # Воркер не работает с Telegram напрямую: webhook и polling - забота фронта.
+        # Проверка webhook идёт, пока запускается HTTP-сервер; дожидаемся её перед polling
+        prepare_task = asyncio.create_task(prepare_polling()) if WORKER_INDEX is None else None
         
-        # Проверяем API
-        try:
-            api_status = await test_api_connection()
-            if api_status:
-                logger.info("API доступен и работает")
-            else:
-                logger.warning("API недоступен, бот будет работать с заглушками")
-        except Exception as e:
-            logger.error(f"Ошибка при проверке API: {e}")
+        # Доступность API проверяется в фоне и не задерживает запуск
+        # (в режиме воркеров - только в первом, остальные делят тот же ключ)
+        if WORKER_INDEX in (None, 0):
+            probe_task = asyncio.create_task(probe_llm_endpoints())
         
         # Запускаем HTTP сервер для healthcheck и для Timeweb Cloud
         # Используем стандартный порт 8080, который нужен для Timeweb
@@ -727,7 +928,6 @@ if __name__ == "__main__":
         
         # Глобальная переменная для отслеживания состояния бота
         bot_started_at = time.time()
-        polling_active = True
         
         # Обработчик для принудительного завершения или перезапуска зависших запросов
         async def reset_handler(request):
@@ -746,18 +946,70 @@ if __name__ == "__main__":
             
             return web.json_response({
                 "status": "ok", 
-                "mode": "polling", 
+                "mode": "polling" if WORKER_INDEX is None else f"worker {WORKER_INDEX}/{WORKER_COUNT}", 
                 "timestamp": int(time.time()),
                 "uptime": uptime,
-                "polling_active": polling_active,
+                "polling_active": worker_state["polling"],
+                "draining": worker_state["draining"],
                 "handlers_count": len(dp.message.handlers),
                 "active_sessions": len(session_manager.sessions),
-                "active_requests": active_requests
+                "active_requests": active_requests,
+                "edit_stats": llm_client.edit_stats,
+                "loop_lag_ms": loop_watchdog.lag_ms(),
+                "loop_lag_max_ms": loop_watchdog.max_lag_ms(),
+                "loop_stalls": loop_watchdog.stall_count,
+                "admission": llm_client.admission.snapshot(),
+                "llm_reachable": None if llm_probe_results is None else sum(1 for result in llm_probe_results.values() if result["reachable"]),
+                "startup": startup_timings
             })
         
+        async def metrics_handler(request):
+            return web.Response(body=registry.render().encode("utf-8"), headers={"Content-Type": CONTENT_TYPE})
+        
         app.router.add_get('/', health_handler)
+        app.router.add_get('/metrics', metrics_handler)
+        
+        async def traces_handler(request):
+            # Разбор задержек по этапам: /debug/traces?user_id=123&min_ms=1000
+            try:
+                user_id = int(request.query["user_id"]) if "user_id" in request.query else None
+                limit = int(request.query.get("limit", 20))
+                min_ms = float(request.query.get("min_ms", 0))
+            except ValueError:
+                return web.json_response({"error": "user_id, limit и min_ms должны быть числами"}, status=400)
+            return web.json_response({"traces": recent_traces(user_id, limit, min_ms)})
+        
+        app.router.add_get('/debug/traces', traces_handler)
+        
+        async def loop_handler(request):
+            # Перцентили задержки цикла событий и самые частые места блокировок: /debug/loop?top=10
+            try:
+                top = int(request.query.get("top", 10))
+            except ValueError:
+                return web.json_response({"error": "top должен быть числом"}, status=400)
+            if "reset" in request.query:
+                loop_watchdog.reset()
+            return web.json_response(loop_watchdog.snapshot(top))
+        
+        app.router.add_get('/debug/loop', loop_handler)
+        # /debug/profile/cpu и /debug/profile/memory, только при PROFILING_ENABLED=1 и заданном токене
+        add_profiling_routes(app)
         app.router.add_get('/reset', reset_handler)  # Новый эндпоинт для сброса зависших запросов
         
+        async def update_handler(request):
+            # Обновление от фронта (workers.py); 503 - фронт повторит доставку позже
+            if not worker_state["polling"] or worker_state["draining"]:
+                return web.json_response({"ok": False, "error": "Воркер не принимает обновления"}, status=503)
+            try:
+                data = await request.json()
+            except ValueError:
+                return web.json_response({"ok": False, "error": "Ожидается JSON обновления"}, status=400)
+            feed_update(data)
+            return web.json_response({"ok": True})
+        
+        if WORKER_INDEX is not None:
+            app.router.add_post('/update', update_handler)
+        
         # Получаем порт из переменной окружения или используем 8081 по умолчанию
         # Используем другой порт, чтобы избежать конфликта с simple_server.py
         PORT = int(os.environ.get("BOT_HTTP_PORT", 8081))
@@ -769,9 +1021,39 @@ if __name__ == "__main__":
         site = web.TCPSite(runner, '0.0.0.0', PORT)
         await site.start()
         logger.info(f"HTTP сервер запущен на порту {PORT}")
+        mark_startup("http_server")
+        
+        # Сторож цикла событий: задержка для health-эндпоинта и монитора ресурсов, стеки блокировок
+        loop_watchdog.start()
+        
+        # Счётчики в общей памяти: simple_server и фронт читают их без HTTP-запросов
+        stats_writer = None
+        try:
+            stats_writer = StatsWriter(segment_path(os.getpid()))
+            stats_task = asyncio.create_task(publish_stats(stats_writer))
+        except OSError as e:
+            logger.warning(f"Сегмент счётчиков недоступен: {e}")
+        
+        # SIGTERM от надзора - плавная остановка с передачей сессий новому процессу
+        drain_task = None
+        def request_drain():
+            nonlocal drain_task
+            if drain_task is None:
+                drain_task = asyncio.create_task(drain_and_stop())
+        
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, request_drain)
+        
+        # Новый процесс при плавном перезапуске уже готов, но забирает обновления только после старого
+        await wait_for_handoff()
+        mark_startup("handoff")
+        # Воркер берёт из общего снимка только сессии своих пользователей
+        session_manager.load_snapshot(SESSION_SNAPSHOT_PATH, shard=None if WORKER_INDEX is None else (WORKER_INDEX, WORKER_COUNT))
+        mark_startup("snapshot")
         
         # Запускаем бота
-        logger.info("Запуск бота в режиме polling...")
+        logger.info("Запуск бота в режиме polling..." if WORKER_INDEX is None else f"Запуск воркера {WORKER_INDEX} из {WORKER_COUNT}...")
         
         # Выводим информацию о зарегистрированных обработчиках
         router_info = "Зарегистрированные обработчики:\n"
@@ -785,45 +1067,72 @@ if __name__ == "__main__":
             logger.error(f"Ошибка при обработке обновления: {exception}")
             return True  # Продолжаем обработку других обновлений
         
+        # Мониторинг активных запросов каждые 5 минут
+        async def monitor_active_requests():
+            stalls_reported = 0
+            while True:
+                try:
+                    await asyncio.sleep(300)  # Проверка каждые 5 минут
+                    active_requests = len(llm_client.active_requests) if hasattr(llm_client, 'active_requests') else 0
+                    logger.info(f"Мониторинг: {active_requests} активных API запросов")
+                    # Запросы могут висеть из-за заблокированного цикла событий, а не из-за API
+                    if loop_watchdog.stall_count > stalls_reported:
+                        stalls_reported = loop_watchdog.stall_count
+                        worst = loop_watchdog.snapshot(top=1)
+                        location = worst["top_offenders"][0]["location"] if worst["top_offenders"] else None
+                        logger.warning(f"Мониторинг: блокировок цикла событий {stalls_reported}, p99 задержки {worst['lag_ms']['p99']} мс, чаще всего: {location}")
+                    if active_requests > 10:
+                        logger.warning(f"Большое количество активных запросов: {active_requests}. Отмена...")
+                        await cancel_active_requests()
+                except Exception as e:
+                    logger.error(f"Ошибка в мониторинге активных запросов: {e}")
+        
+        # Запускаем мониторинг в отдельной задаче
+        asyncio.create_task(monitor_active_requests())
+        
+        def log_startup_ready():
+            # Вызывается один раз, когда бот начинает получать обновления
+            if startup_timings["ready_ms"] is None:
+                startup_timings["ready_ms"] = _since_start_ms()
+                phases = ", ".join(f"{phase} {ms} мс" for phase, ms in startup_timings["phases"].items())
+                logger.info(f"Бот готов к обновлениям через {startup_timings['ready_ms']} мс после запуска ({phases})")
+        
+        if WORKER_INDEX is not None:
+            # Обновления приходят от фронта в /update; работаем до SIGTERM или до завершения фронта
+            parent_pid = os.getppid()
+            worker_state["polling"] = True
+            log_startup_ready()
+            logger.info(f"Воркер {WORKER_INDEX} принимает обновления на порту {PORT}")
+            while not worker_state["draining"]:
+                await asyncio.sleep(0.5)
+                if os.getppid() != parent_pid:
+                    logger.warning("Фронт завершился, воркер останавливается")
+                    request_drain()
+            worker_state["polling"] = False
+        
+        offset_task = None
+        if prepare_task is not None:
+            await prepare_task
+            mark_startup("telegram")
+            # Сообщения, отправленные во время перезапуска, не теряются
+            if not worker_state["draining"]:
+                await drain_backlog()
+                mark_startup("backlog")
+                offset_task = asyncio.create_task(update_offset.autosave())
+        
+        # Момент готовности - начало polling: после on_startup aiogram сразу запрашивает обновления
+        @dp.startup()
+        async def on_polling_startup():
+            log_startup_ready()
+        
         try:
             # Запускаем с автоматическим перезапуском при ошибках сети
-            while True:
+            while not worker_state["draining"]:
                 try:
-                    # Проверяем еще раз, что webhook точно удален
-                    webhook_info = await bot.get_webhook_info()
-                    if webhook_info.url:
-                        logger.error(f"Webhook всё ещё активен перед запуском polling: {webhook_info.url}")
-                        logger.info("Еще одна попытка удаления webhook...")
-                        await bot.delete_webhook(drop_pending_updates=True)
-                        
-                        # Если и это не помогло - используем прямой HTTP запрос
-                        webhook_info = await bot.get_webhook_info()
-                        if webhook_info.url:
-                            delete_url = f"https://api.telegram.org/bot{BOT_TOKEN}/deleteWebhook?drop_pending_updates=true"
-                            async with aiohttp.ClientSession() as session:
-                                async with session.get(delete_url) as response:
-                                    response_json = await response.json()
-                                    logger.info(f"Результат принудительного удаления webhook: {response_json}")
-                    
                     logger.info("Запуск polling...")
-                    # Мониторинг активных запросов каждые 5 минут
-                    async def monitor_active_requests():
-                        while True:
-                            try:
-                                await asyncio.sleep(300)  # Проверка каждые 5 минут
-                                active_requests = len(llm_client.active_requests) if hasattr(llm_client, 'active_requests') else 0
-                                logger.info(f"Мониторинг: {active_requests} активных API запросов")
-                                if active_requests > 10:
-                                    logger.warning(f"Большое количество активных запросов: {active_requests}. Отмена...")
-                                    await cancel_active_requests()
-                            except Exception as e:
-                                logger.error(f"Ошибка в мониторинге активных запросов: {e}")
-                    
-                    # Запускаем мониторинг в отдельной задаче
-                    asyncio.create_task(monitor_active_requests())
-                    
-                    # Запускаем polling
-                    await dp.start_polling(bot)
+                    # Запускаем polling; сигналы и закрытие сессии обрабатывает drain_and_stop
+                    worker_state["polling"] = True
+                    await dp.start_polling(bot, handle_signals=False, close_bot_session=False)
                 except (aiohttp.ClientError, asyncio.TimeoutError) as e:
                     logger.error(f"Сетевая ошибка при polling: {e}, перезапуск через 5 секунд...")
                     await asyncio.sleep(5)
@@ -832,10 +1141,26 @@ if __name__ == "__main__":
                     import traceback
                     logger.error(traceback.format_exc())
                     break  # Выходим из цикла при критических ошибках
+                finally:
+                    worker_state["polling"] = False
         except Exception as e:
             logger.error(f"Ошибка при запуске polling: {e}")
             import traceback
             logger.error(traceback.format_exc())
+        
+        # Дожидаемся плавной остановки и освобождаем ресурсы
+        if drain_task is not None:
+            await drain_task
+        await runner.cleanup()
+        await bot.session.close()
+        if offset_task is not None:
+            offset_task.cancel()
+        if update_offset is not None:
+            update_offset.save()
+        if stats_writer is not None:
+            stats_task.cancel()
+            stats_writer.close()
+        logger.info("Бот остановлен")
     
     # Запускаем все в одном цикле
     asyncio.run(run_all()) 
\ No newline at end of file
@@ -2,8 +2,6 @@ import os
 import logging
 from dotenv import load_dotenv, find_dotenv
 
-# Настройка логирования
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # Пытаемся найти .env файл
@@ -38,6 +36,9 @@ OPENROUTER_API_URLS = [
     "https://openrouter.ai/api/chat/completions",
     "https://api.openai.com/v1/chat/completions",  # Последняя надежда - обычное API OpenAI
 ]
+# Список URL можно переопределить через окружение (через запятую), например для локальной заглушки API
+if os.getenv("OPENROUTER_API_URLS"):
+    OPENROUTER_API_URLS = [url.strip() for url in os.getenv("OPENROUTER_API_URLS").split(",") if url.strip()]
 logger.info(f"Основной URL API: {OPENROUTER_API_URLS[0]}")
 
 # Заголовки для OpenRouter API
@@ -63,4 +64,14 @@ logger.info(f"Доступно {len(ALTERNATIVE_MODELS)} альтернатив
 # Настройки отладки и безопасности
 DEBUG_MODE = True  # Режим отладки для дополнительной информации
 DISABLE_SSL_VERIFY = True  # Отключение проверки SSL сертификатов
-logger.info(f"Режим отладки: {DEBUG_MODE}, Проверка SSL: {not DISABLE_SSL_VERIFY}") 
\ No newline at end of file
+logger.info(f"Режим отладки: {DEBUG_MODE}, Проверка SSL: {not DISABLE_SSL_VERIFY}") 
+
+# Инкрементальное редактирование постов (патчи по абзацам вместо полной перегенерации)
+INCREMENTAL_EDIT_MODE = os.getenv("INCREMENTAL_EDIT_MODE", "1") == "1"
+logger.info(f"Инкрементальное редактирование: {INCREMENTAL_EDIT_MODE}")
+
+# Количество правок, которые хранятся в истории редактирования дословно (старые сворачиваются)
+EDIT_HISTORY_MAX_TURNS = int(os.getenv("EDIT_HISTORY_MAX_TURNS", "4"))
+
+# Через сколько секунд показывать локальный черновик, если нейросеть ещё генерирует пост (0 - не показывать)
+FIRST_DRAFT_DELAY = float(os.getenv("FIRST_DRAFT_DELAY", "0"))
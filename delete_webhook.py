@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 """
-Скрипт для принудительного удаления webhook у бота.
-Запустите его один раз перед запуском основного бота.
+Скрипт для принудительного удаления webhook у бота вручную.
+При запуске бот сам проверяет webhook и удаляет его, запускать скрипт перед ботом не нужно.
 """
 
 import requests
@@ -9,6 +9,8 @@ import os
 import sys
 from dotenv import load_dotenv
 
+from telegram_transport import api_method_url
+
 # Загружаем переменные окружения из .env файла
 load_dotenv()
 
@@ -23,10 +25,10 @@ if not BOT_TOKEN:
     sys.exit(1)
 
 # URL для удаления webhook
-delete_webhook_url = f"https://api.telegram.org/bot{BOT_TOKEN}/deleteWebhook?drop_pending_updates=true"
+delete_webhook_url = api_method_url(BOT_TOKEN, "deleteWebhook")
 
 # URL для получения информации о webhook
-get_webhook_info_url = f"https://api.telegram.org/bot{BOT_TOKEN}/getWebhookInfo"
+get_webhook_info_url = api_method_url(BOT_TOKEN, "getWebhookInfo")
 
 # Запрашиваем информацию о текущем webhook
 print("Получаю информацию о текущем webhook...")
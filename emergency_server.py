@@ -5,84 +5,99 @@
 """
 import sys
 import logging
-from http.server import HTTPServer, BaseHTTPRequestHandler
-import json
 import os
 import time
 import signal
+from urllib.parse import urlparse, parse_qs
 
 logging.basicConfig(level=logging.INFO, 
                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger("emergency_server")
 
+from alerts import alert_dispatcher
+from http_utils import ThreadedHTTPServer, KeepAliveHandler, PrecomputedResponse
+
 # Импортируем мониторинг ресурсов, если доступен
 try:
-    from resource_monitor import monitor
+    from resource_monitor import monitor, add_monitor_routes
     MONITOR_AVAILABLE = True
     logger.info("Мониторинг ресурсов успешно импортирован")
 except ImportError:
     MONITOR_AVAILABLE = False
     logger.warning("Мониторинг ресурсов недоступен")
 
+# Локальный генератор черновиков работает без API и без основного бота
+try:
+    from fallback_generator import fallback_generator
+    GENERATOR_AVAILABLE = True
+except ImportError:
+    GENERATOR_AVAILABLE = False
+    logger.warning("Генератор черновиков недоступен")
+
 # Порт для сервера
 PORT = int(os.environ.get("PORT", 8080))
 
-class EmergencyHandler(BaseHTTPRequestHandler):
-    """Простой обработчик HTTP-запросов для аварийного режима"""
+def build_health():
+    """Ответ health-эндпоинта; собирается в фоне, а не на каждый запрос"""
+    response_data = {
+        "status": "error",
+        "mode": "emergency",
+        "timestamp": int(time.time()),
+        "message": "Бот находится в аварийном режиме. Пожалуйста, проверьте логи."
+    }
     
-    def log_message(self, format, *args):
-        """Переопределяем логирование запросов"""
-        logger.info(f"{self.address_string()} - {format % args}")
+    # Добавляем информацию о системе из последней проверки монитора, без ожидания
+    if MONITOR_AVAILABLE and monitor.is_running:
+        response_data["system"] = monitor.last_sample()
+    else:
+        try:
+            import psutil
+            memory = psutil.virtual_memory()
+            response_data["system"] = {
+                "cpu_percent": psutil.cpu_percent(interval=None),
+                "memory_percent": memory.percent,
+                "memory_available_mb": round(memory.available / (1024 * 1024), 2)
+            }
+        except ImportError:
+            pass
+    return response_data
+
+HEALTH_RESPONSE = PrecomputedResponse(build_health)
+
+class EmergencyHandler(KeepAliveHandler):
+    """Простой обработчик HTTP-запросов для аварийного режима"""
     
     def do_GET(self):
         """Обработка GET-запросов"""
-        # Если запрос к мониторингу и мониторинг доступен
-        if self.path == "/monitor" and MONITOR_AVAILABLE:
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            self.wfile.write(monitor.get_status().encode())
+        # Черновик поста по теме: /draft?topic=...&size=small|medium|large
+        parsed_url = urlparse(self.path)
+        if parsed_url.path == "/draft" and GENERATOR_AVAILABLE:
+            params = parse_qs(parsed_url.query)
+            topic = params.get("topic", [""])[0]
+            size = params.get("size", ["medium"])[0]
+            started = time.perf_counter()
+            draft = fallback_generator.generate(topic, size)
+            self.send_json({
+                "status": "ok",
+                "mode": "emergency",
+                "topic": topic,
+                "size": size,
+                "text": draft,
+                "generation_ms": round((time.perf_counter() - started) * 1000, 3)
+            })
             return
-            
-        # Отвечаем на запрос к корневому пути
+        
+        # Отвечаем на запрос к корневому пути готовым ответом
         if self.path == "/" or self.path == "/health":
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            
-            # Формируем ответ в зависимости от пути
-            response_data = {
-                "status": "error",
-                "mode": "emergency",
-                "timestamp": int(time.time()),
-                "message": "Бот находится в аварийном режиме. Пожалуйста, проверьте логи."
-            }
-            
-            # Добавляем информацию о системе, если возможно
-            try:
-                import psutil
-                response_data["system"] = {
-                    "cpu_percent": psutil.cpu_percent(interval=0.5),
-                    "memory_percent": psutil.virtual_memory().percent,
-                    "memory_available_mb": round(psutil.virtual_memory().available / (1024 * 1024), 2)
-                }
-            except ImportError:
-                pass
-            
-            # Если запрос к /reset, добавляем информацию о сбросе
-            if self.path == "/reset":
-                response_data["message"] = "Команда сброса получена, но бот в аварийном режиме."
-                logger.info("Получена команда сброса в аварийном режиме")
-            
-            # Отправляем JSON-ответ
-            self.wfile.write(json.dumps(response_data).encode())
+            self.send_body(HEALTH_RESPONSE.get())
+        elif self.path == "/reset":
+            logger.info("Получена команда сброса в аварийном режиме")
+            response_data = build_health()
+            response_data["message"] = "Команда сброса получена, но бот в аварийном режиме."
+            self.send_json(response_data)
         else:
             # Для всех других путей отправляем 404
-            self.send_response(404)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            response = {"status": "error", "message": f"Путь {self.path} не найден"}
-            self.wfile.write(json.dumps(response).encode())
+            self.send_json({"status": "error", "message": f"Путь {self.path} не найден"}, status=404)
 
 def run_emergency_server(port=PORT):
     """Запускает аварийный HTTP-сервер"""
@@ -108,32 +123,24 @@ def run_emergency_server(port=PORT):
             
             # Отправляем уведомление о переходе в аварийный режим
             if admin_chat_id:
-                try:
-                    import asyncio
-                    from telegram import Bot
-                    from config import BOT_TOKEN
-                    
-                    async def send_emergency_notification():
-                        bot = Bot(token=BOT_TOKEN)
-                        message = "🚨 ВНИМАНИЕ! Бот перешел в аварийный режим!\n"
-                        message += f"Время: {time.strftime('%Y-%m-%d %H:%M:%S')}\n"
-                        message += "Проверьте логи и перезапустите приложение."
-                        await bot.send_message(chat_id=admin_chat_id, text=message)
-                    
-                    loop = asyncio.new_event_loop()
-                    asyncio.set_event_loop(loop)
-                    loop.run_until_complete(send_emergency_notification())
-                    loop.close()
-                except Exception as e:
-                    logger.error(f"Не удалось отправить уведомление об аварийном режиме: {e}")
+                message = "🚨 ВНИМАНИЕ! Бот перешел в аварийный режим!\n"
+                message += f"Время: {time.strftime('%Y-%m-%d %H:%M:%S')}\n"
+                message += "Проверьте логи и перезапустите приложение."
+                alert_dispatcher.send(message, severity="critical", key="emergency", chat_id=admin_chat_id)
         
-        server = HTTPServer(('0.0.0.0', port), EmergencyHandler)
+        # /monitor и /monitor?since=... обслуживает монитор ресурсов
+        handler_class = add_monitor_routes(EmergencyHandler) if MONITOR_AVAILABLE else EmergencyHandler
+        # Поток на соединение: медленный клиент не задерживает проверку здоровья
+        server = ThreadedHTTPServer(('0.0.0.0', port), handler_class)
+        HEALTH_RESPONSE.start()
         logger.info(f"Аварийный HTTP-сервер запущен на порту {port}")
         
         # Регистрируем обработчик сигналов для корректного завершения
         def signal_handler(sig, frame):
             logger.info(f"Получен сигнал {sig}, завершаем работу")
             server.server_close()
+            # Дожидаемся отправки уведомлений, уже стоящих в очереди
+            alert_dispatcher.flush(timeout=5)
             sys.exit(0)
         
         signal.signal(signal.SIGINT, signal_handler)
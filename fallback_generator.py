@@ -0,0 +1,435 @@
+"""
+Локальный генератор черновиков постов без обращения к LLM.
+Используется, когда все эндпоинты API недоступны, в аварийном режиме
+и для быстрого первого черновика, пока нейросеть генерирует пост.
+
+Черновик собирается по шаблону: вступление с темой, предложения из архива
+прошлых удачных постов на похожую тему (или из набора фраз направления),
+ссылка из датасета, призыв к действию и хэштеги.
+"""
+import os
+import re
+import json
+import time
+import random
+import hashlib
+import logging
+import threading
+from collections import OrderedDict, deque
+
+from rddm_info import RDDM_DATASET, RDDM_INFO
+
+logger = logging.getLogger(__name__)
+
+MAIN_HASHTAG = "#ДвижениеПервых59"
+
+# Диапазоны размеров поста (символы), совпадают с PostSize
+SIZE_RANGES = {
+    "small": (200, 400),
+    "medium": (400, 800),
+    "large": (800, 1200),
+}
+
+# Направления: основы ключевых слов -> хэштег и фразы для тела поста
+DIRECTIONS = [
+    {
+        "stems": ["экол", "природ", "убор", "субботн", "мусор", "парк", "дерев", "посад"],
+        "hashtag": "#ЭкологияПервых",
+        "phrases": [
+            "Забота о природе начинается с малого — с бережного отношения к тому, что нас окружает.",
+            "Ребята показали, что сделать город чище и зеленее может каждый.",
+            "Вместе мы доказали, что экология — это не громкие слова, а конкретные дела.",
+        ],
+    },
+    {
+        "stems": ["спорт", "зож", "трениров", "зарядк", "турнир", "соревнов", "футбол", "забег", "гто"],
+        "hashtag": "#СпортЗОЖПервых",
+        "phrases": [
+            "Активный образ жизни — отличный заряд энергии на весь день!",
+            "Участники проверили свои силы, поддержали друг друга и поставили новые личные рекорды.",
+            "Спорт объединяет: здесь каждый нашёл команду и единомышленников.",
+        ],
+    },
+    {
+        "stems": ["наук", "технолог", "робот", "исследов", "лаборатор", "инновац", "ферм", "коров", "экскурс"],
+        "hashtag": "#НаукаПервых",
+        "phrases": [
+            "Ребята познакомились с современными технологиями и узнали, как наука меняет привычные вещи.",
+            "Такие встречи расширяют кругозор и помогают найти дело по душе.",
+            "Участники задавали вопросы экспертам и сами попробовали себя в роли исследователей.",
+        ],
+    },
+    {
+        "stems": ["професс", "карьер", "работ", "профориент", "предприят"],
+        "hashtag": "#ПрофессияПервых",
+        "phrases": [
+            "Ребята узнали, как устроена работа настоящих профессионалов, и примерили на себя новые роли.",
+            "Выбор профессии — важный шаг, и мы помогаем сделать его осознанно.",
+        ],
+    },
+    {
+        "stems": ["путешеств", "туризм", "поход", "поездк", "маршрут"],
+        "hashtag": "#ПутешествияПервых",
+        "phrases": [
+            "Новые места, новые друзья и впечатления, которые запомнятся надолго.",
+            "Путешествия помогают лучше узнать нашу большую страну и её историю.",
+        ],
+    },
+    {
+        "stems": ["добр", "волонт", "помощ", "благотвор", "акци"],
+        "hashtag": "#ДоброПервых",
+        "phrases": [
+            "Каждое доброе дело делает мир вокруг немного лучше.",
+            "Ребята на деле показали, что помогать другим — это просто и важно.",
+        ],
+    },
+    {
+        "stems": ["патриот", "истори", "памят", "ветеран", "побед", "героя", "герои"],
+        "hashtag": "#ПатриотыПервых",
+        "phrases": [
+            "Помнить историю своей страны — значит ценить настоящее и строить будущее.",
+            "Ребята с гордостью рассказали о подвигах своих земляков.",
+        ],
+    },
+    {
+        "stems": ["творч", "музык", "театр", "концерт", "рисун", "искусств", "фестивал"],
+        "hashtag": "#ТворчествоПервых",
+        "phrases": [
+            "Творчество помогает раскрыть таланты и найти свой голос.",
+            "Участники подготовили яркие номера и подарили зрителям отличное настроение.",
+        ],
+    },
+    {
+        "stems": ["дипломат", "международ", "переговор"],
+        "hashtag": "#ДипломатыПервых",
+        "phrases": [
+            "Ребята учились вести диалог, слышать друг друга и отстаивать свою позицию.",
+        ],
+    },
+    {
+        "stems": ["квн", "юмор", "шутк"],
+        "hashtag": "#КВНПервые",
+        "phrases": [
+            "Смех, импровизация и командный дух — всё, за что мы любим КВН!",
+        ],
+    },
+    {
+        "stems": ["грант", "конкурс", "проект"],
+        "hashtag": "#грантыПервых",
+        "phrases": [
+            "Каждая идея может стать проектом, а проект — получить поддержку.",
+        ],
+    },
+]
+
+# Программы из раздела HASHTAGS датасета: основы ключевых слов -> название программы
+PROGRAM_STEMS = {
+    "Мы - граждане России": ["паспорт", "граждан"],
+    "Хранители истории": ["хранител", "музе"],
+    "Классные встречи": ["классные встреч", "классных встреч"],
+    "Первая помощь": ["первая помощь", "первой помощи", "медицин"],
+    "Зарница": ["зарниц"],
+}
+
+OPENINGS = [
+    "Друзья! Рассказываем о событии: {topic}.",
+    "{Topic} — ещё одна яркая страница в истории «Движения Первых»!",
+    "Новости «Движения Первых»: {topic}.",
+]
+
+CLOSINGS = [
+    "Присоединяйтесь к «Движению Первых» — вместе мы сделаем больше!",
+    "Следите за обновлениями группы, чтобы не пропустить новые события и возможности для саморазвития!",
+]
+
+# Архивные посты, с которых начинается работа генератора
+SEED_POSTS = [
+    ("вручение паспортов", """Сегодня состоялось торжественное вручение паспортов юным гражданам России!
+
+В этот важный день ребята присоединились к программе «Мы – граждане России!», которая реализуется совместно с Министерством внутренних дел РФ.
+
+Получение паспорта - это первый серьёзный шаг во взрослую жизнь, новые права и обязанности. Искренне поздравляем ребят с этим значимым событием!
+
+Подробнее о программе: https://vk.com/club26323016
+
+#МыГражданеРоссии #ПатриотыПервых #ДвижениеПервых59"""),
+    ("экология уборка парка", """Друзья! Движение Первых приглашает всех на экологическую акцию по уборке городского парка!
+
+Вместе мы сделаем наш город чище и покажем, что забота о природе начинается с малого - с бережного отношения к окружающей среде вокруг нас.
+
+Приходите в эту субботу в 12:00, с собой можно взять перчатки и хорошее настроение!
+
+#ЭкологияПервых #ДвижениеПервых59"""),
+    ("спорт тренировка", """Активный образ жизни - путь к успеху!
+
+Сегодня участники "Движения Первых" провели открытую тренировку на свежем воздухе. Утренняя зарядка, пробежка и спортивные игры - отличный заряд энергии на весь день!
+
+Присоединяйтесь к нашим регулярным тренировкам каждую субботу в 10:00 в городском парке.
+
+#СпортЗОЖПервых #ДвижениеПервых59"""),
+    ("экскурсия на ферму коровы", """Сегодня в рамках образовательной программы "Движения Первых" ребята посетили современную молочную ферму и узнали о новейших технологиях в сельском хозяйстве!
+
+Самое яркое впечатление произвели автоматические доильные аппараты, где коровы самостоятельно заходят в доильные боксы, когда чувствуют необходимость. Датчики и роботизированная система делают процесс доения комфортным как для животных, так и для фермеров.
+
+Такие экскурсии не только расширяют кругозор, но и знакомят молодежь с инновациями в традиционных отраслях.
+
+#НаукаПервых #ТехнологииБудущего #ДвижениеПервых59"""),
+]
+
+WORD_PATTERN = re.compile(r"[а-яёa-z0-9]+")
+SENTENCE_PATTERN = re.compile(r"(?<=[.!?])\s+")
+
+def topic_stems(text):
+    """Основы слов для индексации: первые 4 буквы слов длиннее 3 символов"""
+    return {word[:4] for word in WORD_PATTERN.findall(text.lower()) if len(word) > 3}
+
+def _matches(words, topic_lower, stems):
+    """Проверяет, начинается ли какое-либо слово темы с одной из основ"""
+    for stem in stems:
+        if " " in stem:
+            if stem in topic_lower:
+                return True
+        elif any(word.startswith(stem) for word in words):
+            return True
+    return False
+
+def _split_sentences(text):
+    """Предложения поста без хэштегов и ссылок"""
+    sentences = []
+    for paragraph in re.split(r"\n\s*\n", text):
+        paragraph = paragraph.strip()
+        if not paragraph or paragraph.startswith("#") or "http" in paragraph:
+            continue
+        sentences.extend(s.strip() for s in SENTENCE_PATTERN.split(paragraph) if len(s.strip()) > 20)
+    return sentences
+
+class PostArchive:
+    """Архив удачных постов с индексом по ключевым словам темы"""
+
+    def __init__(self, path=None, max_entries=2000):
+        """
+        :param path: Путь к файлу архива (JSONL, запись только в конец)
+        :param max_entries: Сколько последних постов держать в памяти
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # {id: {"topic", "text", "stems", "topic_stems"}}
+        self.index = {}  # {основа слова: set(id)}
+        self.next_id = 0
+        self.lock = threading.Lock()
+
+        for topic, text in SEED_POSTS:
+            self._add_entry(topic, text)
+        if path and os.path.exists(path):
+            self._load()
+
+    def _load(self):
+        # Файл только дописывается, а в памяти держим max_entries последних постов
+        records = deque(maxlen=self.max_entries)
+        total = 0
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                        topic, text = record["topic"], record["text"]
+                    except (json.JSONDecodeError, KeyError, TypeError):
+                        continue
+                    records.append((line if line.endswith("\n") else line + "\n", topic, text))
+                    total += 1
+        except OSError as e:
+            logger.error(f"Не удалось прочитать архив постов {self.path}: {e}")
+            return
+        for _, topic, text in records:
+            self._add_entry(topic, text)
+        logger.info(f"Загружено {len(records)} постов из архива {self.path}")
+        if total > 2 * self.max_entries:
+            self._compact([line for line, _, _ in records], total)
+
+    def _compact(self, lines, total):
+        """Переписывает файл архива, оставляя только загруженные последние посты"""
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.writelines(lines)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.error(f"Не удалось сжать архив постов {self.path}: {e}")
+            return
+        logger.info(f"Архив постов {self.path} сжат: {total} -> {len(lines)} записей")
+
+    def _add_entry(self, topic, text):
+        entry_id = self.next_id
+        self.next_id += 1
+        own_topic_stems = topic_stems(topic)
+        stems = own_topic_stems | topic_stems(text[:300])
+        self.entries[entry_id] = {"topic": topic, "text": text, "stems": stems, "topic_stems": own_topic_stems}
+        for stem in stems:
+            self.index.setdefault(stem, set()).add(entry_id)
+
+        # Вытесняем самые старые записи
+        while len(self.entries) > self.max_entries:
+            old_id, old_entry = self.entries.popitem(last=False)
+            for stem in old_entry["stems"]:
+                ids = self.index.get(stem)
+                if ids:
+                    ids.discard(old_id)
+                    if not ids:
+                        del self.index[stem]
+
+    def add(self, topic, text):
+        """Добавляет пост в архив и дописывает его в файл"""
+        if not topic or not text:
+            return
+        with self.lock:
+            self._add_entry(topic, text)
+            if self.path:
+                try:
+                    with open(self.path, "a", encoding="utf-8") as f:
+                        f.write(json.dumps({"ts": int(time.time()), "topic": topic, "text": text},
+                                           ensure_ascii=False, separators=(",", ":")) + "\n")
+                except OSError as e:
+                    logger.error(f"Не удалось записать пост в архив: {e}")
+
+    def search(self, stems, hashtags=(), limit=2, min_score=2):
+        """
+        Возвращает посты, наиболее близкие к теме.
+
+        Совпадение с темой архивного поста весит вдвое больше совпадения с его текстом,
+        посты с хэштегами подходящих направлений получают дополнительные баллы.
+        """
+        with self.lock:
+            scores = {}
+            for stem in stems:
+                for entry_id in self.index.get(stem, ()):
+                    weight = 2 if stem in self.entries[entry_id]["topic_stems"] else 1
+                    scores[entry_id] = scores.get(entry_id, 0) + weight
+            for entry_id in scores:
+                if any(tag in self.entries[entry_id]["text"] for tag in hashtags):
+                    scores[entry_id] += 2
+            best = sorted(scores.items(), key=lambda item: (item[1], item[0]), reverse=True)[:limit]
+            if not best:
+                return []
+            # Отбрасываем посты, заметно уступающие лучшему совпадению
+            threshold = max(min_score, best[0][1] - 1)
+            return [self.entries[entry_id] for entry_id, score in best if score >= threshold]
+
+class Draft(str):
+    """
+    Текст черновика локального генератора.
+
+    Черновик отличается от ответа модели типом, а не содержимым: признак не зависит
+    от перезапусков и процесса, в котором черновик создан.
+    """
+
+class FallbackGenerator:
+    """Генератор тематических черновиков по шаблону без обращения к LLM"""
+
+    def __init__(self, archive=None):
+        self.archive = archive if archive is not None else PostArchive(
+            path=os.environ.get("POST_ARCHIVE_PATH", "post_archive.jsonl")
+        )
+        # Хэши недавно сгенерированных черновиков, чтобы не путать их с ответами модели
+        self.generated = OrderedDict()
+
+    def _match_directions(self, topic_lower):
+        words = WORD_PATTERN.findall(topic_lower)
+        directions = [d for d in DIRECTIONS if _matches(words, topic_lower, d["stems"])]
+        programs = []
+        for name, program_stems in PROGRAM_STEMS.items():
+            if name.lower() in topic_lower or _matches(words, topic_lower, program_stems):
+                programs.append((name, RDDM_DATASET["HASHTAGS"][name]))
+        return directions, programs
+
+    def generate(self, topic=None, post_size="medium"):
+        """
+        Генерирует черновик поста по теме.
+
+        :param topic: Тема поста (если не указана - общий пост о движении)
+        :param post_size: Размер поста: small, medium или large
+        :return: Текст черновика
+        """
+        topic = (topic or "").strip()
+        min_size, max_size = SIZE_RANGES.get(str(getattr(post_size, "value", post_size)), SIZE_RANGES["medium"])
+        rng = random.Random(hashlib.md5(topic.encode("utf-8")).hexdigest())
+        topic_lower = topic.lower()
+        stems = topic_stems(topic)
+        directions, programs = self._match_directions(topic_lower)
+
+        paragraphs = []
+        if topic:
+            opening = rng.choice(OPENINGS)
+            paragraphs.append(opening.format(topic=topic, Topic=topic[:1].upper() + topic[1:]))
+        else:
+            paragraphs.append("Друзья! \"Движение Первых\" - это наша общая история, которую мы пишем вместе.")
+
+        # Тело поста: предложения из похожих архивных постов, затем фразы направлений
+        candidates = []
+        direction_tags = [d["hashtag"] for d in directions] + [program["hashtag"] for _, program in programs]
+        for entry in self.archive.search(stems, direction_tags) if stems else []:
+            candidates.extend(_split_sentences(entry["text"]))
+        for direction in directions:
+            candidates.extend(direction["phrases"])
+        for _, program in programs:
+            if program.get("description") and not any(program["description"][-40:] in c for c in candidates):
+                candidates.append(program["description"] + ".")
+        if not candidates:
+            candidates.append(RDDM_INFO["девиз"].strip())
+            candidates.append("Приглашаем вас принять участие в наших мероприятиях, раскрыть свои таланты и найти единомышленников.")
+
+        links = [program["link"] for _, program in programs if program.get("link")]
+        hashtags = list(dict.fromkeys(direction_tags + [MAIN_HASHTAG]))
+        tail = [rng.choice(CLOSINGS)]
+        tail += [f"Подробнее: {link}" for link in links]
+        tail.append(" ".join(hashtags))
+
+        # Набираем предложения, пока пост укладывается в ограничение по размеру
+        fixed_length = sum(len(p) + 2 for p in paragraphs + tail)
+        body = []
+        body_length = 0
+        for sentence in dict.fromkeys(candidates):
+            if fixed_length + body_length + len(sentence) + 1 > max_size:
+                continue
+            body.append(sentence)
+            body_length += len(sentence) + 1
+            if fixed_length + body_length >= (min_size + max_size) // 2:
+                break
+
+        # Делим тело на абзацы по два предложения
+        for i in range(0, len(body), 2):
+            paragraphs.append(" ".join(body[i:i + 2]))
+
+        draft = Draft("\n\n".join(paragraphs + tail))
+        self._remember(draft)
+        return draft
+
+    def _remember(self, text):
+        self.generated[hashlib.md5(text.encode("utf-8")).hexdigest()] = True
+        while len(self.generated) > 500:
+            self.generated.popitem(last=False)
+
+    def is_generated(self, text):
+        """Проверяет, что текст - черновик этого генератора, а не ответ модели"""
+        if isinstance(text, Draft):
+            return True
+        return bool(text) and hashlib.md5(text.encode("utf-8")).hexdigest() in self.generated
+
+    def remember_post(self, topic, text, from_model):
+        """
+        Сохраняет удачный пост от модели в архив для будущих черновиков.
+
+        :param from_model: Текст - ответ модели, а не черновик или сообщение об ошибке;
+                           иначе архив пополнялся бы собственными черновиками
+        """
+        if from_model and text and not self.is_generated(text):
+            self.archive.add(topic, text)
+
+# Глобальный экземпляр генератора
+fallback_generator = FallbackGenerator()
+
+if __name__ == "__main__":
+    import sys
+
+    started = time.perf_counter()
+    print(fallback_generator.generate(" ".join(sys.argv[1:]) or None, "medium"))
+    print(f"\n({(time.perf_counter() - started) * 1000:.2f} мс)")
@@ -0,0 +1,90 @@
+"""
+Общие части HTTP-серверов simple_server и emergency_server.
+
+Каждое соединение обслуживается в своём потоке, поэтому медленный клиент или долгий
+запрос не задерживает проверку здоровья платформы. Соединения остаются открытыми
+между запросами (HTTP/1.1 keep-alive), а простаивающие и медленные клиенты
+отключаются по таймауту. Ответ health-эндпоинта собирается заранее в фоновом потоке,
+обработчик только отправляет готовые байты.
+"""
+import os
+import json
+import time
+import logging
+import threading
+import http.server
+
+logger = logging.getLogger("http_utils")
+
+# Сколько секунд ждать данных от клиента, прежде чем закрыть соединение
+HTTP_TIMEOUT = float(os.environ.get("HTTP_TIMEOUT", 15))
+
+class ThreadedHTTPServer(http.server.ThreadingHTTPServer):
+    """HTTP-сервер с потоком на соединение"""
+
+    allow_reuse_address = True
+    daemon_threads = True
+    # Очередь соединений на случай всплеска опросов
+    request_queue_size = 128
+
+class KeepAliveHandler(http.server.BaseHTTPRequestHandler):
+    """Обработчик с keep-alive: каждый ответ обязан содержать Content-Length"""
+
+    protocol_version = "HTTP/1.1"
+    timeout = HTTP_TIMEOUT
+    # Заголовки и тело уходят отдельными записями; без TCP_NODELAY ответ ждёт подтверждения клиента
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        """Запросы пишутся только в отладочный лог: опросы здоровья идут постоянно"""
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+    def send_body(self, body, status=200, content_type="application/json"):
+        """Отправляет готовое тело ответа"""
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, data, status=200, indent=None):
+        """Сериализует и отправляет JSON"""
+        self.send_body(json.dumps(data, ensure_ascii=False, indent=indent).encode("utf-8"), status,
+                       "application/json; charset=utf-8")
+
+class PrecomputedResponse:
+    """Тело ответа, которое пересобирается в фоне не чаще раза в interval секунд"""
+
+    def __init__(self, builder, interval=1.0):
+        """
+        :param builder: Функция без аргументов, возвращающая данные для JSON
+        :param interval: Период пересборки, секунды
+        """
+        self.builder = builder
+        self.interval = interval
+        self.body = None
+        self.thread = None
+
+    def refresh(self):
+        self.body = json.dumps(self.builder(), ensure_ascii=False).encode("utf-8")
+        return self.body
+
+    def start(self):
+        if self.thread is None:
+            self.refresh()
+            self.thread = threading.Thread(target=self._run, name="health-response", daemon=True)
+            self.thread.start()
+        return self
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.error(f"Ошибка при подготовке ответа health-эндпоинта: {e}")
+
+    def get(self):
+        """Готовое тело ответа; до первого запуска собирается на месте"""
+        body = self.body
+        return body if body is not None else self.refresh()
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+"""
+Запись и воспроизведение запросов к LLM ("кассета").
+
+В режиме записи каждый ответ модели вместе с ключом запроса, длительностью и
+попытками по URL дописывается в компактный JSONL-файл. Сам запрос (промпт пользователя
+с датасетом и история правок) не хранится: ключ - это хэш промптов, истории и max_tokens.
+Системные промпты хранятся один раз (по хэшу), чтобы по записи было видно тип запроса.
+Запросы, на которые модель не ответила (черновик локального генератора), не записываются:
+при воспроизведении такой черновик выдавался бы за ответ модели.
+В режиме воспроизведения ответы выдаются из файла детерминированно, с исходными
+задержками (их можно ускорить), что позволяет гонять bot.py офлайн.
+
+Проверка форматтеров и _enforce_size_limits на записанных ответах:
+
+    python llm_cassette.py stats llm_cassette.jsonl
+    python llm_cassette.py check llm_cassette.jsonl
+"""
+import os
+import re
+import sys
+import json
+import time
+import asyncio
+import hashlib
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+class Cassette:
+    """Журнал запросов к LLM с записью в конец файла и детерминированным воспроизведением"""
+
+    def __init__(self, path, mode="record", speed=1.0, miss="fallback"):
+        """
+        :param path: Путь к файлу кассеты (JSONL)
+        :param mode: record - записывать, replay - воспроизводить
+        :param speed: Множитель задержек при воспроизведении (0 - без задержек)
+        :param miss: Что делать при отсутствии записи: fallback - локальный черновик, network - реальный запрос
+        """
+        self.path = path
+        self.mode = mode
+        self.speed = speed
+        self.miss = miss
+        self.lock = threading.Lock()
+        self.known_prompts = set()  # Хэши системных промптов, уже записанных в файл
+        self.records = {}  # {ключ: [записи]} для воспроизведения
+        self.positions = {}  # {ключ: номер следующей записи}
+        self.prompts = {}  # {хэш: текст системного промпта}
+        self.skipped = 0  # Записи без ответа модели, которые не воспроизводятся
+
+        if os.path.exists(path):
+            self._load()
+        logger.info(f"Кассета LLM: режим {mode}, файл {path}, записей {sum(len(v) for v in self.records.values())}")
+
+    @property
+    def recording(self):
+        return self.mode == "record"
+
+    @property
+    def replaying(self):
+        return self.mode == "replay"
+
+    @staticmethod
+    def _hash(text):
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()[:16]
+
+    @classmethod
+    def key(cls, system_prompt, history, user_prompt, max_tokens):
+        """Ключ запроса: не зависит от модели и URL, на которых он в итоге выполнился"""
+        payload = json.dumps([system_prompt, history or [], user_prompt, max_tokens],
+                             ensure_ascii=False, separators=(",", ":"))
+        return cls._hash(payload)
+
+    def _load(self):
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if record.get("type") == "prompt":
+                    self.prompts[record["h"]] = record["text"]
+                    self.known_prompts.add(record["h"])
+                elif record.get("type") == "call":
+                    if not any(attempt.get("status") == 200 for attempt in record.get("a", [])):
+                        # Старые кассеты могли записать черновик локального генератора вместо ответа
+                        self.skipped += 1
+                        continue
+                    self.records.setdefault(record["k"], []).append(record)
+
+    def _append(self, lines):
+        with self.lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                for line in lines:
+                    f.write(json.dumps(line, ensure_ascii=False, separators=(",", ":")) + "\n")
+
+    def record(self, key, system_prompt, max_tokens, content, elapsed, attempts):
+        """Дописывает ответ модели на запрос с ключом key в кассету"""
+        prompt_hash = self._hash(system_prompt)
+        lines = []
+        if prompt_hash not in self.known_prompts:
+            self.known_prompts.add(prompt_hash)
+            lines.append({"type": "prompt", "h": prompt_hash, "text": system_prompt})
+        lines.append({
+            "type": "call",
+            "k": key,
+            "t": round(time.time(), 3),
+            "ms": round(elapsed * 1000, 1),
+            "sp": prompt_hash,
+            "mt": max_tokens,
+            "a": attempts,
+            "r": content
+        })
+        try:
+            self._append(lines)
+        except OSError as e:
+            logger.error(f"Не удалось записать запрос в кассету: {e}")
+
+    async def replay(self, key):
+        """
+        Возвращает записанный ответ на запрос или None, если записи нет.
+
+        Повторные одинаковые запросы получают записи по очереди, по кругу.
+        """
+        records = self.records.get(key)
+        if not records:
+            logger.warning(f"Кассета: нет записи для запроса {key}")
+            return None
+        position = self.positions.get(key, 0)
+        self.positions[key] = position + 1
+        record = records[position % len(records)]
+        if self.speed:
+            await asyncio.sleep(record["ms"] / 1000 * self.speed)
+        return record["r"]
+
+    def calls(self):
+        """Все записанные вызовы в порядке записи по ключам"""
+        for records in self.records.values():
+            yield from records
+
+_cassette = None
+
+def get_cassette():
+    """Кассета из настроек окружения (LLM_CASSETTE_MODE=record|replay) или None"""
+    global _cassette
+    mode = os.getenv("LLM_CASSETTE_MODE", "off")
+    if mode not in ("record", "replay"):
+        return None
+    if _cassette is None:
+        _cassette = Cassette(
+            os.getenv("LLM_CASSETTE_PATH", "llm_cassette.jsonl"),
+            mode=mode,
+            speed=float(os.getenv("LLM_CASSETTE_SPEED", "1.0")),
+            miss=os.getenv("LLM_CASSETTE_MISS", "fallback")
+        )
+    return _cassette
+
+def _html_balanced(html_text):
+    """Проверяет, что HTML-теги Telegram закрыты в правильном порядке"""
+    stack = []
+    for closing, tag in re.findall(r"<(/?)([a-z-]+)[^>]*>", html_text):
+        if not closing:
+            stack.append(tag)
+        elif not stack or stack.pop() != tag:
+            return False
+    return not stack
+
+def check_cassette(path):
+    """
+    Прогоняет форматтеры и _enforce_size_limits по всем записанным ответам.
+
+    :return: Количество найденных проблем
+    """
+    from text_formatting import format_to_html, format_message_text, escape_markdown
+    from llm_client import LLMClient
+
+    logging.disable(logging.WARNING)
+    client = LLMClient()
+    cassette = Cassette(path, mode="replay", speed=0)
+    sizes = [(200, 400), (400, 800), (800, 1200)]
+    problems = 0
+    checked = 0
+    started = time.perf_counter()
+
+    for record in cassette.calls():
+        text = record["r"]
+        checked += 1
+        try:
+            html_text = format_to_html(text)
+            format_message_text(text)
+            escape_markdown(text)
+            if not _html_balanced(html_text):
+                problems += 1
+                print(f"[{record['k']}] несбалансированные HTML-теги после format_to_html")
+            for min_size, max_size in sizes:
+                limited = client._enforce_size_limits(text, min_size, max_size)
+                if len(text) > max_size:
+                    if len(limited) > max_size + len("\n\n#ДвижениеПервых59"):
+                        problems += 1
+                        print(f"[{record['k']}] _enforce_size_limits({min_size}, {max_size}) вернул {len(limited)} символов")
+                    if "#ДвижениеПервых59" not in limited:
+                        problems += 1
+                        print(f"[{record['k']}] после обрезки потерян #ДвижениеПервых59")
+                    original_urls = set(re.findall(r"https?://\S+", text))
+                    if any(url not in original_urls for url in re.findall(r"https?://\S+", limited)):
+                        problems += 1
+                        print(f"[{record['k']}] после обрезки осталась неполная ссылка")
+        except Exception as e:
+            problems += 1
+            print(f"[{record['k']}] исключение: {e}")
+
+    elapsed = time.perf_counter() - started
+    print(f"Проверено ответов: {checked}, проблем: {problems}, время: {elapsed:.2f} с")
+    return problems
+
+def print_stats(path):
+    """Краткая статистика по кассете"""
+    cassette = Cassette(path, mode="replay", speed=0)
+    calls = list(cassette.calls())
+    latencies = sorted(call["ms"] for call in calls)
+    print(f"Записей: {len(calls)}, уникальных запросов: {len(cassette.records)}, системных промптов: {len(cassette.prompts)}")
+    if latencies:
+        for p in (50, 90, 99):
+            print(f"p{p}: {latencies[min(len(latencies) - 1, len(latencies) * p // 100)]:.0f} мс")
+    if cassette.skipped:
+        print(f"Записей с локальным черновиком вместо ответа модели (не воспроизводятся): {cassette.skipped}")
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3 or sys.argv[1] not in ("stats", "check"):
+        print("Использование: python llm_cassette.py stats|check <файл кассеты>")
+        sys.exit(1)
+    if sys.argv[1] == "stats":
+        print_stats(sys.argv[2])
+    else:
+        sys.exit(1 if check_cassette(sys.argv[2]) else 0)
@@ -1,55 +1,53 @@
-import requests
 import asyncio
 import json
 import aiohttp
 import time
 from config import (
     OPENROUTER_API_URLS, OPENROUTER_API_KEY, OPENROUTER_MODEL, 
-    OPENROUTER_HEADERS, DEBUG_MODE, DISABLE_SSL_VERIFY, ALTERNATIVE_MODELS
+    OPENROUTER_HEADERS, DEBUG_MODE, DISABLE_SSL_VERIFY, ALTERNATIVE_MODELS,
+    INCREMENTAL_EDIT_MODE, EDIT_HISTORY_MAX_TURNS
 )
 import logging
-from rddm_info import get_rddm_knowledge
+from rddm_info import get_rddm_knowledge, RDDM_DATASET
 from session_manager import PostSize
+from post_editor import try_mechanical_edit, number_paragraphs, EditSession
+from fallback_generator import fallback_generator
+from llm_cassette import Cassette, get_cassette
+from metrics import (LLM_REQUEST_DURATION, LLM_QUEUE_DEPTH, LLM_IN_FLIGHT, LLM_FALLBACKS,
+                     LLM_PROMPT_TOKENS, LLM_CACHED_TOKENS, LLM_LOCAL_EDITS)
+from tracing import span
+from shared_limiter import SharedRateLimiter, SharedSemaphore, shared_limits_path
+from admission import AdmissionController
 
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Новый датасет
-RDDM_DATASET = {
-    "F&Q": [
-        "Движение Первых. Экология, #ЭкологияПервых",
-        "Движение Первых. Профессия, #ПрофессияПервых",
-        "Движение Первых. Путешествия, #ПутешествияПервых",
-        "Движение Первых. Добро, #ДоброПервых",
-        "Движение Первых. Наука, #НаукаПервых",
-        "КВН Первые | Движение Первых, #КВНПервые",
-        "Движение Первых. Спорт и ЗОЖ, #СпортЗОЖПервых",
-        "Движение Первых. Патриоты, #ПатриотыПервых",
-        "Движение Первых. Творчество, #ТворчествоПервых",
-        "Движение Первых. Дипломаты, #ДипломатыПервых",
-        "Гранты | Движение Первых, #грантыПервых"
-    ],
-    "HASHTAGS": {
-        "Мы - граждане России": {
-            "description": "Программа «Мы – граждане России!» реализуется совместно с Министерством внутренних дел РФ",
-            "link": "https://vk.com/club26323016",
-            "hashtag": "#МыГражданеРоссии"
-        },
-        "Хранители истории": {
-            "hashtag": "#ХранителиИстории"
-        },
-        "Классные встречи": {
-            "hashtag": "#КлассныеВстречи",
-            "link": "https://vk.com/klassnye_vstrechi"
-        },
-        "Первая помощь": {
-            "hashtag": "#ПервыеПомогают"
-        },
-        "Зарница": {
-            "hashtag": "#ЗарницаПервых"
-        }
-    }
-}
+# Датасет сериализуется один раз: одинаковые байты в каждом запросе нужны для кэширования промпта
+RDDM_DATASET_JSON = json.dumps(RDDM_DATASET, ensure_ascii=False, indent=2)
+
+# Статический системный промпт для редактирования. Он не зависит от пользователя и поста,
+# поэтому начало каждого запроса на правку побайтно совпадает и кэшируется провайдером
+EDIT_SYSTEM_PROMPT = f"""Чат, тебе нужно отредактировать пост для группы в Вконтакте "Движение первых". Пост разбит на пронумерованные абзацы. Верни только изменения в виде JSON-патча, не переписывая пост целиком.
+
+Общая информация про "Движение первых": 
+Российское движение детей и молодёжи «Движение первых» — общероссийское общественно-государственное движение, созданное 20 июля 2022 года по инициативе руководства России, для воспитания, организации досуга подростков, и формирования мировоззрения «на основе традиционных российских духовных и нравственных ценностей».
+
+Датасет:
+{RDDM_DATASET_JSON}
+
+Формат ответа - только JSON без пояснений:
+{{"ops": [{{"op": "replace", "index": 2, "text": "новый текст абзаца"}}, {{"op": "delete", "index": 3}}, {{"op": "insert", "after": 1, "text": "новый абзац"}}]}}
+
+Критерии:
+- Номера абзацев указывай так, как они указаны в посте, "after": 0 означает вставку в начало поста
+- Пост может редактироваться несколько раз подряд: учитывай предыдущие запросы пользователя и применённые патчи, новые абзацы получают номера из поля "id" патча
+- Меняй только те абзацы, которых касается запрос, остальные не упоминай
+- Не делай слишком формальный текст, но и не уходи в свободу мыслей. Движение - государственная сущность, твоя целевая аудитория - люди 14-35 лет
+- Если добавляешь информацию из датасета, то ссылки указывай полностью
+- Не удаляй хэштег #ДвижениеПервых59"""
+
+def estimate_tokens(text):
+    """Грубая оценка числа токенов (для русского текста ~3 символа на токен)"""
+    return max(1, len(text) // 3) if text else 0
 
 class RateLimiter:
     """Класс для ограничения частоты запросов к API"""
@@ -86,16 +84,27 @@ class LLMClient:
         self.debug = debug
         self.disable_ssl = True  # Всегда отключаем SSL-проверку
         
+        # Лимиты провайдера общие для всех процессов бота с этим ключом (воркеры, случайный второй bot.py)
+        limits_path = shared_limits_path(api_key)
+        
         # Семафор для ограничения одновременных запросов
-        self.request_semaphore = asyncio.Semaphore(3)  # Максимум 3 одновременных запроса
+        self.request_semaphore = SharedSemaphore(3, limits_path)  # Максимум 3 одновременных запроса
         
         # Rate limiter для ограничения частоты запросов
-        self.rate_limiter = RateLimiter(requests_per_minute=15)  # 15 запросов в минуту
+        self.rate_limiter = SharedRateLimiter(15, limits_path, fallback=RateLimiter(requests_per_minute=15))  # 15 запросов в минуту
+        
+        # Оценка ожидания по очереди и наблюдаемой пропускной способности для допуска генераций
+        self.admission = AdmissionController(requests_per_minute=15, concurrency=3)
         
         # Отслеживание активных запросов
         self.active_requests = set()
         self.request_lock = asyncio.Lock()
         
+        # Статистика токенов при редактировании (оценка)
+        self.edit_stats = {"edits": 0, "local_edits": 0, "tokens_sent": 0, "tokens_new": 0, "tokens_standalone": 0}
+        # Кассета для записи/воспроизведения запросов (LLM_CASSETTE_MODE), по умолчанию выключена
+        self.cassette = get_cassette()
+        
         if self.debug:
             logger.info(f"LLMClient инициализирован с моделью {model}")
             logger.info(f"SSL проверка: {'отключена' if disable_ssl else 'включена'}")
@@ -122,7 +131,7 @@ class LLMClient:
 Тема нового поста: {topic}
 
 Датасет:
-{json.dumps(RDDM_DATASET, ensure_ascii=False, indent=2)}
+{RDDM_DATASET_JSON}
 
 Логика составления поста:
 1) Если пользователей отправил тебе пример поста, то при генерации нового поста опирайся на него;
@@ -144,12 +153,18 @@ class LLMClient:
         # Генерируем текст с установленным тайм-аутом
         try:
             generated_text = await asyncio.wait_for(
-                self._send_request_async(system_prompt, user_prompt),
+                self._send_request_async(system_prompt, user_prompt, topic=topic, post_size=post_size),
                 timeout=30  # Жесткий тайм-аут 30 секунд на весь запрос
             )
             
+            # Черновик локального генератора (API недоступен) - не ответ модели
+            from_model = bool(generated_text) and not fallback_generator.is_generated(generated_text)
             # Применяем ограничения по размеру
-            return self._enforce_size_limits(generated_text, min_size, max_size)
+            result = self._enforce_size_limits(generated_text, min_size, max_size)
+            # Удачные ответы модели пополняют архив локального генератора черновиков;
+            # слишком короткий ответ - скорее ошибка, чем пост
+            fallback_generator.remember_post(topic, result, from_model=from_model and len(result) >= min_size)
+            return result
             
         except asyncio.TimeoutError:
             logger.error(f"Тайм-аут при генерации поста из шаблона по теме '{topic}'")
@@ -175,7 +190,7 @@ class LLMClient:
         user_prompt = f"""Тема поста: {topic}
 
 Датасет:
-{json.dumps(RDDM_DATASET, ensure_ascii=False, indent=2)}
+{RDDM_DATASET_JSON}
 
 Логика составления поста:
 1) Если пользователей отправил тебе пример поста, то при генерации нового поста опирайся на него;
@@ -197,12 +212,18 @@ class LLMClient:
         # Генерируем текст с тайм-аутом
         try:
             generated_text = await asyncio.wait_for(
-                self._send_request_async(system_prompt, user_prompt),
+                self._send_request_async(system_prompt, user_prompt, topic=topic, post_size=post_size),
                 timeout=30  # Жесткий тайм-аут 30 секунд на весь запрос
             )
             
+            # Черновик локального генератора (API недоступен) - не ответ модели
+            from_model = bool(generated_text) and not fallback_generator.is_generated(generated_text)
             # Применяем ограничения по размеру
-            return self._enforce_size_limits(generated_text, min_size, max_size)
+            result = self._enforce_size_limits(generated_text, min_size, max_size)
+            # Удачные ответы модели пополняют архив локального генератора черновиков;
+            # слишком короткий ответ - скорее ошибка, чем пост
+            fallback_generator.remember_post(topic, result, from_model=from_model and len(result) >= min_size)
+            return result
             
         except asyncio.TimeoutError:
             logger.error(f"Тайм-аут при генерации поста без шаблона по теме '{topic}'")
@@ -211,8 +232,80 @@ class LLMClient:
             logger.error(f"Ошибка при генерации поста: {e}")
             return f"Произошла ошибка при генерации поста. Пожалуйста, попробуйте позже.\n\n#ДвижениеПервых59"
     
-    async def modify_post(self, current_post, modification_request, language="ru"):
-        """Модифицирует существующий пост согласно запросу."""
+    async def modify_post(self, current_post, modification_request, language="ru", edit_session=None):
+        """Модифицирует существующий пост согласно запросу.
+        
+        edit_session - история правок этого поста (EditSession); при её наличии
+        модель видит предыдущие запросы, а в API отправляется только новая часть диалога.
+        """
+        if INCREMENTAL_EDIT_MODE:
+            # Простые механические правки выполняем локально, без обращения к API
+            edited_post = try_mechanical_edit(current_post, modification_request)
+            if edited_post is not None:
+                logger.info("Пост отредактирован локально без запроса к API")
+                self.edit_stats["local_edits"] += 1
+                LLM_LOCAL_EDITS.inc()
+                if edit_session is not None:
+                    edit_session.record_request(modification_request)
+                return edited_post
+            
+            if edit_session is None:
+                edit_session = EditSession(max_turns=EDIT_HISTORY_MAX_TURNS)
+            return await self._modify_post_incremental(current_post, modification_request, edit_session)
+        
+        return await self._modify_post_full(current_post, modification_request)
+    
+    async def _modify_post_incremental(self, current_post, modification_request, edit_session):
+        """Запрашивает у модели только изменённые абзацы и применяет патч локально."""
+        history, user_message, paragraphs, ids = edit_session.prepare_turn(current_post, modification_request)
+        self._log_edit_tokens(edit_session, history, user_message, paragraphs, modification_request)
+        
+        try:
+            response_text = await asyncio.wait_for(
+                self._send_request_async(EDIT_SYSTEM_PROMPT, user_message, max_tokens=512, history=history),
+                timeout=30  # Жесткий тайм-аут 30 секунд на весь запрос
+            )
+        except asyncio.TimeoutError:
+            logger.error(f"Тайм-аут при модификации поста")
+            return f"Извините, время ожидания истекло. Попробуйте ещё раз с другим запросом на изменение.\n\n{current_post}"
+        except Exception as e:
+            logger.error(f"Ошибка при модификации поста: {e}")
+            return f"Произошла ошибка при модификации поста. Пожалуйста, попробуйте позже.\n\n{current_post}"
+        
+        if fallback_generator.is_generated(response_text):
+            # API недоступен - не подменяем пост пользователя черновиком-заглушкой
+            return f"Произошла ошибка при модификации поста. Пожалуйста, попробуйте позже.\n\n{current_post}"
+        
+        patched_post = edit_session.apply_response(modification_request, user_message, paragraphs, ids, response_text)
+        if patched_post is not None:
+            return patched_post
+        
+        # Модель вернула не патч, а пост целиком - используем его как есть
+        logger.warning("Ответ модели не является патчем, используем его как полный текст поста")
+        current_length = len(current_post)
+        return self._enforce_size_limits(response_text, current_length * 0.8, current_length * 1.2)
+    
+    def _log_edit_tokens(self, edit_session, history, user_message, paragraphs, modification_request):
+        """Оценивает объём отправляемых токенов с историей и без неё."""
+        new_messages = edit_session.new_messages(user_message)
+        sent = estimate_tokens(EDIT_SYSTEM_PROMPT) + sum(estimate_tokens(m["content"]) for m in history) + estimate_tokens(user_message)
+        # Всё, кроме новых сообщений, совпадает с началом предыдущего запроса и кэшируется
+        new = sum(estimate_tokens(m["content"]) for m in new_messages)
+        standalone = estimate_tokens(EDIT_SYSTEM_PROMPT) + estimate_tokens(
+            f"Текущий пост по абзацам:\n\n{number_paragraphs(paragraphs)}\n\nТребуемые изменения: {modification_request}"
+        )
+        
+        self.edit_stats["edits"] += 1
+        self.edit_stats["tokens_sent"] += sent
+        self.edit_stats["tokens_new"] += new
+        self.edit_stats["tokens_standalone"] += standalone
+        logger.info(
+            f"Правка: ~{sent} токенов в запросе, из них новых ~{new}; "
+            f"отдельный запрос без истории занял бы ~{standalone} токенов без кэширования"
+        )
+    
+    async def _modify_post_full(self, current_post, modification_request):
+        """Перегенерирует пост целиком с учётом запроса на изменение."""
         system_prompt = """Чат, тебе нужно отредактировать пост для группы в Вконтакте "Движение первых". При составлении поста опирайся на пример поста, который тебе отправил пользоватеь или на информацию, которую в тебя заложили с помощью промта и датасета. 
 
 Общая информация про "Движение первых": 
@@ -225,7 +318,7 @@ class LLMClient:
 Требуемые изменения: {modification_request}
 
 Датасет:
-{json.dumps(RDDM_DATASET, ensure_ascii=False, indent=2)}
+{RDDM_DATASET_JSON}
 
 Критерии:
 - Обращай внимание на датасет и обязательно указывай в сгенрированных постах ту информацию, которую мы заложили в документе
@@ -243,6 +336,10 @@ class LLMClient:
                 timeout=30  # Жесткий тайм-аут 30 секунд на весь запрос
             )
             
+            if fallback_generator.is_generated(generated_text):
+                # API недоступен - не подменяем пост пользователя черновиком-заглушкой
+                return f"Произошла ошибка при модификации поста. Пожалуйста, попробуйте позже.\n\n{current_post}"
+            
             # Сохраняем примерно ту же длину
             current_length = len(current_post)
             return self._enforce_size_limits(generated_text, current_length * 0.8, current_length * 1.2)
@@ -340,13 +437,31 @@ class LLMClient:
         # Если текст в пределах нормы
         return text
     
-    async def _send_request_async(self, system_prompt, user_prompt):
-        """Асинхронно отправляет запрос к OpenRouter API с ограничением одновременных запросов."""
+    async def _send_request_async(self, system_prompt, user_prompt, max_tokens=1024, history=None, topic=None, post_size=None):
+        """Асинхронно отправляет запрос к OpenRouter API с ограничением одновременных запросов.
+        
+        history - предыдущие сообщения диалога, вставляются между системным промптом и запросом.
+        topic и post_size используются локальным генератором, если API недоступен.
+        """
         # Ограничиваем частоту запросов
-        await self.rate_limiter.acquire()
+        LLM_QUEUE_DEPTH.inc()
+        self.admission.waiting += 1
+        try:
+            with span("llm.rate_limiter"):
+                await self.rate_limiter.acquire()
+            # Ограничиваем количество одновременных запросов
+            with span("llm.semaphore"):
+                await self.request_semaphore.acquire()
+        except BaseException:
+            self.admission.waiting -= 1
+            raise
+        finally:
+            LLM_QUEUE_DEPTH.dec()
         
-        # Ограничиваем количество одновременных запросов
-        async with self.request_semaphore:
+        LLM_IN_FLIGHT.inc()
+        self.admission.started()
+        started = time.monotonic()
+        try:
             # Создаем уникальный идентификатор для этого запроса
             request_id = id(user_prompt)
             
@@ -356,10 +471,11 @@ class LLMClient:
             
             try:
                 # Задаем таймаут для всего процесса запроса
-                return await asyncio.wait_for(
-                    self._execute_request(system_prompt, user_prompt, request_id),
-                    timeout=25  # Общий таймаут немного меньше, чем у вызывающих методов
-                )
+                with span("llm.request", max_tokens=max_tokens):
+                    return await asyncio.wait_for(
+                        self._execute_request(system_prompt, user_prompt, request_id, max_tokens, history, topic, post_size),
+                        timeout=25  # Общий таймаут немного меньше, чем у вызывающих методов
+                    )
             except asyncio.TimeoutError:
                 logger.error(f"Таймаут для запроса {request_id}")
                 raise
@@ -370,8 +486,35 @@ class LLMClient:
                 # Удаляем запрос из списка активных
                 async with self.request_lock:
                     self.active_requests.discard(request_id)
+        finally:
+            LLM_IN_FLIGHT.dec()
+            self.request_semaphore.release()
+            self.admission.finished(time.monotonic() - started)
+    
+    async def _execute_request(self, system_prompt, user_prompt, request_id, max_tokens=1024, history=None, topic=None, post_size=None):
+        """Выполняет запрос к API, при включенной кассете записывая или воспроизводя ответ."""
+        if self.cassette is None:
+            return await self._execute_attempts(system_prompt, user_prompt, request_id, max_tokens, history, topic, post_size, [])
+        
+        key = Cassette.key(system_prompt, history, user_prompt, max_tokens)
+        if self.cassette.replaying:
+            with span("llm.cassette_replay"):
+                recorded = await self.cassette.replay(key)
+            if recorded is not None:
+                logger.info(f"Запрос {request_id}: ответ воспроизведен из кассеты")
+                return recorded
+            if self.cassette.miss != "network":
+                return self._get_fallback_response(topic, post_size)
+        
+        attempts = []
+        start_time = time.time()
+        content = await self._execute_attempts(system_prompt, user_prompt, request_id, max_tokens, history, topic, post_size, attempts)
+        # Черновик локального генератора - не ответ модели, воспроизводить его нельзя
+        if self.cassette.recording and not fallback_generator.is_generated(content):
+            self.cassette.record(key, system_prompt, max_tokens, content, time.time() - start_time, attempts)
+        return content
     
-    async def _execute_request(self, system_prompt, user_prompt, request_id):
+    async def _execute_attempts(self, system_prompt, user_prompt, request_id, max_tokens, history, topic, post_size, attempts):
         """Выполняет фактический запрос к API с обработкой ошибок и сменой моделей/URL."""
         # Используем все доступные URL для большей вероятности успеха
         api_urls = self.api_urls.copy()
@@ -381,66 +524,81 @@ class LLMClient:
         
         for attempt, current_url in enumerate(api_urls, 1):
             current_model = models_to_try[0]  # Текущая модель для этой попытки
-            
-            try:
-                # Подготовка данных для запроса
-                payload = {
-                    "model": current_model,
-                    "messages": [
-                        {"role": "system", "content": system_prompt},
-                        {"role": "user", "content": user_prompt}
-                    ],
-                    "max_tokens": 1024,
-                    "temperature": 0.7
-                }
+            attempt_info = {"url": current_url, "model": current_model}
+            attempts.append(attempt_info)
+            attempt_start = time.time()
+            with span("llm.attempt", url=current_url, model=current_model) as attempt_span:
+                try:
+                    # Подготовка данных для запроса
+                    payload = {
+                        "model": current_model,
+                        "messages": [
+                            {"role": "system", "content": system_prompt},
+                            *(history or []),
+                            {"role": "user", "content": user_prompt}
+                        ],
+                        "max_tokens": max_tokens,
+                        "temperature": 0.7
+                    }
                 
-                headers = self.headers.copy()
-                logger.info(f"Запрос {request_id}: попытка {attempt}/{len(api_urls)} к {current_url}, модель {current_model}")
+                    headers = self.headers.copy()
+                    logger.debug("Запрос %s: попытка %s/%s к %s, модель %s", request_id, attempt, len(api_urls), current_url, current_model)
                 
-                # Отключаем проверку SSL для отладки и решения проблем с сертификатами
-                connector = aiohttp.TCPConnector(ssl=False, force_close=True)
+                    # Отключаем проверку SSL для отладки и решения проблем с сертификатами
+                    connector = aiohttp.TCPConnector(ssl=False, force_close=True)
                 
-                # Настраиваем более жесткие тайм-ауты для разных этапов запроса
-                timeout = aiohttp.ClientTimeout(total=20, connect=5, sock_read=15)
+                    # Настраиваем более жесткие тайм-ауты для разных этапов запроса
+                    timeout = aiohttp.ClientTimeout(total=20, connect=5, sock_read=15)
                 
-                async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
-                    async with session.post(
-                        current_url, 
-                        json=payload, 
-                        headers=headers
-                    ) as response:
-                        status = response.status
-                        raw_response = await asyncio.wait_for(response.text(), timeout=10)
+                    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+                        async with session.post(
+                            current_url, 
+                            json=payload, 
+                            headers=headers
+                        ) as response:
+                            status = response.status
+                            attempt_info["status"] = status
+                            raw_response = await asyncio.wait_for(response.text(), timeout=10)
                         
-                        if status != 200:
-                            logger.error(f"Ошибка API (запрос {request_id}): статус {status}")
-                            # Переходим к следующей попытке
-                            raise Exception(f"API вернул статус {status}")
+                            if status != 200:
+                                logger.error(f"Ошибка API (запрос {request_id}): статус {status}")
+                                # Переходим к следующей попытке
+                                raise Exception(f"API вернул статус {status}")
                         
-                        # Если дошли сюда, то статус 200
-                        try:
-                            result = json.loads(raw_response)
+                            # Если дошли сюда, то статус 200
+                            try:
+                                result = json.loads(raw_response)
                             
-                            # Проверяем наличие ответа в ожидаемом формате
-                            if "choices" in result and len(result["choices"]) > 0:
-                                message = result["choices"][0]["message"]
-                                if message and "content" in message:
-                                    logger.info(f"Запрос {request_id}: успешно получен ответ")
-                                    return message["content"]
+                                # Проверяем наличие ответа в ожидаемом формате
+                                if "choices" in result and len(result["choices"]) > 0:
+                                    message = result["choices"][0]["message"]
+                                    if message and "content" in message:
+                                        self._record_usage(current_model, result.get("usage"))
+                                        logger.info("Запрос %s: ответ получен от %s (%s), попытка %s", request_id, current_url, current_model, attempt)
+                                        return message["content"]
                             
-                            # Если дошли сюда - формат ответа неожиданный
-                            logger.error(f"Запрос {request_id}: неожиданный формат JSON")
-                            raise Exception("Неожиданный формат ответа")
+                                # Если дошли сюда - формат ответа неожиданный
+                                logger.error(f"Запрос {request_id}: неожиданный формат JSON")
+                                raise Exception("Неожиданный формат ответа")
                             
-                        except json.JSONDecodeError:
-                            logger.error(f"Запрос {request_id}: ошибка декодирования JSON")
-                            raise
+                            except json.JSONDecodeError:
+                                logger.error(f"Запрос {request_id}: ошибка декодирования JSON")
+                                raise
             
-            except (aiohttp.ClientConnectorError, asyncio.TimeoutError) as e:
-                logger.error(f"Запрос {request_id}: ошибка соединения: {e}")
+                except (aiohttp.ClientConnectorError, asyncio.TimeoutError) as e:
+                    logger.error(f"Запрос {request_id}: ошибка соединения: {e}")
+                    attempt_info["error"] = type(e).__name__
             
-            except Exception as e:
-                logger.error(f"Запрос {request_id}: ошибка: {e}")
+                except Exception as e:
+                    logger.error(f"Запрос {request_id}: ошибка: {e}")
+                    attempt_info.setdefault("error", str(e)[:100])
+            
+                finally:
+                    attempt_info["ms"] = round((time.time() - attempt_start) * 1000, 1)
+                    LLM_REQUEST_DURATION.labels(current_url, current_model, str(attempt_info.get("status", "error"))).observe(
+                        attempt_info["ms"] / 1000
+                    )
+                    attempt_span.set(status=attempt_info.get("status"), error=attempt_info.get("error"))
             
             # Если попытка не удалась, пробуем другую модель и/или URL
             if len(models_to_try) > 1:
@@ -452,62 +610,54 @@ class LLMClient:
         
         # Если все попытки не удались
         logger.error(f"Запрос {request_id}: все попытки запроса к API неудачны")
-        return self._get_fallback_response(user_prompt)
+        return self._get_fallback_response(topic, post_size)
+    
+    def _record_usage(self, model, usage):
+        """Учитывает токены промпта и попадания в кэш провайдера по полю usage ответа."""
+        if not usage:
+            return
+        LLM_PROMPT_TOKENS.labels(model).inc(usage.get("prompt_tokens") or 0)
+        details = usage.get("prompt_tokens_details") or {}
+        LLM_CACHED_TOKENS.labels(model).inc(details.get("cached_tokens") or 0)
+    
+    def _get_fallback_response(self, topic=None, post_size=None):
+        """Возвращает черновик локального генератора при ошибках API."""
+        LLM_FALLBACKS.inc()
+        logger.info("Использование локального генератора черновиков из-за ошибок API")
+        with span("llm.fallback_generator"):
+            return fallback_generator.generate(topic, post_size or PostSize.MEDIUM)
+    
+    async def probe_endpoints(self, timeout=5):
+        """
+        Проверяет доступность URL API без генерации: HEAD-запрос без ключа и тела.
+
+        Любой HTTP-ответ (в том числе 404 или 405) означает, что хост доступен. Доступные URL
+        переносятся в начало списка, чтобы первый запрос пользователя не ждал таймаутов
+        недоступных хостов. Лимиты запросов и токены не расходуются.
+
+        :param timeout: Таймаут проверки одного URL в секундах
+        :return: {url: {"reachable", "status", "ms"}}
+        """
+        async def probe(session, url):
+            started = time.perf_counter()
+            result = {"reachable": False, "status": None}
+            try:
+                async with session.head(url, allow_redirects=False) as response:
+                    result.update(reachable=True, status=response.status)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                result["error"] = type(e).__name__
+            result["ms"] = round((time.perf_counter() - started) * 1000, 1)
+            return url, result
+
+        connector = aiohttp.TCPConnector(ssl=False, force_close=True)
+        async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=timeout)) as session:
+            results = dict(await asyncio.gather(*(probe(session, url) for url in self.api_urls)))
+
+        reachable = [url for url in self.api_urls if results[url]["reachable"]]
+        if reachable:
+            self.api_urls = reachable + [url for url in self.api_urls if not results[url]["reachable"]]
+        return results
     
-    def _get_fallback_response(self, user_prompt):
-        """Возвращает заглушку при ошибках API."""
-        logger.info("Использование заглушки из-за ошибок API")
-        
-        user_prompt_lower = user_prompt.lower()
-        
-        # Проверяем различные ключевые слова для выбора подходящей заглушки
-        if "паспорт" in user_prompt_lower:
-            return """Сегодня состоялось торжественное вручение паспортов юным гражданам России! 
-
-В этот важный день ребята присоединились к программе «Мы – граждане России!», которая реализуется совместно с Министерством внутренних дел РФ.
-
-Получение паспорта - это первый серьёзный шаг во взрослую жизнь, новые права и обязанности. Искренне поздравляем ребят с этим значимым событием!
-
-Подробнее о программе: https://vk.com/club26323016
-
-#МыГражданеРоссии #ПатриотыПервых #ДвижениеПервых59"""
-        
-        elif "экология" in user_prompt_lower:
-            return """Друзья! Движение Первых приглашает всех на экологическую акцию по уборке городского парка!
-
-Вместе мы сделаем наш город чище и покажем, что забота о природе начинается с малого - с бережного отношения к окружающей среде вокруг нас.
-
-Приходите в эту субботу в 12:00, с собой можно взять перчатки и хорошее настроение!
-
-#ЭкологияПервых #ДвижениеПервых59"""
-        
-        elif "спорт" in user_prompt_lower:
-            return """Активный образ жизни - путь к успеху! 
-
-Сегодня участники "Движения Первых" провели открытую тренировку на свежем воздухе. Утренняя зарядка, пробежка и спортивные игры - отличный заряд энергии на весь день!
-
-Присоединяйтесь к нашим регулярным тренировкам каждую субботу в 10:00 в городском парке.
-
-#СпортЗОЖПервых #ДвижениеПервых59"""
-            
-        elif "коров" in user_prompt_lower:
-            return """Сегодня в рамках образовательной программы "Движения Первых" ребята посетили современную молочную ферму и узнали о новейших технологиях в сельском хозяйстве!
-
-Самое яркое впечатление произвели автоматические доильные аппараты, где коровы самостоятельно заходят в доильные боксы, когда чувствуют необходимость. Датчики и роботизированная система делают процесс доения комфортным как для животных, так и для фермеров.
-
-Такие экскурсии не только расширяют кругозор, но и знакомят молодежь с инновациями в традиционных отраслях.
-
-#НаукаПервых #ТехнологииБудущего #ДвижениеПервых59"""
-        
-        else:
-            return """Друзья! "Движение Первых" - это наша общая история, которую мы пишем вместе.
-
-Приглашаем вас принять участие в наших мероприятиях, раскрыть свои таланты и найти единомышленников.
-
-Следите за обновлениями группы, чтобы не пропустить интересные события и возможности для саморазвития!
-
-#ДвижениеПервых59"""
-            
     async def cancel_all_requests(self):
         """Отменяет все активные запросы"""
         logger.warning(f"Отмена всех активных запросов ({len(self.active_requests)})")
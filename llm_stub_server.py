@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+"""
+Локальная заглушка OpenRouter API для нагрузочного тестирования и проверки отказоустойчивости.
+
+Реализует /api/v1/chat/completions (обычный и потоковый режим) со сценарием поведения:
+распределение задержек, доля ошибок, ответы 429 с Retry-After, медленная отдача тела
+и обрыв соединения. LLMClient направляется на заглушку только через конфигурацию:
+
+    python llm_stub_server.py --port 8090 --scenario scenario.json
+    POST_ARCHIVE_PATH=/tmp/stub_archive.jsonl OPENROUTER_API_URLS=http://127.0.0.1:8090/fail/api/v1/chat/completions,http://127.0.0.1:8090/api/v1/chat/completions python bot.py
+
+Префикс пути (/fail/... выше) выбирает профиль из раздела "profiles" сценария, так что
+один процесс заглушки изображает несколько эндпоинтов с разным поведением.
+Сценарий можно посмотреть и изменить на лету: GET/POST /__stub/config, статистика - GET /__stub/stats.
+Для детерминированных тестов режим отдельного запроса задаётся заголовком
+X-Stub-Mode: ok | error | 429 | slow | reset.
+"""
+import os
+import re
+import json
+import time
+import uuid
+import random
+import asyncio
+import logging
+import argparse
+
+from aiohttp import web
+
+from fallback_generator import FallbackGenerator, PostArchive
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger("llm_stub_server")
+
+# Ответы заглушки собираются из постов-образцов в памяти: рабочий архив постов они не
+# читают, а сами не должны в него попадать (см. POST_ARCHIVE_PATH в README)
+reply_generator = FallbackGenerator(archive=PostArchive())
+
+# Сценарий по умолчанию: быстрые успешные ответы
+DEFAULT_SCENARIO = {
+    "latency": {"dist": "fixed", "ms": 200},  # fixed | uniform | normal | lognormal | exponential
+    "error_rate": 0.0,  # Доля ответов 500
+    "error_status": 500,
+    "rate_limit_rate": 0.0,  # Доля ответов 429
+    "retry_after": 5,  # Значение заголовка Retry-After, секунды
+    "rps_limit": 0,  # Ограничение запросов в секунду (0 - без ограничения), сверх лимита - 429
+    "slow_body_rate": 0.0,  # Доля ответов, тело которых отдаётся медленно
+    "slow_body_chunk_delay_ms": 500,
+    "reset_rate": 0.0,  # Доля запросов, на которые соединение обрывается без ответа
+    "stream_chunk_delay_ms": 20,  # Задержка между фрагментами в потоковом режиме
+    "reply": "generated",  # generated | echo | fixed
+    "fixed_text": "Тестовый пост от заглушки API.\n\n#ДвижениеПервых59",
+    "seed": None,
+    "profiles": {
+        "fail": {"error_rate": 1.0},
+        "slow": {"latency": {"dist": "fixed", "ms": 30000}},
+        "limited": {"rate_limit_rate": 1.0},
+        "reset": {"reset_rate": 1.0},
+    },
+}
+
+class StubState:
+    """Текущий сценарий и статистика заглушки"""
+
+    def __init__(self, scenario=None):
+        self.scenario = json.loads(json.dumps(DEFAULT_SCENARIO))
+        self.rng = random.Random(self.scenario.get("seed"))
+        if scenario:
+            self.update(scenario)
+        self.stats = {}
+        self.latencies = []
+        self.window_start = time.monotonic()
+        self.window_count = 0
+
+    def update(self, changes):
+        """Обновляет сценарий (профили объединяются по ключам)"""
+        changes = dict(changes)
+        profiles = changes.pop("profiles", None)
+        self.scenario.update(changes)
+        if profiles:
+            self.scenario["profiles"].update(profiles)
+        self.rng = random.Random(self.scenario.get("seed"))
+
+    def settings(self, profile):
+        """Настройки для профиля (поверх базового сценария)"""
+        settings = dict(self.scenario)
+        if profile:
+            settings.update(self.scenario["profiles"].get(profile, {}))
+        return settings
+
+    def count(self, outcome):
+        self.stats[outcome] = self.stats.get(outcome, 0) + 1
+
+    def over_rps_limit(self, limit):
+        """Простое окно в одну секунду для ограничения запросов"""
+        if not limit:
+            return False
+        now = time.monotonic()
+        if now - self.window_start >= 1:
+            self.window_start = now
+            self.window_count = 0
+        self.window_count += 1
+        return self.window_count > limit
+
+    def sample_latency(self, latency):
+        """Возвращает задержку в секундах согласно распределению"""
+        dist = latency.get("dist", "fixed")
+        ms = latency.get("ms", 0)
+        rng = self.rng
+        if dist == "uniform":
+            value = rng.uniform(latency.get("min_ms", 0), latency.get("max_ms", ms))
+        elif dist == "normal":
+            value = rng.gauss(ms, latency.get("sigma_ms", ms * 0.2))
+        elif dist == "lognormal":
+            # ms - медиана, sigma - параметр формы
+            value = ms * rng.lognormvariate(0, latency.get("sigma", 0.5))
+        elif dist == "exponential":
+            value = rng.expovariate(1 / ms) if ms else 0
+        else:
+            value = ms
+        return max(0.0, value) / 1000
+
+def _extract_topic(messages):
+    """Достаёт тему поста из промпта, чтобы ответ был правдоподобным"""
+    for message in reversed(messages):
+        match = re.search(r"Тема (?:нового )?поста: (.+)", message.get("content", ""))
+        if match:
+            return match.group(1).strip()
+    return None
+
+def _build_reply(settings, messages):
+    """Формирует текст ответа модели"""
+    system = messages[0].get("content", "") if messages else ""
+    user = messages[-1].get("content", "") if messages else ""
+    if "JSON-патч" in system:
+        # Запрос на правку - отвечаем патчем к первому абзацу
+        return json.dumps({"ops": [{"op": "replace", "index": 1, "text": f"Отредактировано заглушкой: {user[-80:]}"}]},
+                          ensure_ascii=False)
+    if settings["reply"] == "echo":
+        return user
+    if settings["reply"] == "fixed":
+        return settings["fixed_text"]
+    size_match = re.search(r"от (\d+) до (\d+) символов", user)
+    size = "medium"
+    if size_match:
+        size = {"200": "small", "400": "medium", "800": "large"}.get(size_match.group(1), "medium")
+    return reply_generator.generate(_extract_topic(messages), size)
+
+def _completion(model, content, prompt_chars):
+    return {
+        "id": f"gen-{uuid.uuid4().hex[:16]}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": content},
+            "finish_reason": "stop"
+        }],
+        "usage": {
+            "prompt_tokens": prompt_chars // 3,
+            "completion_tokens": len(content) // 3,
+            "total_tokens": (prompt_chars + len(content)) // 3
+        }
+    }
+
+async def _send_stream(request, settings, model, content):
+    """Отдаёт ответ фрагментами в формате server-sent events"""
+    response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+    await response.prepare(request)
+    completion_id = f"gen-{uuid.uuid4().hex[:16]}"
+    delay = settings["stream_chunk_delay_ms"] / 1000
+    words = re.findall(r"\S+\s*", content)
+    for i in range(0, len(words), 3):
+        chunk = {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "delta": {"content": "".join(words[i:i + 3])}, "finish_reason": None}]
+        }
+        await response.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode())
+        if delay:
+            await asyncio.sleep(delay)
+    final = {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]
+    }
+    await response.write(f"data: {json.dumps(final)}\n\n".encode())
+    await response.write(b"data: [DONE]\n\n")
+    await response.write_eof()
+    return response
+
+async def _send_slow(request, settings, payload):
+    """Отдаёт тело ответа маленькими порциями с задержками"""
+    body = json.dumps(payload, ensure_ascii=False).encode()
+    response = web.StreamResponse(headers={"Content-Type": "application/json"})
+    response.content_length = len(body)
+    await response.prepare(request)
+    delay = settings["slow_body_chunk_delay_ms"] / 1000
+    step = max(1, len(body) // 10)
+    for i in range(0, len(body), step):
+        await response.write(body[i:i + step])
+        await asyncio.sleep(delay)
+    await response.write_eof()
+    return response
+
+async def chat_completions(request):
+    """Обработчик /api/v1/chat/completions"""
+    state = request.app["state"]
+    profile = request.match_info.get("profile")
+    settings = state.settings(profile)
+    started = time.perf_counter()
+
+    try:
+        payload = await request.json()
+    except json.JSONDecodeError:
+        state.count("bad_request")
+        return web.json_response({"error": {"message": "Invalid JSON", "code": 400}}, status=400)
+
+    model = payload.get("model", "stub-model")
+    messages = payload.get("messages") or []
+    rng = state.rng
+
+    # Режим запроса: из заголовка или по вероятностям сценария
+    mode = request.headers.get("X-Stub-Mode")
+    if not mode:
+        roll = rng.random()
+        if state.over_rps_limit(settings["rps_limit"]):
+            mode = "429"
+        elif roll < settings["reset_rate"]:
+            mode = "reset"
+        elif roll < settings["reset_rate"] + settings["rate_limit_rate"]:
+            mode = "429"
+        elif roll < settings["reset_rate"] + settings["rate_limit_rate"] + settings["error_rate"]:
+            mode = "error"
+        elif rng.random() < settings["slow_body_rate"]:
+            mode = "slow"
+        else:
+            mode = "ok"
+
+    if mode == "429":
+        state.count("rate_limited")
+        return web.json_response(
+            {"error": {"message": "Rate limit exceeded", "code": 429}},
+            status=429,
+            headers={"Retry-After": str(settings["retry_after"])}
+        )
+
+    await asyncio.sleep(state.sample_latency(settings["latency"]))
+
+    if mode == "reset":
+        state.count("reset")
+        # Обрываем соединение, не отправив ответ
+        request.transport.abort()
+        raise asyncio.CancelledError()
+
+    if mode == "error":
+        state.count("error")
+        return web.json_response({"error": {"message": "Stub upstream error", "code": settings["error_status"]}},
+                                 status=settings["error_status"])
+
+    content = _build_reply(settings, messages)
+    prompt_chars = sum(len(m.get("content", "")) for m in messages)
+    state.latencies.append(time.perf_counter() - started)
+    del state.latencies[:-10000]
+
+    if payload.get("stream"):
+        state.count("ok_stream")
+        return await _send_stream(request, settings, model, content)
+
+    completion = _completion(model, content, prompt_chars)
+    if mode == "slow":
+        state.count("slow_body")
+        return await _send_slow(request, settings, completion)
+
+    state.count("ok")
+    return web.json_response(completion)
+
+async def config_handler(request):
+    """Просмотр и изменение сценария на лету"""
+    state = request.app["state"]
+    if request.method == "POST":
+        state.update(await request.json())
+        logger.info(f"Сценарий заглушки обновлён: {state.scenario}")
+    return web.json_response(state.scenario)
+
+async def stats_handler(request):
+    """Статистика ответов заглушки"""
+    state = request.app["state"]
+    latencies = sorted(state.latencies)
+    percentiles = {}
+    for p in (50, 90, 99):
+        if latencies:
+            percentiles[f"p{p}_ms"] = round(latencies[min(len(latencies) - 1, len(latencies) * p // 100)] * 1000, 2)
+    return web.json_response({"outcomes": state.stats, "latency": percentiles})
+
+async def models_handler(request):
+    """Список моделей (используется для проверки доступности)"""
+    return web.json_response({"data": [{"id": "stub-model"}]})
+
+def create_app(scenario=None):
+    """Создаёт aiohttp-приложение заглушки"""
+    app = web.Application()
+    app["state"] = StubState(scenario)
+    for prefix in ("", "/{profile}"):
+        app.router.add_post(prefix + "/api/v1/chat/completions", chat_completions)
+        app.router.add_post(prefix + "/v1/chat/completions", chat_completions)
+        app.router.add_post(prefix + "/api/chat/completions", chat_completions)
+        app.router.add_get(prefix + "/api/v1/models", models_handler)
+    app.router.add_route("*", "/__stub/config", config_handler)
+    app.router.add_get("/__stub/stats", stats_handler)
+    return app
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Заглушка OpenRouter API")
+    parser.add_argument("--host", default="127.0.0.1", help="Адрес для прослушивания")
+    parser.add_argument("--port", type=int, default=int(os.environ.get("LLM_STUB_PORT", 8090)), help="Порт")
+    parser.add_argument("--scenario", default=os.environ.get("LLM_STUB_SCENARIO"), help="JSON-файл сценария")
+    args = parser.parse_args()
+
+    scenario = None
+    if args.scenario:
+        with open(args.scenario, "r", encoding="utf-8") as f:
+            scenario = json.load(f)
+
+    logger.info(f"Заглушка OpenRouter API запущена на http://{args.host}:{args.port}/api/v1/chat/completions")
+    web.run_app(create_app(scenario), host=args.host, port=args.port, print=None)
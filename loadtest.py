@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+"""
+Нагрузочный тест бота на синтетических обновлениях Telegram.
+
+N виртуальных пользователей параллельно проходят сценарий
+start → mode → topic → size → edit. Обновления подаются прямо в dp.feed_update
+из bot.py, поэтому работают настоящие роутеры, фильтры, SessionManager и LLMClient
+(с его RateLimiter и семафором). Исходящие вызовы Bot API перехватывает фейковая
+сессия aiogram, вместо LLM по умолчанию используется локальная заглушка с
+настраиваемой задержкой.
+
+Примеры:
+
+    python loadtest.py --users 50
+    python loadtest.py --users 200 --rpm 6000 --llm-latency 2 --json
+    python loadtest.py --users 20 --llm url   # через OPENROUTER_API_URLS, например llm_stub_server.py
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+import tempfile
+import tracemalloc
+from collections import defaultdict
+
+# Тест не должен трогать архив постов и кассету
+os.environ["POST_ARCHIVE_PATH"] = os.path.join(tempfile.mkdtemp(prefix="loadtest_"), "post_archive.jsonl")
+os.environ["LLM_CASSETTE_MODE"] = "off"
+
+from aiogram import Bot
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import Response
+from aiogram.types import Update
+
+STAGES = ["start", "mode", "topic", "size", "edit_button", "edit"]
+
+TOPICS = [
+    "Экологическая акция в школе",
+    "Волонтёрский отряд помог ветеранам",
+    "Спортивные соревнования первичного отделения",
+    "Встреча с профессионалами медиацентра",
+    "Конкурс проектов по истории родного края",
+]
+
+EDIT_REQUESTS = [
+    "Сделай первый абзац более торжественным",
+    "Добавь призыв присоединиться к движению",
+    "Перепиши вступление короче",
+]
+
+# Методы Bot API, которые возвращают сообщение, остальные возвращают True
+MESSAGE_METHODS = {"sendMessage", "editMessageText"}
+
+class FakeSession(BaseSession):
+    """Сессия aiogram, которая не ходит в сеть, а запоминает исходящие вызовы"""
+
+    def __init__(self, latency=0.0):
+        super().__init__()
+        self.latency = latency
+        self.calls = defaultdict(int)
+        self.message_id = 0
+
+    async def make_request(self, bot, method, timeout=None):
+        name = method.__api_method__
+        self.calls[name] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if name in MESSAGE_METHODS:
+            self.message_id += 1
+            result = {
+                "message_id": getattr(method, "message_id", None) or self.message_id,
+                "date": int(time.time()),
+                "chat": {"id": method.chat_id, "type": "private"},
+                "text": method.text,
+            }
+        else:
+            result = True
+        response = Response[method.__returning__].model_validate({"ok": True, "result": result}, context={"bot": bot})
+        return response.result
+
+    async def close(self):
+        pass
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b""
+
+def install_llm_stand_in(llm_client, latency, jitter):
+    """Подменяет запрос к API локальной заглушкой: RateLimiter и семафор остаются настоящими"""
+    from llm_client import EDIT_SYSTEM_PROMPT
+    from fallback_generator import fallback_generator
+    from session_manager import PostSize
+
+    async def execute_request(system_prompt, user_prompt, request_id, max_tokens=1024, history=None, topic=None, post_size=None):
+        await asyncio.sleep(max(0.0, random.gauss(latency, latency * jitter)))
+        if system_prompt == EDIT_SYSTEM_PROMPT:
+            text = "Друзья, с гордостью рассказываем о событии, которое объединило первых!"
+            return json.dumps({"ops": [{"op": "replace", "index": 1, "text": text}]}, ensure_ascii=False)
+        return fallback_generator.generate(topic, post_size or PostSize.MEDIUM)
+
+    llm_client._execute_request = execute_request
+
+class VirtualUser:
+    """Виртуальный пользователь, проходящий сценарий создания и правки поста"""
+
+    def __init__(self, user_id, bot, bot_user):
+        self.user_id = user_id
+        self.bot = bot
+        self.bot_user = bot_user
+        self.message_id = 0
+
+    def _message(self, text, from_bot=False):
+        self.message_id += 1
+        return {
+            "message_id": self.message_id,
+            "date": int(time.time()),
+            "chat": {"id": self.user_id, "type": "private"},
+            "from": self.bot_user if from_bot else {"id": self.user_id, "is_bot": False, "first_name": f"User{self.user_id}"},
+            "text": text,
+        }
+
+    def message_update(self, update_id, text):
+        return Update.model_validate(
+            {"update_id": update_id, "message": self._message(text)},
+            context={"bot": self.bot}
+        )
+
+    def callback_update(self, update_id, data):
+        return Update.model_validate({
+            "update_id": update_id,
+            "callback_query": {
+                "id": f"{self.user_id}-{update_id}",
+                "from": {"id": self.user_id, "is_bot": False, "first_name": f"User{self.user_id}"},
+                "chat_instance": str(self.user_id),
+                "data": data,
+                "message": self._message("...", from_bot=True),
+            }
+        }, context={"bot": self.bot})
+
+    def scenario(self):
+        return [
+            ("start", "message", "/start"),
+            ("mode", "callback", "mode:no_template"),
+            ("topic", "message", random.choice(TOPICS)),
+            ("size", "callback", random.choice(["size:small", "size:medium", "size:large"])),
+            ("edit_button", "callback", "action:edit"),
+            ("edit", "message", random.choice(EDIT_REQUESTS)),
+        ]
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+async def run_load(args):
+    import bot as bot_module
+
+    if args.llm == "local":
+        install_llm_stand_in(bot_module.llm_client, args.llm_latency, args.llm_jitter)
+    if args.rpm:
+        from llm_client import RateLimiter
+        bot_module.llm_client.rate_limiter = RateLimiter(requests_per_minute=args.rpm)
+        bot_module.llm_client.admission.requests_per_minute = args.rpm
+    if args.llm_slots:
+        bot_module.llm_client.request_semaphore = asyncio.Semaphore(args.llm_slots)
+        bot_module.llm_client.admission.concurrency = args.llm_slots
+
+    session = FakeSession(latency=args.tg_latency)
+    session.middleware(bot_module.telegram_api_metrics_middleware)
+    bot = Bot(token="42:TEST", session=session)
+    bot_user = {"id": 42, "is_bot": True, "first_name": "LoadTestBot"}
+    dp = bot_module.dp
+
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+    update_counter = iter(range(1, 10 ** 9))
+
+    async def run_user(index, record=True):
+        if record:
+            await asyncio.sleep(args.ramp * index / max(1, args.users))
+        user = VirtualUser(1_000_000 + index, bot, bot_user)
+        for stage, kind, payload in user.scenario():
+            update_id = next(update_counter)
+            if kind == "message":
+                update = user.message_update(update_id, payload)
+            else:
+                update = user.callback_update(update_id, payload)
+            started = time.perf_counter()
+            try:
+                await dp.feed_update(bot, update)
+            except Exception as e:
+                errors[stage] += 1
+                logging.getLogger(__name__).error(f"Ошибка на этапе {stage}: {e}")
+            if not record:
+                continue
+            latencies[stage].append(time.perf_counter() - started)
+            if args.think:
+                await asyncio.sleep(random.uniform(0, args.think))
+
+    # Прогрев: первые обновления строят схемы pydantic и кэши aiogram, их не учитываем
+    for index in range(args.warmup):
+        await run_user(-1 - index, record=False)
+    errors.clear()
+    session.calls.clear()
+
+    tracemalloc.start()
+    memory_before = tracemalloc.take_snapshot()
+    traced_before, _ = tracemalloc.get_traced_memory()
+    started = time.perf_counter()
+
+    await asyncio.gather(*(run_user(i) for i in range(args.users)))
+
+    elapsed = time.perf_counter() - started
+    traced_after, traced_peak = tracemalloc.get_traced_memory()
+    top_growth = tracemalloc.take_snapshot().compare_to(memory_before, "lineno")[:5]
+    tracemalloc.stop()
+
+    total_updates = sum(len(v) for v in latencies.values())
+    return {
+        "users": args.users,
+        "llm": args.llm,
+        "duration_s": round(elapsed, 3),
+        "updates": total_updates,
+        "updates_per_s": round(total_updates / elapsed, 1) if elapsed else 0,
+        "errors": dict(errors),
+        "stages": {
+            stage: {
+                "count": len(latencies[stage]),
+                "p50_ms": round(percentile(latencies[stage], 50) * 1000, 1),
+                "p90_ms": round(percentile(latencies[stage], 90) * 1000, 1),
+                "p99_ms": round(percentile(latencies[stage], 99) * 1000, 1),
+                "max_ms": round(max(latencies[stage], default=0) * 1000, 1),
+            }
+            for stage in STAGES
+        },
+        "memory": {
+            "growth_kb": round((traced_after - traced_before) / 1024, 1),
+            "peak_kb": round(traced_peak / 1024, 1),
+            "per_user_kb": round((traced_after - traced_before) / 1024 / max(1, args.users), 2),
+            "top_growth": [str(stat) for stat in top_growth],
+        },
+        "bot_api_calls": dict(session.calls),
+        "admission": dict(bot_module.llm_client.admission.stats),
+        "sessions": len(bot_module.session_manager.sessions) - args.warmup,
+    }
+
+def print_report(report):
+    print(f"Пользователей: {report['users']}, LLM: {report['llm']}, время: {report['duration_s']} с")
+    print(f"Обновлений: {report['updates']} ({report['updates_per_s']}/с), ошибок: {sum(report['errors'].values())}")
+    print(f"{'этап':<12}{'n':>6}{'p50, мс':>10}{'p90, мс':>10}{'p99, мс':>10}{'max, мс':>10}")
+    for stage, stats in report["stages"].items():
+        print(f"{stage:<12}{stats['count']:>6}{stats['p50_ms']:>10}{stats['p90_ms']:>10}{stats['p99_ms']:>10}{stats['max_ms']:>10}")
+    memory = report["memory"]
+    print(f"Память: +{memory['growth_kb']} КБ ({memory['per_user_kb']} КБ на пользователя), пик {memory['peak_kb']} КБ")
+    for line in memory["top_growth"]:
+        print(f"  {line}")
+    print(f"Вызовы Bot API: {report['bot_api_calls']}")
+    print(f"Допуск генераций: {report['admission']}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота на синтетических обновлениях")
+    parser.add_argument("--users", type=int, default=20, help="Число виртуальных пользователей")
+    parser.add_argument("--ramp", type=float, default=0.0, help="Время подключения всех пользователей, с")
+    parser.add_argument("--think", type=float, default=0.0, help="Максимальная пауза пользователя между шагами, с")
+    parser.add_argument("--llm", choices=["local", "url"], default="local",
+                        help="local - заглушка в процессе, url - настоящие запросы по OPENROUTER_API_URLS")
+    parser.add_argument("--llm-latency", type=float, default=1.0, help="Средняя задержка заглушки LLM, с")
+    parser.add_argument("--llm-jitter", type=float, default=0.3, help="Разброс задержки заглушки (доля от средней)")
+    parser.add_argument("--rpm", type=int, default=0, help="Переопределить лимит запросов к LLM в минуту (0 - как в боте)")
+    parser.add_argument("--llm-slots", type=int, default=0, help="Переопределить число одновременных запросов к LLM")
+    parser.add_argument("--tg-latency", type=float, default=0.0, help="Задержка ответа фейкового Bot API, с")
+    parser.add_argument("--warmup", type=int, default=1, help="Число прогревочных пользователей вне статистики")
+    parser.add_argument("--json", action="store_true", help="Вывести отчет в JSON")
+    parser.add_argument("--verbose", action="store_true", help="Не отключать логи бота")
+    args = parser.parse_args()
+
+    if not args.verbose:
+        logging.disable(logging.WARNING)
+
+    report = asyncio.run(run_load(args))
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print_report(report)
+    sys.exit(1 if report["errors"] else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+"""
+Неблокирующая настройка логирования для всех процессов.
+
+Вызовы logger.* только кладут запись в ограниченную очередь (QueueHandler);
+форматирование, обрезка длинных полей, JSON-сериализация и запись в stdout или файл с
+ротацией выполняются в отдельном потоке (QueueListener). Если очередь переполнена,
+запись отбрасывается и учитывается, а не блокирует цикл событий.
+
+Настройки окружения:
+    LOG_LEVEL         - уровень (INFO)
+    LOG_FORMAT        - json или text (json)
+    LOG_FILE          - файл с ротацией по размеру вместо файла по умолчанию; "-" - только stdout
+    LOG_MAX_BYTES     - размер файла до ротации (5 МБ)
+    LOG_BACKUP_COUNT  - число старых файлов (3)
+    LOG_MAX_FIELD     - максимальная длина сообщения и полей (2000 символов)
+    LOG_QUEUE_SIZE    - размер очереди записей (10000)
+    LOG_SAMPLING      - доля сохраняемых записей ниже WARNING по логгерам,
+                        например "aiogram.event=0.1,session_manager=0.5"
+"""
+import os
+import sys
+import json
+import queue
+import atexit
+import random
+import logging
+import logging.handlers
+
+from tracing import current_trace_id
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# Стандартные атрибуты LogRecord, не попадающие в JSON как дополнительные поля
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "trace_id"}
+
+_listener = None
+_queue_handler = None
+
+def _truncate(text, limit):
+    if len(text) <= limit:
+        return text
+    return f"{text[:limit]}…(+{len(text) - limit})"
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись - одна строка JSON; длинные сообщения и поля обрезаются"""
+
+    def __init__(self, max_field=2000):
+        super().__init__()
+        self.max_field = max_field
+
+    def format(self, record):
+        data = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": _truncate(record.getMessage(), self.max_field),
+        }
+        if getattr(record, "trace_id", None) is not None:
+            data["trace_id"] = record.trace_id
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRS and not key.startswith("_"):
+                data[key] = value if isinstance(value, (int, float, bool)) or value is None else _truncate(str(value), self.max_field)
+        if record.exc_info:
+            data["exc"] = _truncate(self.formatException(record.exc_info), self.max_field * 4)
+        return json.dumps(data, ensure_ascii=False)
+
+class TruncatingFormatter(logging.Formatter):
+    """Текстовый формат с обрезкой длинных сообщений"""
+
+    def __init__(self, fmt=TEXT_FORMAT, max_field=2000):
+        super().__init__(fmt)
+        self.max_field = max_field
+
+    def formatMessage(self, record):
+        record.message = _truncate(record.message, self.max_field)
+        return super().formatMessage(record)
+
+class SamplingFilter(logging.Filter):
+    """Пропускает только долю записей ниже WARNING для заданных логгеров"""
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates  # {имя логгера: доля от 0 до 1}
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or not self.rates:
+            return True
+        name = record.name
+        while name:
+            rate = self.rates.get(name)
+            if rate is not None:
+                return random.random() < rate
+            name = name.rpartition(".")[0]
+        return True
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler, который не форматирует запись в вызывающем потоке и не ждёт места в очереди"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Сообщение формируется уже в потоке записи; идентификатор трассы берётся здесь,
+        # пока контекст вызывающей задачи доступен
+        record.trace_id = current_trace_id()
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+def _parse_sampling(value):
+    rates = {}
+    for item in value.split(","):
+        name, _, rate = item.partition("=")
+        if name.strip() and rate:
+            try:
+                rates[name.strip()] = max(0.0, min(1.0, float(rate)))
+            except ValueError:
+                pass
+    return rates
+
+def setup_logging(default_file=None):
+    """
+    Настраивает корневой логгер процесса. Повторные вызовы ничего не меняют.
+
+    :param default_file: Файл журнала процесса, если LOG_FILE не задан (None - только stdout)
+    :return: Обработчик очереди (для статистики отброшенных записей)
+    """
+    global _listener, _queue_handler
+    if _queue_handler is not None:
+        return _queue_handler
+
+    level = os.getenv("LOG_LEVEL", "INFO").upper()
+    max_field = int(os.getenv("LOG_MAX_FIELD", "2000"))
+    if os.getenv("LOG_FORMAT", "json") == "text":
+        formatter = TruncatingFormatter(max_field=max_field)
+    else:
+        formatter = JsonFormatter(max_field=max_field)
+
+    handlers = []
+    console = logging.StreamHandler(sys.stdout)
+    console.setFormatter(formatter)
+    handlers.append(console)
+
+    log_file = os.getenv("LOG_FILE", default_file)
+    if log_file and log_file != "-":
+        file_handler = logging.handlers.RotatingFileHandler(
+            log_file,
+            maxBytes=int(os.getenv("LOG_MAX_BYTES", str(5 * 1024 * 1024))),
+            backupCount=int(os.getenv("LOG_BACKUP_COUNT", "3")),
+            encoding="utf-8"
+        )
+        file_handler.setFormatter(formatter)
+        handlers.append(file_handler)
+
+    log_queue = queue.Queue(maxsize=int(os.getenv("LOG_QUEUE_SIZE", "10000")))
+    _queue_handler = NonBlockingQueueHandler(log_queue)
+    _queue_handler.addFilter(SamplingFilter(_parse_sampling(os.getenv("LOG_SAMPLING", ""))))
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(_queue_handler)
+    root.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+    return _queue_handler
+
+def stop_logging():
+    """Дописывает оставшиеся записи; нужно вызывать перед os.execv, где atexit не срабатывает"""
+    global _listener
+    if _listener is not None:
+        listener, _listener = _listener, None
+        listener.stop()
+        if _queue_handler.dropped:
+            sys.stderr.write(f"log_setup: отброшено записей при переполнении очереди: {_queue_handler.dropped}\n")
+
+def dropped_records():
+    """Число записей, отброшенных из-за переполнения очереди"""
+    return _queue_handler.dropped if _queue_handler is not None else 0
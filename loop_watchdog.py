@@ -0,0 +1,195 @@
+"""
+Сторож цикла событий бота.
+
+Вся работа бота идёт в одном цикле asyncio, поэтому любой синхронный участок
+(большой format_to_html, json.dumps, запись в файл) задерживает всех пользователей.
+Задача-пульс просыпается каждые LOOP_HEARTBEAT_MS и замеряет, насколько она опоздала.
+Отдельный поток следит за пульсом: если цикл не отвечает дольше порога, он снимает
+стек главного потока (sys._current_frames) каждые LOOP_SAMPLE_MS, пока цикл не освободится.
+Стеки агрегируются по месту в коде бота, так что /debug/loop показывает перцентили
+задержки, последние блокировки и самые частые виновники.
+
+Настройки окружения:
+    LOOP_HEARTBEAT_MS  - период пульса (100)
+    LOOP_STALL_MS      - задержка, с которой цикл считается заблокированным (100)
+    LOOP_SAMPLE_MS     - период снятия стека во время блокировки (10)
+"""
+import os
+import sys
+import time
+import asyncio
+import logging
+import threading
+import traceback
+from collections import deque
+
+from metrics import LOOP_LAG, LOOP_STALLS
+
+logger = logging.getLogger("loop_watchdog")
+
+# Сколько кадров стека хранить в одном образце (ближайшие к месту блокировки)
+MAX_STACK_DEPTH = 20
+# Сколько разных стеков хранить; реже встречавшиеся вытесняются
+MAX_OFFENDERS = 200
+
+_APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def _is_app_frame(filename):
+    return filename.startswith(_APP_DIR) and filename != __file__ and "site-packages" not in filename
+
+def _percentile(sorted_values, share):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * share))
+    return round(sorted_values[index], 1)
+
+class LoopWatchdog:
+    """Замер задержки цикла событий и образцы стека во время блокировок"""
+
+    def __init__(self, heartbeat=0.1, stall_threshold=0.1, sample_interval=0.01, history=3000):
+        """
+        :param heartbeat: Период пульса, секунды
+        :param stall_threshold: Опоздание пульса, начиная с которого цикл считается заблокированным
+        :param sample_interval: Период снятия стека во время блокировки
+        :param history: Сколько последних замеров задержки хранить для перцентилей
+        """
+        self.heartbeat = heartbeat
+        self.stall_threshold = stall_threshold
+        self.sample_interval = sample_interval
+        self.lags = deque(maxlen=history)  # Опоздания пульса, мс
+        self.stalls = deque(maxlen=50)  # Последние блокировки
+        self.offenders = {}  # {свёрнутый стек: статистика}
+        self.stall_count = 0
+        self.samples_taken = 0
+        self.last_beat = None
+        self.loop_thread_id = None
+        self.task = None
+        self.thread = None
+        self._pending = {}  # Образцы текущей блокировки: {место в коде: число образцов}
+
+    def start(self):
+        """Запускает пульс в текущем цикле событий и поток-сторож; повторный вызов ничего не делает"""
+        if self.task is not None and not self.task.done():
+            return
+        self.loop_thread_id = threading.get_ident()
+        self.last_beat = time.perf_counter()
+        self.task = asyncio.get_running_loop().create_task(self._heartbeat())
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+            self.thread.start()
+
+    async def _heartbeat(self):
+        while True:
+            scheduled = time.perf_counter()
+            self.last_beat = scheduled
+            await asyncio.sleep(self.heartbeat)
+            lag = max(0.0, time.perf_counter() - scheduled - self.heartbeat)
+            self.lags.append(lag * 1000)
+            LOOP_LAG.set(lag)
+            if lag >= self.stall_threshold:
+                self._finish_stall(lag)
+
+    def _finish_stall(self, lag):
+        """Сохраняет блокировку, закончившуюся перед этим пульсом"""
+        pending, self._pending = self._pending, {}
+        self.stall_count += 1
+        LOOP_STALLS.inc()
+        location = max(pending, key=pending.get) if pending else None
+        self.stalls.append({
+            "timestamp": round(time.time(), 3),
+            "lag_ms": round(lag * 1000, 1),
+            "samples": sum(pending.values()),
+            "location": location
+        })
+        logger.warning("Цикл событий заблокирован на %.0f мс: %s", lag * 1000, location or "стек не снят")
+
+    def _watch(self):
+        while True:
+            time.sleep(self.sample_interval)
+            last_beat = self.last_beat
+            if last_beat is None or time.perf_counter() - last_beat < self.heartbeat + self.stall_threshold:
+                continue
+            frame = sys._current_frames().get(self.loop_thread_id)
+            if frame is not None:
+                self._record_sample(frame)
+            del frame
+
+    def _record_sample(self, frame):
+        """Добавляет образец стека главного потока к статистике"""
+        stack = traceback.StackSummary.extract(traceback.walk_stack(frame), limit=MAX_STACK_DEPTH, lookup_lines=False)
+        if not stack:
+            return
+        # walk_stack идёт от внутреннего кадра к внешнему
+        frames = [f"{entry.name} ({os.path.basename(entry.filename)}:{entry.lineno})" for entry in stack]
+        location = next((frames[i] for i, entry in enumerate(stack) if _is_app_frame(entry.filename)), frames[0])
+        collapsed = ";".join(reversed(frames))
+
+        self.samples_taken += 1
+        self._pending[location] = self._pending.get(location, 0) + 1
+
+        offender = self.offenders.get(collapsed)
+        if offender is None:
+            if len(self.offenders) >= MAX_OFFENDERS:
+                # Вытесняем самый редкий стек, чтобы словарь не рос бесконечно
+                rarest = min(self.offenders, key=lambda key: self.offenders[key]["samples"])
+                del self.offenders[rarest]
+            offender = self.offenders[collapsed] = {"location": location, "samples": 0, "last_seen": 0}
+        offender["samples"] += 1
+        offender["last_seen"] = round(time.time(), 3)
+
+    def lag_ms(self):
+        """Последний замер задержки, мс"""
+        return round(self.lags[-1], 1) if self.lags else None
+
+    def max_lag_ms(self, last=600):
+        """Максимальная задержка по последним замерам, мс"""
+        recent = list(self.lags)[-last:]
+        return round(max(recent), 1) if recent else None
+
+    def snapshot(self, top=10):
+        """
+        Сводка для /debug/loop.
+
+        :param top: Сколько самых частых стеков вернуть
+        """
+        lags = sorted(self.lags)
+        # Копия: поток-сторож может добавлять стеки во время сборки сводки
+        offenders = sorted(list(self.offenders.items()), key=lambda item: item[1]["samples"], reverse=True)[:top]
+        return {
+            "heartbeat_ms": self.heartbeat * 1000,
+            "stall_threshold_ms": self.stall_threshold * 1000,
+            "lag_ms": {
+                "last": self.lag_ms(),
+                "p50": _percentile(lags, 0.5),
+                "p90": _percentile(lags, 0.9),
+                "p99": _percentile(lags, 0.99),
+                "max": round(lags[-1], 1) if lags else None,
+                "samples": len(lags)
+            },
+            "stalls": self.stall_count,
+            "stack_samples": self.samples_taken,
+            "recent_stalls": list(self.stalls)[-top:],
+            "top_offenders": [
+                {
+                    **stats,
+                    # Оценка суммарного времени блокировки по числу образцов
+                    "blocked_ms_estimate": round(stats["samples"] * self.sample_interval * 1000),
+                    "stack": stack
+                }
+                for stack, stats in offenders
+            ]
+        }
+
+    def reset(self):
+        """Сбрасывает накопленные стеки и блокировки"""
+        self.offenders = {}
+        self.stalls.clear()
+        self.stall_count = 0
+        self.samples_taken = 0
+
+# Глобальный сторож цикла событий бота
+loop_watchdog = LoopWatchdog(
+    heartbeat=int(os.getenv("LOOP_HEARTBEAT_MS", "100")) / 1000,
+    stall_threshold=int(os.getenv("LOOP_STALL_MS", "100")) / 1000,
+    sample_interval=int(os.getenv("LOOP_SAMPLE_MS", "10")) / 1000
+)
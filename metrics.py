@@ -0,0 +1,282 @@
+"""
+Реестр метрик процесса в формате Prometheus.
+
+Счётчики, датчики и гистограммы хранятся в памяти процесса; запись значения - это
+поиск по словарю меток и сложение, без блокировок на горячем пути. Текстовый формат
+для /metrics собирается только при запросе скрапера.
+
+    from metrics import LLM_REQUEST_DURATION
+    LLM_REQUEST_DURATION.labels(url, model, "200").observe(0.42)
+"""
+import time
+import threading
+from bisect import bisect_left
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Границы гистограмм по умолчанию в секундах: от обработчиков в миллисекунды до запросов к LLM
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30)
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+class _CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+class _GaugeChild:
+    __slots__ = ("value", "function")
+
+    def __init__(self):
+        self.value = 0
+        self.function = None
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set_function(self, function):
+        """Значение вычисляется при каждом сборе метрик (например, число сессий)"""
+        self.function = function
+
+    def get(self):
+        if self.function is not None:
+            try:
+                return self.function()
+            except Exception:
+                return float("nan")
+        return self.value
+
+class _HistogramChild:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self):
+        """Контекстный менеджер для замера длительности блока"""
+        return _Timer(self)
+
+class _Timer:
+    __slots__ = ("child", "started")
+
+    def __init__(self, child):
+        self.child = child
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.child.observe(time.perf_counter() - self.started)
+
+class Metric:
+    """Метрика с набором меток; значения по каждому сочетанию меток хранятся в дочерних объектах"""
+
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+        self.lock = threading.Lock()
+        if not self.labelnames:
+            self.children[()] = self._new_child()
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        """Возвращает значение метрики для сочетания меток (значения меток - строки)"""
+        child = self.children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"Метрика {self.name} ожидает метки {self.labelnames}")
+            with self.lock:
+                child = self.children.setdefault(values, self._new_child())
+        return child
+
+    def _samples(self):
+        raise NotImplementedError
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return lines
+
+    def _items(self):
+        # Копия, так как новые сочетания меток могут добавляться во время сбора
+        return list(self.children.items())
+
+class Counter(Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self.children[()].inc(amount)
+
+    def _samples(self):
+        for values, child in self._items():
+            yield f"{self.name}_total{_format_labels(self.labelnames, values)} {_format_value(child.value)}"
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value):
+        self.children[()].set(value)
+
+    def inc(self, amount=1):
+        self.children[()].inc(amount)
+
+    def dec(self, amount=1):
+        self.children[()].dec(amount)
+
+    def set_function(self, function):
+        self.children[()].set_function(function)
+
+    def get(self):
+        return self.children[()].get()
+
+    def _samples(self):
+        for values, child in self._items():
+            yield f"{self.name}{_format_labels(self.labelnames, values)} {_format_value(child.get())}"
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self.children[()].observe(value)
+
+    def time(self):
+        return self.children[()].time()
+
+    def _samples(self):
+        for values, child in self._items():
+            cumulative = 0
+            counts = list(child.counts)
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = f'le="{_format_value(float(bound))}"'
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, values, le)} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, values)} {_format_value(child.sum)}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, values)} {child.count}"
+
+class Registry:
+    """Набор метрик процесса"""
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def _register(self, metric):
+        with self.lock:
+            existing = self.metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self.metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        """Все метрики в текстовом формате Prometheus"""
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+# Глобальный реестр процесса
+registry = Registry()
+
+# Метрики бота
+HANDLER_DURATION = registry.histogram(
+    "bot_handler_duration_seconds", "Время обработки обновления обработчиком", ["handler"])
+HANDLER_ERRORS = registry.counter(
+    "bot_handler_errors", "Исключения в обработчиках обновлений", ["handler"])
+SESSIONS = registry.gauge(
+    "bot_sessions", "Число пользовательских сессий в памяти")
+BACKLOG_UPDATES = registry.counter(
+    "bot_backlog_updates", "Обновления, накопившиеся за время простоя бота, по исходу разбора", ["outcome"])
+
+LLM_REQUEST_DURATION = registry.histogram(
+    "llm_request_duration_seconds", "Длительность попытки запроса к LLM", ["url", "model", "status"])
+LLM_QUEUE_DEPTH = registry.gauge(
+    "llm_queue_depth", "Запросы к LLM, ожидающие RateLimiter или свободный слот")
+LLM_IN_FLIGHT = registry.gauge(
+    "llm_in_flight", "Запросы к LLM, выполняющиеся в данный момент")
+LLM_FALLBACKS = registry.counter(
+    "llm_fallback_responses", "Ответы локального генератора вместо модели")
+LLM_PROMPT_TOKENS = registry.counter(
+    "llm_prompt_tokens", "Токены промпта по данным провайдера", ["model"])
+LLM_CACHED_TOKENS = registry.counter(
+    "llm_cached_tokens", "Токены промпта, взятые провайдером из кэша", ["model"])
+LLM_LOCAL_EDITS = registry.counter(
+    "llm_local_edits", "Правки поста, выполненные без запроса к LLM")
+ADMISSION_DECISIONS = registry.counter(
+    "llm_admission_decisions", "Решения о допуске запросов на генерацию", ["decision"])
+ADMISSION_ESTIMATED_WAIT = registry.gauge(
+    "llm_admission_estimated_wait_seconds", "Оценка ожидания генерации при последнем решении о допуске")
+
+TELEGRAM_API_DURATION = registry.histogram(
+    "telegram_api_duration_seconds", "Длительность вызова Bot API", ["method"])
+TELEGRAM_API_ERRORS = registry.counter(
+    "telegram_api_errors", "Ошибки вызовов Bot API", ["method", "error"])
+
+LOOP_LAG = registry.gauge(
+    "bot_event_loop_lag_seconds", "Задержка цикла событий бота по последнему замеру")
+LOOP_STALLS = registry.counter(
+    "bot_event_loop_stalls", "Блокировки цикла событий дольше порога")
+
+LOG_DROPPED = registry.gauge(
+    "log_dropped_records", "Записи лога, отброшенные из-за переполнения очереди")
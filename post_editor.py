@@ -0,0 +1,419 @@
+"""
+Инкрементальное редактирование постов.
+Разбивает пост на абзацы, выполняет механические правки без обращения к LLM
+и применяет структурированные патчи, полученные от модели.
+"""
+import json
+import re
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Обязательный хэштег, который должен оставаться в конце каждого поста
+MAIN_HASHTAG = "#ДвижениеПервых59"
+
+HASHTAG_PATTERN = re.compile(r"#[\w]+")
+
+# Порядковые числительные для указания номера абзаца
+ORDINALS = {
+    "перв": 1, "втор": 2, "трет": 3, "четверт": 4, "четвёрт": 4, "пят": 5,
+    "шест": 6, "седьм": 7, "восьм": 8, "девят": 9, "десят": 10,
+}
+
+DELETE_VERBS = r"(?:убери|удали|убрать|удалить|вычеркни|сотри)"
+ADD_VERBS = r"(?:добавь|добавить|допиши|вставь)"
+REPLACE_VERBS = r"(?:замени|заменить|поменяй|поменять|смени)"
+
+def split_paragraphs(text):
+    """Разбивает текст поста на непустые абзацы"""
+    if not text:
+        return []
+    return [p.strip() for p in re.split(r"\n\s*\n", text.strip()) if p.strip()]
+
+def join_paragraphs(paragraphs):
+    """Собирает пост из абзацев"""
+    return "\n\n".join(paragraphs)
+
+def number_paragraphs(paragraphs, ids=None):
+    """Возвращает абзацы с номерами для передачи модели"""
+    ids = ids or range(1, len(paragraphs) + 1)
+    return "\n\n".join(f"[{i}] {p}" for i, p in zip(ids, paragraphs))
+
+def is_hashtag_paragraph(paragraph):
+    """Проверяет, состоит ли абзац только из хэштегов"""
+    return bool(paragraph) and not HASHTAG_PATTERN.sub("", paragraph).strip()
+
+def ensure_main_hashtag(text):
+    """Гарантирует наличие основного хэштега в конце поста"""
+    if MAIN_HASHTAG in text:
+        return text
+    paragraphs = split_paragraphs(text)
+    if paragraphs and is_hashtag_paragraph(paragraphs[-1]):
+        paragraphs[-1] = f"{paragraphs[-1]} {MAIN_HASHTAG}"
+        return join_paragraphs(paragraphs)
+    return f"{text.rstrip()}\n\n{MAIN_HASHTAG}"
+
+def _content_indexes(paragraphs):
+    """Индексы абзацев с текстом (без блока хэштегов в конце)"""
+    indexes = list(range(len(paragraphs)))
+    if indexes and is_hashtag_paragraph(paragraphs[-1]):
+        indexes = indexes[:-1]
+    return indexes
+
+# Номер абзаца в запросе: "последний", "второй", "2", "2-й", "№2"
+POSITION = r"(?:предпоследн\w*|последн\w*|[а-яё]+(?:ый|ой|ий)|\d+(?:-?[а-я]{1,2})?|№\s*\d+)"
+TAG = r"#\w+"
+TAGS = rf"{TAG}(?:\s*,?\s*(?:и\s+)?{TAG})*"
+HASHTAG_WORD = r"(?:(?:х[эе]ш)?тег\w*)"
+
+# Механические правки распознаются только по запросу целиком: всё, что не укладывается в
+# шаблон ("убери во втором абзаце лишнюю фразу", "добавь абзац про итоги #спорт"), уходит модели
+REPLACE_HASHTAG_REQUEST = re.compile(
+    rf"{REPLACE_VERBS}\s+(?:{HASHTAG_WORD}\s+)?({TAG})\s+на\s+(?:{HASHTAG_WORD}\s+)?({TAG})", re.IGNORECASE)
+DELETE_HASHTAG_REQUEST = re.compile(rf"{DELETE_VERBS}\s+(?:{HASHTAG_WORD}\s+)?({TAG})", re.IGNORECASE)
+ADD_HASHTAGS_REQUEST = re.compile(rf"(?:{ADD_VERBS}\s+(?:{HASHTAG_WORD}\s+)?)?({TAGS})", re.IGNORECASE)
+ADD_LINK_REQUEST = re.compile(rf"{ADD_VERBS}\s+ссылку(?:\s+на\s+[^\s:]+)?\s*:?\s*(https?://\S+)", re.IGNORECASE)
+DELETE_PARAGRAPH_REQUEST = re.compile(
+    rf"{DELETE_VERBS}\s+(?:({POSITION})\s+абзац|абзац\s+(?:номер\s+)?({POSITION}))", re.IGNORECASE)
+
+def _parse_paragraph_position(position, paragraphs):
+    """Определяет индекс абзаца по номеру из запроса ("последний", "второй", "2") или None"""
+    indexes = _content_indexes(paragraphs)
+    if not indexes:
+        return None
+
+    position = position.lower()
+    if position.startswith("предпоследн"):
+        return indexes[-2] if len(indexes) > 1 else None
+    if position.startswith("последн"):
+        return indexes[-1]
+
+    number = re.search(r"\d+", position)
+    if number:
+        position = int(number.group(0))
+    else:
+        for stem, value in ORDINALS.items():
+            if position.startswith(stem):
+                position = value
+                break
+        else:
+            return None
+
+    if 1 <= position <= len(indexes):
+        return indexes[position - 1]
+    return None
+
+def _normalize_hashtag(tag):
+    return tag if tag.startswith("#") else f"#{tag}"
+
+def _replace_hashtag(text, old, new):
+    """Заменяет хэштег целиком, не задевая более длинные хэштеги с тем же началом"""
+    return re.sub(rf"{re.escape(old)}(?![\w])", new, text)
+
+def _remove_hashtag(paragraphs, tag):
+    result = []
+    for paragraph in paragraphs:
+        cleaned = _replace_hashtag(paragraph, tag, "")
+        cleaned = re.sub(r"[ \t]{2,}", " ", cleaned).strip()
+        if cleaned:
+            result.append(cleaned)
+    return result
+
+def try_mechanical_edit(current_post, modification_request):
+    """
+    Пытается выполнить правку без обращения к модели.
+
+    Поддерживаются удаление абзаца по номеру, замена, удаление и добавление
+    хэштега, добавление ссылки с явно указанным URL. Запрос должен целиком
+    совпадать с одним из шаблонов, иначе правку выполняет модель.
+
+    :param current_post: Текущий текст поста
+    :param modification_request: Запрос пользователя на изменение
+    :return: Отредактированный пост или None, если правка требует LLM
+    """
+    if not current_post or not modification_request:
+        return None
+
+    request = re.sub(r"\s+", " ", modification_request).strip().rstrip(".!")
+    paragraphs = split_paragraphs(current_post)
+
+    # Замена хэштега: "замени #A на #B"
+    match = REPLACE_HASHTAG_REQUEST.fullmatch(request)
+    if match:
+        old, new = match.groups()
+        if old not in current_post:
+            return None
+        logger.info(f"Механическая правка: замена хэштега {old} на {new}")
+        return ensure_main_hashtag(_replace_hashtag(current_post, old, new))
+
+    # Удаление хэштега: "убери #A"
+    match = DELETE_HASHTAG_REQUEST.fullmatch(request)
+    if match:
+        tag = match.group(1)
+        if tag not in current_post or tag == MAIN_HASHTAG:
+            return None
+        logger.info(f"Механическая правка: удаление хэштега {tag}")
+        return ensure_main_hashtag(join_paragraphs(_remove_hashtag(paragraphs, tag)))
+
+    # Добавление хэштегов: "добавь хештег #A", "#A #B"
+    match = ADD_HASHTAGS_REQUEST.fullmatch(request)
+    if match:
+        tags = HASHTAG_PATTERN.findall(match.group(1))
+        new_tags = [_normalize_hashtag(t) for t in tags if t not in current_post]
+        if not new_tags:
+            return current_post
+        logger.info(f"Механическая правка: добавление хэштегов {new_tags}")
+        if paragraphs and is_hashtag_paragraph(paragraphs[-1]):
+            paragraphs[-1] = " ".join(new_tags + [paragraphs[-1]])
+        else:
+            paragraphs.append(" ".join(new_tags + [MAIN_HASHTAG]))
+        return ensure_main_hashtag(join_paragraphs(paragraphs))
+
+    # Добавление ссылки с явным URL: "добавь ссылку https://..."
+    match = ADD_LINK_REQUEST.fullmatch(request)
+    if match:
+        url = match.group(1).rstrip(".,;)")
+        if url in current_post:
+            return current_post
+        logger.info(f"Механическая правка: добавление ссылки {url}")
+        position = len(paragraphs)
+        if paragraphs and is_hashtag_paragraph(paragraphs[-1]):
+            position -= 1
+        paragraphs.insert(position, f"Подробнее: {url}")
+        return ensure_main_hashtag(join_paragraphs(paragraphs))
+
+    # Удаление абзаца: "убери последний абзац", "удали 2 абзац", "удали абзац 3"
+    match = DELETE_PARAGRAPH_REQUEST.fullmatch(request)
+    if match:
+        index = _parse_paragraph_position(match.group(1) or match.group(2), paragraphs)
+        if index is None or len(_content_indexes(paragraphs)) < 2:
+            return None
+        logger.info(f"Механическая правка: удаление абзаца {index + 1}")
+        del paragraphs[index]
+        return ensure_main_hashtag(join_paragraphs(paragraphs))
+
+    return None
+
+def _extract_json(response_text):
+    """Извлекает JSON из ответа модели (в том числе из блока ```json```)"""
+    if not response_text:
+        return None
+    fenced = re.search(r"```(?:json)?\s*(.*?)```", response_text, flags=re.DOTALL)
+    candidate = fenced.group(1) if fenced else response_text
+    start = min((i for i in (candidate.find("{"), candidate.find("[")) if i >= 0), default=-1)
+    if start < 0:
+        return None
+    try:
+        value, _ = json.JSONDecoder().raw_decode(candidate[start:])
+        return value
+    except json.JSONDecodeError:
+        return None
+
+def parse_patch(response_text):
+    """
+    Разбирает структурированный патч из ответа модели.
+
+    Ожидаемый формат: {"ops": [{"op": "replace", "index": 2, "text": "..."},
+    {"op": "delete", "index": 3}, {"op": "insert", "after": 1, "text": "..."}]}.
+    Номера абзацев считаются от 1 и относятся к исходному посту.
+
+    :return: Список операций или None, если ответ не является патчем
+    """
+    data = _extract_json(response_text)
+    if isinstance(data, dict):
+        data = data.get("ops")
+    if not isinstance(data, list):
+        return None
+    ops = []
+    for op in data:
+        if not isinstance(op, dict) or op.get("op") not in ("replace", "delete", "insert"):
+            return None
+        ops.append(op)
+    return ops
+
+def apply_patch(paragraphs, ops, ids=None):
+    """
+    Применяет операции патча к списку абзацев.
+
+    Номера в операциях - это номера абзацев, под которыми модель их видела.
+    Вставленным абзацам присваиваются новые номера, они записываются в поле
+    "id" соответствующей операции. Текст из нескольких абзацев разбивается,
+    каждый абзац получает свой номер, а номера всех частей записываются в поле "ids".
+
+    :param paragraphs: Абзацы поста
+    :param ops: Операции патча
+    :param ids: Номера абзацев (по умолчанию 1..N)
+    :return: Кортеж (абзацы, номера абзацев) после применения патча
+    :raises ValueError: если операция ссылается на несуществующий абзац
+                        или номеров абзацев не столько же, сколько абзацев
+    """
+    ids = list(ids) if ids else list(range(1, len(paragraphs) + 1))
+    if len(ids) != len(paragraphs):
+        raise ValueError(f"Номеров абзацев {len(ids)}, а абзацев {len(paragraphs)}")
+    known_ids = set(ids)
+    next_id = max(ids, default=0) + 1
+    replaced = {}
+    deleted = set()
+    inserted = {}
+
+    for op in ops:
+        kind = op["op"]
+        if kind == "delete":
+            index = int(op.get("index", 0))
+            if index not in known_ids:
+                raise ValueError(f"Некорректный номер абзаца: {index}")
+            deleted.add(index)
+            continue
+
+        pieces = split_paragraphs(str(op.get("text", "")))
+        if kind == "insert":
+            after = int(op.get("after", ids[-1] if ids else 0))
+            if after != 0 and after not in known_ids:
+                raise ValueError(f"Некорректная позиция вставки: {after}")
+            piece_ids = list(range(next_id, next_id + len(pieces)))
+            next_id += len(pieces)
+            if piece_ids:
+                op["id"] = piece_ids[0]
+            inserted.setdefault(after, []).extend(zip(piece_ids, pieces))
+        else:
+            index = int(op.get("index", 0))
+            if index not in known_ids:
+                raise ValueError(f"Некорректный номер абзаца: {index}")
+            # Первый абзац замены сохраняет номер заменяемого, остальные получают новые
+            piece_ids = [index] + list(range(next_id, next_id + len(pieces) - 1))
+            next_id += max(0, len(pieces) - 1)
+            replaced[index] = list(zip(piece_ids, pieces))
+        if len(pieces) > 1:
+            op["ids"] = piece_ids
+
+    result = list(inserted.get(0, []))
+    for paragraph_id, paragraph in zip(ids, paragraphs):
+        if paragraph_id in replaced:
+            result.extend(replaced[paragraph_id])
+        elif paragraph_id not in deleted:
+            result.append((paragraph_id, paragraph))
+        result.extend(inserted.get(paragraph_id, []))
+
+    return [text for _, text in result], [paragraph_id for paragraph_id, _ in result]
+
+def apply_patch_response(paragraphs, response_text, ids=None):
+    """Применяет патч из ответа модели; возвращает текст поста или None"""
+    ops = parse_patch(response_text)
+    if ops is None:
+        return None
+    try:
+        patched, _ = apply_patch(paragraphs, ops, ids)
+    except (ValueError, TypeError) as e:
+        logger.warning(f"Не удалось применить патч: {e}")
+        return None
+    if not patched:
+        return None
+    logger.info(f"Применён патч из {len(ops)} операций к посту из {len(paragraphs)} абзацев")
+    return ensure_main_hashtag(join_paragraphs(patched))
+
+class EditSession:
+    """
+    История диалогового редактирования одного поста.
+
+    Хранит компактную историю сообщений (запросы пользователя и патчи модели),
+    чтобы каждый следующий запрос к API отличался от предыдущего только
+    добавленными в конец сообщениями. Старые запросы сворачиваются в краткое
+    содержание, после чего окно истории начинается заново.
+    """
+
+    def __init__(self, max_turns=4, summary_size=10):
+        """
+        :param max_turns: Количество правок, хранимых в истории дословно
+        :param summary_size: Количество старых запросов в кратком содержании
+        """
+        self.max_turns = max_turns
+        self.summary_size = summary_size
+        self.history = []  # Сообщения без системного промпта
+        self.summary = []  # Краткое содержание старых запросов
+        self.requests = []  # Запросы в текущем окне истории
+        self.paragraph_ids = []  # Номера абзацев текущего поста, известные модели
+        self.synced_post = None  # Версия поста, которую модель видела последней
+        self.sent_count = 0  # Сколько сообщений истории модель уже получила
+
+    def record_request(self, request):
+        """Запоминает запрос, выполненный без участия модели в истории"""
+        self.requests.append(request)
+
+    def _compact(self):
+        """Сворачивает текущее окно истории в краткое содержание"""
+        for request in self.requests:
+            short = request if len(request) <= 150 else request[:147] + "..."
+            self.summary.append(short)
+        self.summary = self.summary[-self.summary_size:]
+        self.requests = []
+        self.history = []
+        self.sent_count = 0
+
+    def prepare_turn(self, current_post, request):
+        """
+        Готовит сообщения для очередной правки.
+
+        :return: Кортеж (история, новое сообщение пользователя, абзацы, номера абзацев)
+        """
+        paragraphs = split_paragraphs(current_post)
+        # Номера, не совпадающие с абзацами, привели бы патч не к тем абзацам - начинаем заново
+        in_sync = self.history and self.synced_post == current_post and len(self.paragraph_ids) == len(paragraphs)
+        if in_sync and len(self.requests) < self.max_turns:
+            # Модель уже знает текущую версию поста - отправляем только запрос
+            return list(self.history), f"Требуемые изменения: {request}", paragraphs, self.paragraph_ids
+
+        # Начинаем новое окно: краткое содержание + пост целиком
+        self._compact()
+        self.paragraph_ids = list(range(1, len(paragraphs) + 1))
+        self.synced_post = current_post
+        summary_block = ""
+        if self.summary:
+            previous = "; ".join(f"{i}) {r}" for i, r in enumerate(self.summary, 1))
+            summary_block = f"Ранее пользователь уже просил: {previous}\n\n"
+        user_message = (
+            f"{summary_block}Текущий пост по абзацам:\n\n"
+            f"{number_paragraphs(paragraphs, self.paragraph_ids)}\n\n"
+            f"Требуемые изменения: {request}"
+        )
+        return [], user_message, paragraphs, self.paragraph_ids
+
+    def new_messages(self, user_message):
+        """Сообщения, которых не было в предыдущем запросе к модели"""
+        return self.history[self.sent_count:] + [{"role": "user", "content": user_message}]
+
+    def apply_response(self, request, user_message, paragraphs, ids, response_text):
+        """
+        Применяет патч из ответа модели и добавляет правку в историю.
+
+        :return: Текст отредактированного поста или None, если ответ не патч
+        """
+        self.requests.append(request)
+        ops = parse_patch(response_text)
+        if ops is None:
+            return None
+        try:
+            patched, patched_ids = apply_patch(paragraphs, ops, ids)
+        except (ValueError, TypeError) as e:
+            logger.warning(f"Не удалось применить патч: {e}")
+            return None
+        if not patched:
+            return None
+
+        new_post = ensure_main_hashtag(join_paragraphs(patched))
+        if new_post != join_paragraphs(patched) or len(split_paragraphs(new_post)) != len(patched_ids):
+            # Хэштег добавлен локально или абзацы разбились иначе - модель об этом не знает, синхронизируем заново
+            self.synced_post = None
+        else:
+            self.synced_post = new_post
+        self.paragraph_ids = patched_ids
+
+        # В истории храним нормализованный патч с номерами вставленных абзацев
+        self.history.append({"role": "user", "content": user_message})
+        self.history.append({
+            "role": "assistant",
+            "content": json.dumps({"ops": ops}, ensure_ascii=False, separators=(",", ":"))
+        })
+        # Ответ модели и следующий запрос - единственное, чего не было в этом запросе
+        self.sent_count = len(self.history) - 1
+        logger.info(f"Применён патч из {len(ops)} операций, правок в истории: {len(self.requests)}")
+        return new_post
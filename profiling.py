@@ -0,0 +1,198 @@
+"""
+Профилирование процесса бота по запросу, без перезапуска.
+
+Выключено по умолчанию. Включается переменными окружения:
+    PROFILING_ENABLED=1       - зарегистрировать эндпоинты
+    PROFILING_TOKEN=<секрет>  - обязателен; передаётся в ?token= или заголовке X-Debug-Token
+    PROFILING_MAX_SECONDS     - максимальная длительность одного замера (60)
+
+Эндпоинты (одновременно выполняется только один замер, остальные получают 409):
+    /debug/profile/cpu?seconds=10&interval_ms=5&threads=loop|all&idle=0
+        Сэмплирующий профиль CPU: стеки снимаются из отдельного потока через
+        sys._current_frames, код бота не инструментируется. Ответ - свёрнутые стеки
+        (одна строка "кадр;кадр;кадр число"), их понимают flamegraph.pl и speedscope.
+    /debug/profile/memory?seconds=30&top=25&group=lineno|traceback
+        Разница двух снимков tracemalloc: какие строки выделили память за время замера.
+        tracemalloc включается только на время замера.
+"""
+import os
+import sys
+import hmac
+import time
+import asyncio
+import logging
+import threading
+import tracemalloc
+
+from aiohttp import web
+
+logger = logging.getLogger("profiling")
+
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "0") == "1"
+PROFILING_TOKEN = os.getenv("PROFILING_TOKEN", "")
+MAX_SECONDS = float(os.getenv("PROFILING_MAX_SECONDS", "60"))
+# Кадров в одном стеке не больше этого числа (ближайшие к месту выполнения)
+MAX_STACK_DEPTH = 64
+# Функции, в которых цикл событий ждёт ввода-вывода: такие образцы - простой, а не работа
+IDLE_FUNCTIONS = {"select", "wait", "_worker"}
+
+_profile_lock = asyncio.Lock()
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+
+def collapse_stack(frame, limit=MAX_STACK_DEPTH):
+    """Стек от внешнего кадра к внутреннему в виде строки "кадр;кадр;кадр" """
+    labels = []
+    while frame is not None and len(labels) < limit:
+        labels.append(_frame_label(frame))
+        frame = frame.f_back
+    return ";".join(reversed(labels))
+
+def sample_cpu(seconds, interval, thread_ids=None, include_idle=False):
+    """
+    Снимает стеки потоков с заданным периодом (выполняется в отдельном потоке).
+
+    :param seconds: Длительность замера
+    :param interval: Период снятия стеков, секунды
+    :param thread_ids: Идентификаторы потоков (None - все, кроме самого профилировщика)
+    :param include_idle: Учитывать ли образцы, где поток ждёт ввода-вывода
+    :return: Словарь {свёрнутый стек: число образцов} и число снятых образцов
+    """
+    own_id = threading.get_ident()
+    names = {thread.ident: thread.name for thread in threading.enumerate()}
+    stacks = {}
+    samples = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        frames = sys._current_frames()
+        for thread_id, frame in frames.items():
+            if thread_id == own_id or (thread_ids is not None and thread_id not in thread_ids):
+                continue
+            if not include_idle and frame.f_code.co_name in IDLE_FUNCTIONS:
+                continue
+            key = f"{names.get(thread_id, thread_id)};{collapse_stack(frame)}"
+            stacks[key] = stacks.get(key, 0) + 1
+        # Кадры держат ссылки на локальные переменные потоков
+        del frames
+        samples += 1
+        time.sleep(interval)
+    return stacks, samples
+
+def memory_diff(seconds, top, group, frames):
+    """
+    Сравнивает снимки tracemalloc в начале и в конце замера (выполняется в отдельном потоке).
+
+    :return: Самые крупные изменения выделенной памяти и общая статистика
+    """
+    started_here = not tracemalloc.is_tracing()
+    if started_here:
+        tracemalloc.start(frames)
+    try:
+        filters = [
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<unknown>"),
+        ]
+        before = tracemalloc.take_snapshot().filter_traces(filters)
+        time.sleep(seconds)
+        after = tracemalloc.take_snapshot().filter_traces(filters)
+        current, peak = tracemalloc.get_traced_memory()
+        stats = after.compare_to(before, group)[:top]
+        return {
+            "seconds": seconds,
+            "group": group,
+            "traced_kb": round(current / 1024, 1),
+            "peak_kb": round(peak / 1024, 1),
+            "top": [
+                {
+                    "location": [f"{frame.filename}:{frame.lineno}" for frame in stat.traceback],
+                    "size_diff_kb": round(stat.size_diff / 1024, 1),
+                    "size_kb": round(stat.size / 1024, 1),
+                    "count_diff": stat.count_diff,
+                    "count": stat.count
+                }
+                for stat in stats
+            ]
+        }
+    finally:
+        if started_here:
+            tracemalloc.stop()
+
+def _authorized(request):
+    token = request.query.get("token") or request.headers.get("X-Debug-Token", "")
+    return bool(PROFILING_TOKEN) and hmac.compare_digest(token.encode(), PROFILING_TOKEN.encode())
+
+def _seconds(request, default):
+    seconds = float(request.query.get("seconds", default))
+    return max(0.1, min(seconds, MAX_SECONDS))
+
+async def _run_exclusive(function, *args):
+    """Выполняет замер в пуле потоков, если другой замер сейчас не идёт"""
+    if _profile_lock.locked():
+        return None, web.json_response({"error": "Замер уже выполняется"}, status=409)
+    async with _profile_lock:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, function, *args), None
+
+async def cpu_profile_handler(request):
+    if not _authorized(request):
+        return web.json_response({"error": "Неверный токен"}, status=403)
+    try:
+        seconds = _seconds(request, 10)
+        interval = max(1.0, float(request.query.get("interval_ms", 5))) / 1000
+    except ValueError:
+        return web.json_response({"error": "seconds и interval_ms должны быть числами"}, status=400)
+    # По умолчанию профилируется поток цикла событий, где выполняются обработчики
+    thread_ids = None if request.query.get("threads") == "all" else {threading.get_ident()}
+    include_idle = request.query.get("idle", "0") == "1"
+
+    logger.info(f"Профилирование CPU на {seconds} с, период {interval * 1000:.0f} мс")
+    result, error = await _run_exclusive(sample_cpu, seconds, interval, thread_ids, include_idle)
+    if error is not None:
+        return error
+    stacks, samples = result
+    lines = [f"{stack} {count}" for stack, count in sorted(stacks.items(), key=lambda item: item[1], reverse=True)]
+    return web.Response(
+        text="\n".join(lines) + "\n",
+        headers={"X-Profile-Samples": str(samples), "X-Profile-Interval-Ms": f"{interval * 1000:g}"}
+    )
+
+async def memory_profile_handler(request):
+    if not _authorized(request):
+        return web.json_response({"error": "Неверный токен"}, status=403)
+    try:
+        seconds = _seconds(request, 30)
+        top = min(int(request.query.get("top", 25)), 200)
+        frames = min(int(request.query.get("frames", 1)), 25)
+    except ValueError:
+        return web.json_response({"error": "seconds, top и frames должны быть числами"}, status=400)
+    group = request.query.get("group", "lineno")
+    if group not in ("lineno", "traceback", "filename"):
+        return web.json_response({"error": "group: lineno, traceback или filename"}, status=400)
+    if group == "traceback":
+        frames = max(frames, 10)
+
+    logger.info(f"Профилирование памяти на {seconds} с, группировка {group}")
+    result, error = await _run_exclusive(memory_diff, seconds, top, group, frames)
+    if error is not None:
+        return error
+    return web.json_response(result)
+
+def add_profiling_routes(app):
+    """
+    Регистрирует эндпоинты профилирования, если они включены и задан токен.
+
+    :param app: Приложение aiohttp
+    :return: True, если эндпоинты зарегистрированы
+    """
+    if not PROFILING_ENABLED:
+        return False
+    if not PROFILING_TOKEN:
+        logger.warning("PROFILING_ENABLED=1, но PROFILING_TOKEN не задан: профилирование отключено")
+        return False
+    app.router.add_get('/debug/profile/cpu', cpu_profile_handler)
+    app.router.add_get('/debug/profile/memory', memory_profile_handler)
+    logger.info("Эндпоинты профилирования включены: /debug/profile/cpu, /debug/profile/memory")
+    return True
@@ -32,6 +32,43 @@ RDDM_INFO = {
     """
 }
 
+# Датасет направлений и хэштегов
+RDDM_DATASET = {
+    "F&Q": [
+        "Движение Первых. Экология, #ЭкологияПервых",
+        "Движение Первых. Профессия, #ПрофессияПервых",
+        "Движение Первых. Путешествия, #ПутешествияПервых",
+        "Движение Первых. Добро, #ДоброПервых",
+        "Движение Первых. Наука, #НаукаПервых",
+        "КВН Первые | Движение Первых, #КВНПервые",
+        "Движение Первых. Спорт и ЗОЖ, #СпортЗОЖПервых",
+        "Движение Первых. Патриоты, #ПатриотыПервых",
+        "Движение Первых. Творчество, #ТворчествоПервых",
+        "Движение Первых. Дипломаты, #ДипломатыПервых",
+        "Гранты | Движение Первых, #грантыПервых"
+    ],
+    "HASHTAGS": {
+        "Мы - граждане России": {
+            "description": "Программа «Мы – граждане России!» реализуется совместно с Министерством внутренних дел РФ",
+            "link": "https://vk.com/club26323016",
+            "hashtag": "#МыГражданеРоссии"
+        },
+        "Хранители истории": {
+            "hashtag": "#ХранителиИстории"
+        },
+        "Классные встречи": {
+            "hashtag": "#КлассныеВстречи",
+            "link": "https://vk.com/klassnye_vstrechi"
+        },
+        "Первая помощь": {
+            "hashtag": "#ПервыеПомогают"
+        },
+        "Зарница": {
+            "hashtag": "#ЗарницаПервых"
+        }
+    }
+}
+
 def get_rddm_knowledge(topic=None):
     """
     Возвращает информацию о РДДМ по запрошенной теме или базовый набор информации.
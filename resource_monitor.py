@@ -4,22 +4,17 @@
 Отслеживает использование CPU и памяти, отправляет уведомления
 """
 import os
-import asyncio
 import logging
 import time
 import json
+from array import array
+from collections import deque
 from datetime import datetime
 import threading
+from urllib.parse import urlparse, parse_qs
+
+from alerts import alert_dispatcher
 
-# Настройка логирования
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler("monitor.log"),
-        logging.StreamHandler()
-    ]
-)
 logger = logging.getLogger("resource_monitor")
 
 try:
@@ -29,10 +24,122 @@ except ImportError:
     logger.warning("psutil не установлен, мониторинг ресурсов будет ограничен")
     PSUTIL_AVAILABLE = False
 
+class RingBuffer:
+    """Кольцевой буфер фиксированного размера: по типизированному массиву на каждое поле"""
+    
+    def __init__(self, capacity, fields):
+        """
+        :param capacity: Максимальное число точек
+        :param fields: Имена полей точки (кроме метки времени ts)
+        """
+        self.capacity = capacity
+        self.fields = ("ts",) + tuple(fields)
+        self.columns = [array("d", bytes(8 * capacity)) for _ in self.fields]
+        self.start = 0  # Позиция самой старой точки
+        self.count = 0
+    
+    def append(self, ts, *values):
+        """Добавляет точку, вытесняя самую старую при заполнении"""
+        position = (self.start + self.count) % self.capacity
+        if self.count == self.capacity:
+            self.start = (self.start + 1) % self.capacity
+        else:
+            self.count += 1
+        self.columns[0][position] = ts
+        for column, value in zip(self.columns[1:], values):
+            column[position] = value
+    
+    def _first_after(self, since):
+        """Номер первой (в порядке записи) точки с меткой времени больше since"""
+        timestamps = self.columns[0]
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if timestamps[(self.start + middle) % self.capacity] <= since:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+    
+    def since(self, since=None):
+        """
+        Точки новее since в колоночном виде: {"ts": [...], "cpu": [...], ...}
+        
+        :param since: Метка времени; None - все точки
+        """
+        first = self._first_after(since) if since is not None else 0
+        positions = [(self.start + i) % self.capacity for i in range(first, self.count)]
+        return {name: [round(column[p], 3) for p in positions] for name, column in zip(self.fields, self.columns)}
+    
+    def __len__(self):
+        return self.count
+
+class Rollup:
+    """Агрегаты min/avg/max по интервалам фиксированной длины"""
+    
+    def __init__(self, resolution, capacity, metrics=("cpu", "memory")):
+        """
+        :param resolution: Длина интервала в секундах
+        :param capacity: Сколько завершённых интервалов хранить
+        :param metrics: Агрегируемые показатели
+        """
+        self.resolution = resolution
+        self.metrics = metrics
+        self.buffer = RingBuffer(capacity, [f"{metric}_{agg}" for metric in metrics for agg in ("min", "avg", "max")])
+        self.bucket = None  # Начало текущего интервала
+        self.accumulators = None  # {показатель: [min, сумма, max, число точек]}
+    
+    def add(self, ts, values):
+        """Учитывает точку; завершённый интервал переносится в буфер"""
+        bucket = ts - ts % self.resolution
+        if bucket != self.bucket:
+            if self.bucket is not None:
+                self._flush()
+            self.bucket = bucket
+            self.accumulators = {metric: [float("inf"), 0.0, float("-inf"), 0] for metric in self.metrics}
+        for metric in self.metrics:
+            value = values[metric]
+            accumulator = self.accumulators[metric]
+            accumulator[0] = min(accumulator[0], value)
+            accumulator[1] += value
+            accumulator[2] = max(accumulator[2], value)
+            accumulator[3] += 1
+    
+    def _row(self):
+        """Агрегаты текущего интервала в порядке полей буфера"""
+        row = []
+        for metric in self.metrics:
+            low, total, high, count = self.accumulators[metric]
+            row.extend((low, total / count, high))
+        return row
+    
+    def _flush(self):
+        self.buffer.append(self.bucket, *self._row())
+    
+    def since(self, since=None):
+        """
+        Интервалы, закончившиеся после since, и текущий незавершённый интервал.
+        
+        Отбор по концу интервала: интервал, начавшийся до предыдущего опроса, но
+        завершённый после него, тоже попадает в ответ. Незавершённый интервал идёт
+        последним с признаком "partial"; при следующем опросе он придёт снова уже с
+        итоговыми значениями, если успел получить новые точки.
+        """
+        result = self.buffer.since(None if since is None else since - self.resolution)
+        result["partial"] = self.bucket is not None
+        if self.bucket is not None:
+            result["ts"].append(round(self.bucket, 3))
+            for name, value in zip(self.buffer.fields[1:], self._row()):
+                result[name].append(round(value, 3))
+        return result
+
+# Поля точки истории: система целиком и дерево процессов бота
+SAMPLE_FIELDS = ("cpu", "memory", "bot_cpu", "bot_rss_mb", "loop_lag_ms")
+
 class ResourceMonitor:
     def __init__(self, 
                  admin_chat_id=None, 
-                 check_interval=60, 
+                 check_interval=15, 
                  cpu_threshold=90, 
                  memory_threshold=90,
                  history_size=100):
@@ -58,10 +165,27 @@ class ResourceMonitor:
                 "cpu": 0,
                 "memory": 0,
                 "uptime": 0
-            },
-            "history": [],
-            "alerts": []
+            }
+        }
+        
+        # Процесс бота, дерево которого отслеживается отдельно, и источник его счётчиков
+        self.target_pid = None
+        self.stats_provider = None  # Функция без аргументов, возвращающая счётчики бота (stats_segment) или None
+        self._processes = {}  # {pid: psutil.Process}: cpu_percent считается по разнице между вызовами
+        self._last_cpu_times = None  # (простой, всего) из /proc/stat для режима без psutil
+        self._memory_available_mb = None
+        
+        # Сырые точки и агрегаты: 1 минута за сутки, 1 час за месяц, 1 день за год
+        self.history = RingBuffer(history_size, SAMPLE_FIELDS)
+        self.rollups = {
+            "1m": Rollup(60, 24 * 60, SAMPLE_FIELDS),
+            "1h": Rollup(3600, 31 * 24, SAMPLE_FIELDS),
+            "1d": Rollup(86400, 366, SAMPLE_FIELDS)
         }
+        self.alerts = deque(maxlen=20)
+        
+        # Готовый JSON полного статуса, пересобирается раз за проверку, а не на каждый запрос
+        self._snapshot = None
         
         # Флаг работы мониторинга
         self.is_running = False
@@ -81,6 +205,8 @@ class ResourceMonitor:
             return
         
         self.is_running = True
+        # Первый вызов cpu_percent без интервала только запоминает счётчики
+        self._get_resource_usage()
         threading.Thread(target=self._monitoring_loop, daemon=True).start()
         logger.info("Мониторинг ресурсов запущен")
     
@@ -95,28 +221,13 @@ class ResourceMonitor:
         
         while self.is_running:
             try:
-                # Получаем данные о ресурсах
+                # Получаем данные о ресурсах: без ожидания, по разнице с прошлой проверкой
                 cpu_percent, memory_percent = self._get_resource_usage()
+                bot = self._sample_process_tree()
                 uptime = int(time.time() - self.start_time)
                 
                 # Обновляем данные мониторинга
-                with self.lock:
-                    self.monitoring_data["last_update"] = time.time()
-                    self.monitoring_data["current"]["cpu"] = cpu_percent
-                    self.monitoring_data["current"]["memory"] = memory_percent
-                    self.monitoring_data["current"]["uptime"] = uptime
-                    
-                    # Добавляем точку в историю
-                    history_point = {
-                        "timestamp": time.time(),
-                        "cpu": cpu_percent,
-                        "memory": memory_percent
-                    }
-                    self.monitoring_data["history"].append(history_point)
-                    
-                    # Ограничиваем размер истории
-                    if len(self.monitoring_data["history"]) > self.history_size:
-                        self.monitoring_data["history"] = self.monitoring_data["history"][-self.history_size:]
+                self.record_sample(cpu_percent, memory_percent, uptime, bot=bot)
                 
                 # Логируем текущее состояние
                 if cpu_percent > 50 or memory_percent > 50:
@@ -130,22 +241,19 @@ class ResourceMonitor:
                 
                 if (cpu_percent > self.cpu_threshold or memory_percent > self.memory_threshold) and \
                    (current_time - last_alert_time > alert_cooldown):
-                    alert_message = self._generate_alert(cpu_percent, memory_percent)
+                    alert_message = self._generate_alert(cpu_percent, memory_percent, bot)
                     self._send_alert(alert_message)
                     last_alert_time = current_time
                     
-                    # Сохраняем алерт в историю
+                    # Сохраняем алерт в историю (хранятся последние 20)
                     with self.lock:
-                        self.monitoring_data["alerts"].append({
+                        self.alerts.append({
                             "timestamp": current_time,
                             "cpu": cpu_percent,
                             "memory": memory_percent,
                             "message": alert_message
                         })
-                        
-                        # Ограничиваем количество алертов в истории
-                        if len(self.monitoring_data["alerts"]) > 20:
-                            self.monitoring_data["alerts"] = self.monitoring_data["alerts"][-20:]
+                        self._snapshot = None
             
             except Exception as e:
                 logger.error(f"Ошибка в цикле мониторинга: {e}")
@@ -166,13 +274,17 @@ class ResourceMonitor:
                     memory_percent = 100 - (float(mem[0]) / float(mem[1]) * 100)
                     return cpu, memory_percent
                 else:
-                    # Для Linux используем /proc
+                    # Для Linux используем /proc: загрузка по разнице счётчиков с прошлой проверки
                     with open('/proc/stat', 'r') as f:
-                        cpu_lines = f.readlines()
-                    cpu_line = cpu_lines[0].split()
+                        cpu_line = f.readline().split()
                     cpu_idle = float(cpu_line[4])
                     cpu_total = sum(float(x) for x in cpu_line[1:])
-                    cpu_percent = 100 - (cpu_idle / cpu_total * 100)
+                    last_idle, last_total = self._last_cpu_times or (0.0, 0.0)
+                    self._last_cpu_times = (cpu_idle, cpu_total)
+                    if cpu_total > last_total:
+                        cpu_percent = 100 - ((cpu_idle - last_idle) / (cpu_total - last_total) * 100)
+                    else:
+                        cpu_percent = 0.0
                     
                     with open('/proc/meminfo', 'r') as f:
                         mem_lines = f.readlines()
@@ -185,63 +297,149 @@ class ResourceMonitor:
                 logger.error(f"Ошибка при получении данных о ресурсах: {e}")
                 return 0, 0
         else:
-            # Используем psutil если доступен
-            cpu_percent = psutil.cpu_percent(interval=1)
-            memory_percent = psutil.virtual_memory().percent
-            return cpu_percent, memory_percent
+            # Используем psutil если доступен; interval=None не блокирует поток
+            cpu_percent = psutil.cpu_percent(interval=None)
+            memory = psutil.virtual_memory()
+            self._memory_available_mb = round(memory.available / (1024 * 1024), 2)
+            return cpu_percent, memory.percent
     
-    def _generate_alert(self, cpu_percent, memory_percent):
+    def _sample_process_tree(self):
+        """
+        Ресурсы процесса бота вместе с дочерними процессами
+        
+        :return: Словарь с pid, числом процессов, RSS, CPU, дескрипторами, потоками и
+                 задержкой цикла событий, или None, если процесс бота не задан
+        """
+        sample = None
+        if PSUTIL_AVAILABLE and self.target_pid:
+            try:
+                root = psutil.Process(self.target_pid)
+                tree = [root] + root.children(recursive=True)
+            except psutil.Error:
+                tree = []
+            
+            processes = {}
+            sample = {"pid": self.target_pid, "processes": 0, "rss_mb": 0.0, "cpu_percent": 0.0, "fds": 0, "threads": 0}
+            for process in tree:
+                # Тот же объект Process между проверками: cpu_percent считается по разнице
+                process = self._processes.get(process.pid, process)
+                try:
+                    with process.oneshot():
+                        sample["rss_mb"] += process.memory_info().rss / (1024 * 1024)
+                        sample["cpu_percent"] += process.cpu_percent(interval=None)
+                        sample["threads"] += process.num_threads()
+                        if hasattr(process, "num_fds"):
+                            sample["fds"] += process.num_fds()
+                except psutil.Error:
+                    continue
+                processes[process.pid] = process
+                sample["processes"] += 1
+            self._processes = processes
+            sample["rss_mb"] = round(sample["rss_mb"], 1)
+            sample["cpu_percent"] = round(sample["cpu_percent"], 1)
+        
+        if self.stats_provider is not None:
+            try:
+                stats = self.stats_provider()
+            except Exception as e:
+                logger.debug(f"Не удалось прочитать счётчики бота: {e}")
+                stats = None
+            if stats is not None:
+                sample = sample or {"pid": self.target_pid}
+                sample["loop_lag_ms"] = stats["loop_lag_ms"]
+                sample["active_requests"] = stats["active_requests"]
+                sample["llm_queue"] = stats["llm_queue"]
+                sample["sessions"] = stats["sessions"]
+                sample["stats_stale"] = stats["stale"]
+        return sample
+    
+    def _generate_alert(self, cpu_percent, memory_percent, bot=None):
         """Генерация текста уведомления"""
         timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         message = f"⚠️ ВНИМАНИЕ! Высокая нагрузка ({timestamp}):\n"
         message += f"CPU: {cpu_percent:.1f}% (порог: {self.cpu_threshold}%)\n"
         message += f"RAM: {memory_percent:.1f}% (порог: {self.memory_threshold}%)\n"
         
-        # Добавляем информацию о процессах, если psutil доступен
-        if PSUTIL_AVAILABLE:
-            try:
-                # Получаем топ-5 процессов по CPU
-                processes = []
-                for proc in psutil.process_iter(['pid', 'name', 'cpu_percent', 'memory_percent']):
-                    processes.append(proc.info)
-                
-                # Сортируем по CPU
-                top_cpu = sorted(processes, key=lambda x: x['cpu_percent'], reverse=True)[:3]
-                
-                if top_cpu:
-                    message += "\nТоп процессы по CPU:\n"
-                    for proc in top_cpu:
-                        message += f"- {proc['name']} (PID: {proc['pid']}): CPU {proc['cpu_percent']:.1f}%, RAM {proc['memory_percent']:.1f}%\n"
-            except Exception as e:
-                logger.error(f"Ошибка при получении информации о процессах: {e}")
+        # Добавляем данные о процессе бота из последней проверки, без обхода всех процессов хоста
+        if bot:
+            message += f"\nБот (PID: {bot.get('pid')}, процессов: {bot.get('processes', 0)}): "
+            message += f"CPU {bot.get('cpu_percent', 0):.1f}%, RSS {bot.get('rss_mb', 0):.1f} МБ, "
+            message += f"потоков {bot.get('threads', 0)}, дескрипторов {bot.get('fds', 0)}"
+            if "loop_lag_ms" in bot:
+                message += f", задержка цикла событий {bot['loop_lag_ms']:.0f} мс"
+            if "active_requests" in bot:
+                message += f", запросов к LLM {bot['active_requests']} (в очереди {bot['llm_queue']}), сессий {bot['sessions']}"
+            if bot.get("stats_stale"):
+                message += ", счётчики не обновляются (процесс завис?)"
+            message += "\n"
         
         return message
     
     def _send_alert(self, message):
-        """Отправка уведомления"""
+        """Отправка уведомления: только постановка в очередь диспетчера, без ожидания сети"""
         logger.warning(f"АЛЕРТ: {message}")
         
         # Если настроен ID чата администратора, отправляем через Telegram
         if self.admin_chat_id:
-            try:
-                # Импортируем только при необходимости
-                from telegram import Bot
-                from config import BOT_TOKEN
-                
-                async def send_telegram_message():
-                    bot = Bot(token=BOT_TOKEN)
-                    await bot.send_message(chat_id=self.admin_chat_id, text=message, parse_mode='HTML')
-                
-                # Запускаем asyncio задачу
-                asyncio.run(send_telegram_message())
-                logger.info(f"Уведомление отправлено в Telegram (chat_id: {self.admin_chat_id})")
-            except Exception as e:
-                logger.error(f"Ошибка при отправке уведомления в Telegram: {e}")
+            alert_dispatcher.send(message, severity="warning", key="resources", chat_id=self.admin_chat_id)
     
-    def get_status(self):
-        """Получение текущего статуса для API"""
+    def record_sample(self, cpu_percent, memory_percent, uptime=None, timestamp=None, bot=None):
+        """Добавляет точку в историю и агрегаты"""
+        timestamp = timestamp or time.time()
+        bot = bot or {}
+        values = {
+            "cpu": cpu_percent,
+            "memory": memory_percent,
+            "bot_cpu": bot.get("cpu_percent", 0.0),
+            "bot_rss_mb": bot.get("rss_mb", 0.0),
+            "loop_lag_ms": bot.get("loop_lag_ms", 0.0)
+        }
         with self.lock:
-            return json.dumps(self.monitoring_data)
+            self.monitoring_data["last_update"] = timestamp
+            self.monitoring_data["current"]["cpu"] = cpu_percent
+            self.monitoring_data["current"]["memory"] = memory_percent
+            self.monitoring_data["current"]["bot"] = bot or None
+            if uptime is not None:
+                self.monitoring_data["current"]["uptime"] = uptime
+            
+            self.history.append(timestamp, *(values[field] for field in SAMPLE_FIELDS))
+            for rollup in self.rollups.values():
+                rollup.add(timestamp, values)
+            self._snapshot = None
+    
+    def last_sample(self):
+        """Последняя точка без обращения к системе - для проверок здоровья за O(1)"""
+        current = self.monitoring_data["current"]
+        return {
+            "timestamp": self.monitoring_data["last_update"],
+            "cpu_percent": current["cpu"],
+            "memory_percent": current["memory"],
+            "memory_available_mb": self._memory_available_mb,
+            "bot": current.get("bot")
+        }
+    
+    def _build_status(self, since=None):
+        return {
+            **self.monitoring_data,
+            "since": since,
+            "history": self.history.since(since),
+            "rollups": {name: rollup.since(since) for name, rollup in self.rollups.items()},
+            "alerts": [alert for alert in self.alerts if since is None or alert["timestamp"] > since]
+        }
+    
+    def get_status(self, since=None):
+        """
+        Получение текущего статуса для API
+        
+        :param since: Метка времени: вернуть только точки и агрегаты новее неё (для опроса дашбордом)
+        :return: JSON-строка; история в колоночном виде {"ts": [...], "cpu": [...], ...}
+        """
+        with self.lock:
+            if since is not None:
+                return json.dumps(self._build_status(since))
+            if self._snapshot is None:
+                self._snapshot = json.dumps(self._build_status())
+            return self._snapshot
 
 # Создаем глобальный экземпляр монитора
 monitor = ResourceMonitor()
@@ -257,11 +455,26 @@ def add_monitor_routes(server_handler_class):
     original_do_get = server_handler_class.do_GET
     
     def enhanced_do_get(self):
-        if self.path == "/monitor" or self.path == "/monitor/":
+        parsed_url = urlparse(self.path)
+        if parsed_url.path == "/monitor" or parsed_url.path == "/monitor/":
+            # /monitor?since=<ts> - только новые точки с момента предыдущего опроса
+            since = parse_qs(parsed_url.query).get("since", [None])[0]
+            try:
+                since = float(since) if since is not None else None
+            except ValueError:
+                body = b'{"error": "since must be a unix timestamp"}'
+                self.send_response(400)
+                self.send_header('Content-type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                return
+            body = monitor.get_status(since).encode()
             self.send_response(200)
             self.send_header('Content-type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
             self.end_headers()
-            self.wfile.write(monitor.get_status().encode())
+            self.wfile.write(body)
         else:
             original_do_get(self)
     
@@ -269,6 +482,9 @@ def add_monitor_routes(server_handler_class):
     return server_handler_class
 
 if __name__ == "__main__":
+    from log_setup import setup_logging
+    setup_logging("monitor.log")
+    
     # Тест мониторинга
     test_monitor = ResourceMonitor(check_interval=5)
     test_monitor.start()
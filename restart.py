@@ -9,9 +9,6 @@
 import argparse
 import requests
 import time
-import os
-import sys
-import subprocess
 
 def get_server_ip():
     """Пытается определить IP сервера"""
@@ -25,52 +22,37 @@ def get_server_ip():
         return "localhost"
 
 def restart_bot(host, port=8080):
-    """Перезапускает бота, сначала сбрасывая все активные запросы"""
-    
-    reset_url = f"http://{host}:{port}/reset"
-    print(f"Сбрасываем все активные запросы через {reset_url}...")
+    """
+    Плавно перезапускает бота через сервер: новый процесс запускается рядом со старым,
+    старый дожидается начатых генераций и передаёт сессии. Активные запросы не сбрасываются.
+    """
+    reload_url = f"http://{host}:{port}/reload"
+    status_url = f"http://{host}:{port}/status"
+    print(f"Плавный перезапуск через {reload_url}...")
     
     try:
-        response = requests.get(reset_url, timeout=5)
-        if response.status_code == 200:
-            print("Все активные запросы успешно сброшены")
-        else:
-            print(f"Ошибка при сбросе запросов: {response.status_code}, {response.text}")
-    except requests.RequestException as e:
+        starts = requests.get(status_url, timeout=5).json().get("supervisor", {}).get("starts", 0)
+        response = requests.get(reload_url, timeout=5)
+        if response.status_code != 200:
+            print(f"Ошибка при перезапуске: {response.status_code}, {response.text}")
+            return False
+    except (requests.RequestException, ValueError) as e:
         print(f"Ошибка при подключении к серверу: {e}")
         return False
     
-    # Небольшая пауза для завершения активных процессов
-    time.sleep(2)
-    
-    # Если скрипт запущен на сервере, перезапускаем бота
-    if host in ["localhost", "127.0.0.1"] or host == get_server_ip():
-        print("Перезапускаем бота локально...")
-        
+    # Ждем, пока новый процесс примет работу
+    for _ in range(60):
+        time.sleep(2)
         try:
-            # Находим PID процесса Python, запущенного с bot.py
-            ps_output = subprocess.check_output(["ps", "-ef"], text=True)
-            for line in ps_output.splitlines():
-                if "python" in line and "bot.py" in line and "grep" not in line:
-                    pid = line.split()[1]
-                    print(f"Найден процесс бота с PID {pid}, завершаем...")
-                    os.system(f"kill {pid}")
-            
-            # Даем процессу время на завершение
-            time.sleep(3)
-            
-            # Запускаем бота заново в фоне
-            print("Запускаем бота заново...")
-            os.system("python bot.py &")
+            supervisor = requests.get(status_url, timeout=5).json().get("supervisor", {})
+        except (requests.RequestException, ValueError):
+            continue
+        print(f"Состояние: {supervisor.get('state')}, PID {supervisor.get('pid')}, запусков {supervisor.get('starts')}")
+        if supervisor.get("state") == "ready" and supervisor.get("starts", 0) > starts:
             print("Бот перезапущен!")
             return True
-        except Exception as e:
-            print(f"Ошибка при перезапуске бота: {e}")
-            return False
-    else:
-        print(f"Скрипт запущен не на сервере ({host}). Для полного перезапуска запустите на сервере.")
-        print("Сброс активных запросов выполнен успешно.")
-        return True
+    print("Новый процесс не стал готовым, проверьте логи сервера")
+    return False
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Перезапуск бота RDDM")
@@ -5,18 +5,24 @@
 """
 import os
 import sys
-import subprocess
-import time
+import json
 import logging
 import signal
 
-logging.basicConfig(level=logging.INFO, 
-                   format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+from log_setup import setup_logging, stop_logging
+from supervisor import Supervisor
+
+setup_logging()
 logger = logging.getLogger("run")
 
+# Процесс под надзором; останавливается вместе с этим скриптом
+active_supervisor = None
+
 # Функция для обработки сигналов завершения
 def signal_handler(sig, frame):
     logger.info(f"Получен сигнал {sig}, завершаем работу")
+    if active_supervisor is not None:
+        active_supervisor.stop()
     sys.exit(0)
 
 # Регистрируем обработчики сигналов
@@ -29,241 +35,57 @@ def main():
     # Устанавливаем переменную окружения PORT для правильного определения порта
     os.environ["PORT"] = "8080"
     
-    # Проверяем наличие delete_webhook.py
-    if os.path.exists("delete_webhook.py"):
-        logger.info("Выполняем удаление webhook...")
-        try:
-            # Запускаем delete_webhook.py и дожидаемся завершения
-            result = subprocess.run(["python", "delete_webhook.py"], 
-                                   stdout=subprocess.PIPE, 
-                                   stderr=subprocess.PIPE, 
-                                   text=True,
-                                   check=False)
-            logger.info(f"Скрипт delete_webhook.py завершен с кодом {result.returncode}")
-            if result.stdout:
-                logger.info(f"Вывод: {result.stdout}")
-            if result.stderr:
-                logger.error(f"Ошибки: {result.stderr}")
-        except Exception as e:
-            logger.error(f"Ошибка при удалении webhook: {e}")
-    
-    # Небольшая пауза перед запуском бота
-    time.sleep(1)
+    # Webhook проверяет сам бот (или фронт workers.py) одним асинхронным запросом при запуске;
+    # psutil необязателен: без него монитор ресурсов читает /proc
     
-    # Проверяем наличие psutil и устанавливаем при необходимости
-    try:
-        import psutil
-        logger.info("Библиотека psutil уже установлена")
-    except ImportError:
-        logger.info("Устанавливаем psutil для мониторинга...")
-        try:
-            result = subprocess.run([sys.executable, "-m", "pip", "install", "psutil"],
-                              stdout=subprocess.PIPE,
-                              stderr=subprocess.PIPE,
-                              text=True)
-            if result.returncode == 0:
-                logger.info("psutil успешно установлен")
-            else:
-                logger.error(f"Ошибка установки psutil: {result.stderr}")
-        except Exception as e:
-            logger.error(f"Не удалось установить psutil: {e}")
-    
-    # Запускаем простой сервер вместо бота
+    # Под надзором запускаем простой сервер, а если его нет - бота напрямую
     if os.path.exists("simple_server.py"):
         logger.info("Запуск простого HTTP-сервера...")
-        try:
-            server_process = subprocess.Popen(
-                ["python", "simple_server.py"],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True,
-                bufsize=1
-            )
-            
-            # Функция для чтения вывода из потока
-            def read_stream(stream, prefix):
-                while True:
-                    line = stream.readline()
-                    if not line:
-                        break
-                    logger.info(f"{prefix}: {line.rstrip()}")
-            
-            # Запускаем отдельные потоки для чтения stdout и stderr
-            import threading
-            stdout_thread = threading.Thread(target=read_stream, args=(server_process.stdout, "SERVER"))
-            stderr_thread = threading.Thread(target=read_stream, args=(server_process.stderr, "SERVER_ERR"))
-            stdout_thread.daemon = True
-            stderr_thread.daemon = True
-            stdout_thread.start()
-            stderr_thread.start()
-            
-            # Проверяем состояние процесса каждые 2 секунды
-            while True:
-                # Если процесс завершился, запускаем аварийный сервер
-                if server_process.poll() is not None:
-                    exit_code = server_process.returncode
-                    logger.error(f"Сервер неожиданно завершился с кодом {exit_code}")
-                    
-                    # Запускаем аварийный HTTP-сервер
-                    logger.info("Запускаем аварийный HTTP-сервер после сбоя...")
-                    if os.path.exists("emergency_server.py"):
-                        os.execv(sys.executable, [sys.executable, "emergency_server.py"])
-                    else:
-                        # Используем встроенный аварийный сервер
-                        from http.server import HTTPServer, BaseHTTPRequestHandler
-                        
-                        class SimpleHandler(BaseHTTPRequestHandler):
-                            def do_GET(self):
-                                self.send_response(200)
-                                self.send_header('Content-type', 'application/json')
-                                self.end_headers()
-                                response = f'{{"status":"error","message":"Server crashed with exit code {exit_code}"}}'
-                                self.wfile.write(response.encode())
-                        
-                        server = HTTPServer(('0.0.0.0', 8080), SimpleHandler)
-                        logger.info("Встроенный аварийный HTTP-сервер запущен на порту 8080")
-                        server.serve_forever()
-                
-                # Если процесс работает, ждем 2 секунды
-                time.sleep(2)
-            
-        except Exception as e:
-            logger.error(f"Ошибка при запуске простого сервера: {e}")
-            # Пробуем запустить аварийный сервер
-            if os.path.exists("emergency_server.py"):
-                os.execv(sys.executable, [sys.executable, "emergency_server.py"])
-            else:
-                # Запускаем встроенный аварийный сервер
-                from http.server import HTTPServer, BaseHTTPRequestHandler
-                
-                class SimpleHandler(BaseHTTPRequestHandler):
-                    def do_GET(self):
-                        self.send_response(200)
-                        self.send_header('Content-type', 'application/json')
-                        self.end_headers()
-                        response = f'{{"status":"error","message":"Failed to start server: {str(e)}"}}'
-                        self.wfile.write(response.encode())
-                
-                server = HTTPServer(('0.0.0.0', 8080), SimpleHandler)
-                logger.info("Встроенный аварийный HTTP-сервер запущен на порту 8080")
-                server.serve_forever()
-                
-    # Если simple_server.py отсутствует, запускаем бота напрямую
+        supervisor = Supervisor("simple_server", [sys.executable, "simple_server.py"],
+                                readiness_url=f"http://127.0.0.1:{os.environ['PORT']}/", readiness_timeout=30)
     else:
-        # Запускаем бота
         logger.info("Запуск бота...")
-        try:
-            # Запускаем бота как подпроцесс
-            bot_process = subprocess.Popen(["python", "bot.py"], 
-                                        stdout=subprocess.PIPE, 
-                                        stderr=subprocess.PIPE, 
-                                        text=True)
-            
-            # Даем боту время для запуска
-            time.sleep(5)
-            
-            # Проверяем, запустился ли процесс
-            if bot_process.poll() is not None:
-                # Процесс завершился сразу, это ошибка
-                stdout, stderr = bot_process.communicate()
-                logger.error(f"Ошибка при запуске бота, код выхода: {bot_process.returncode}")
-                if stdout:
-                    logger.info(f"Вывод бота: {stdout}")
-                if stderr:
-                    logger.error(f"Ошибки бота: {stderr}")
-                
-                # Запускаем аварийный HTTP-сервер
-                logger.info("Запускаем аварийный HTTP-сервер...")
-                if os.path.exists("emergency_server.py"):
-                    os.execv(sys.executable, [sys.executable, "emergency_server.py"])
-                else:
-                    logger.error("Файл emergency_server.py не найден!")
-                    # Используем встроенный аварийный сервер
-                    from http.server import HTTPServer, BaseHTTPRequestHandler
-                    
-                    class SimpleHandler(BaseHTTPRequestHandler):
-                        def do_GET(self):
-                            self.send_response(200)
-                            self.send_header('Content-type', 'application/json')
-                            self.end_headers()
-                            response = '{"status":"error","message":"Bot failed to start, check logs"}'
-                            self.wfile.write(response.encode())
-                
-                    server = HTTPServer(('0.0.0.0', 8080), SimpleHandler)
-                    logger.info("Встроенный аварийный HTTP-сервер запущен на порту 8080")
-                    server.serve_forever()
-            
-            # Если процесс запустился, начинаем читать его вывод
-            logger.info("Бот успешно запущен, начинаем читать вывод")
-            
-            # Функция для чтения вывода из потока
-            def read_stream(stream, prefix):
-                while True:
-                    line = stream.readline()
-                    if not line:
-                        break
-                    print(f"{prefix}: {line.rstrip()}")
-            
-            # Запускаем отдельные потоки для чтения stdout и stderr
-            import threading
-            stdout_thread = threading.Thread(target=read_stream, args=(bot_process.stdout, "STDOUT"))
-            stderr_thread = threading.Thread(target=read_stream, args=(bot_process.stderr, "STDERR"))
-            stdout_thread.daemon = True
-            stderr_thread.daemon = True
-            stdout_thread.start()
-            stderr_thread.start()
-            
-            # Проверяем состояние процесса каждые 2 секунды
-            while True:
-                # Если процесс завершился, запускаем аварийный сервер
-                if bot_process.poll() is not None:
-                    exit_code = bot_process.returncode
-                    logger.error(f"Бот неожиданно завершился с кодом {exit_code}")
-                    
-                    # Запускаем аварийный HTTP-сервер
-                    logger.info("Запускаем аварийный HTTP-сервер после сбоя...")
-                    if os.path.exists("emergency_server.py"):
-                        os.execv(sys.executable, [sys.executable, "emergency_server.py"])
-                    else:
-                        # Используем встроенный аварийный сервер
-                        from http.server import HTTPServer, BaseHTTPRequestHandler
-                        
-                        class SimpleHandler(BaseHTTPRequestHandler):
-                            def do_GET(self):
-                                self.send_response(200)
-                                self.send_header('Content-type', 'application/json')
-                                self.end_headers()
-                                response = f'{{"status":"error","message":"Bot crashed with exit code {exit_code}"}}'
-                                self.wfile.write(response.encode())
-                        
-                        server = HTTPServer(('0.0.0.0', 8080), SimpleHandler)
-                        logger.info("Встроенный аварийный HTTP-сервер запущен на порту 8080")
-                        server.serve_forever()
-                
-                # Если процесс работает, ждем 2 секунды
-                time.sleep(2)
-        
-        except Exception as e:
-            logger.error(f"Ошибка при запуске бота: {e}")
-            # Запускаем аварийный HTTP-сервер
-            logger.info("Запускаем аварийный HTTP-сервер из-за исключения...")
-            if os.path.exists("emergency_server.py"):
-                os.execv(sys.executable, [sys.executable, "emergency_server.py"])
-            else:
-                # Используем встроенный аварийный сервер
-                from http.server import HTTPServer, BaseHTTPRequestHandler
-                
-                class SimpleHandler(BaseHTTPRequestHandler):
-                    def do_GET(self):
-                        self.send_response(200)
-                        self.send_header('Content-type', 'application/json')
-                        self.end_headers()
-                        response = f'{{"status":"error","message":"Exception: {str(e)}"}}'
-                        self.wfile.write(response.encode())
-                
-                server = HTTPServer(('0.0.0.0', 8080), SimpleHandler)
-                logger.info("Встроенный аварийный HTTP-сервер запущен на порту 8080")
-                server.serve_forever()
+        supervisor = Supervisor("bot", [sys.executable, "bot.py"],
+                                readiness_url=f"http://127.0.0.1:{os.environ.get('BOT_HTTP_PORT', 8081)}/")
+    
+    # Процесс пишет в унаследованные stdout/stderr напрямую, без перечитывания строк здесь;
+    # падение замечается сразу (waitpid), перезапуск - с растущей задержкой
+    global active_supervisor
+    active_supervisor = supervisor
+    try:
+        supervisor.start()
+        state = supervisor.wait()
+        message = f"Process crashed repeatedly, last exit code {supervisor.last_exit_code}"
+    except Exception as e:
+        logger.error(f"Ошибка при запуске: {e}")
+        state = "failed"
+        message = f"Exception: {str(e)}"
+    
+    # Аварийный режим - только после цикла падений
+    if state == "failed":
+        run_emergency(message)
+
+def run_emergency(message):
+    """Запускает аварийный HTTP-сервер вместо текущего процесса"""
+    logger.info("Запускаем аварийный HTTP-сервер...")
+    if os.path.exists("emergency_server.py"):
+        stop_logging()
+        os.execv(sys.executable, [sys.executable, "emergency_server.py"])
+    
+    # Используем встроенный аварийный сервер
+    logger.error("Файл emergency_server.py не найден!")
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    
+    class SimpleHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-type', 'application/json')
+            self.end_headers()
+            self.wfile.write(json.dumps({"status": "error", "message": message}).encode())
+    
+    server = HTTPServer(('0.0.0.0', 8080), SimpleHandler)
+    logger.info("Встроенный аварийный HTTP-сервер запущен на порту 8080")
+    server.serve_forever()
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
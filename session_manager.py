@@ -1,6 +1,8 @@
 from enum import Enum
 from typing import Dict, Optional
 from pydantic import BaseModel
+import os
+import json
 import logging
 from datetime import datetime, timedelta
 
@@ -39,6 +41,7 @@ class UserState:
         self.language = "ru"  # Язык генерации
         self.current_post_message_id = None  # ID сообщения с текущим постом
         self.chat_id = None  # ID чата
+        self.edit_session = None  # История правок текущего поста (post_editor.EditSession)
         
     def update(self, **kwargs):
         """Обновляет поля объекта по словарю с аргументами"""
@@ -48,6 +51,35 @@ class UserState:
         
         # Обновляем время активности при любом обновлении
         self.last_activity = datetime.now()
+    
+    def to_dict(self):
+        """Состояние в виде, пригодном для JSON (для передачи новому процессу бота)"""
+        data = {}
+        for key, value in vars(self).items():
+            if isinstance(value, Enum):
+                value = value.value
+            elif isinstance(value, datetime):
+                value = value.isoformat()
+            elif key == "edit_session" and value is not None:
+                value = vars(value)
+            data[key] = value
+        return data
+    
+    @classmethod
+    def from_dict(cls, data):
+        """Восстанавливает состояние, сохранённое to_dict"""
+        from post_editor import EditSession
+        
+        state = cls()
+        state.update(**data)
+        state.mode = GenerationMode(state.mode)
+        state.post_size = PostSize(state.post_size)
+        state.last_activity = datetime.fromisoformat(data["last_activity"])
+        if data.get("edit_session") is not None:
+            edit_session = EditSession()
+            vars(edit_session).update(data["edit_session"])
+            state.edit_session = edit_session
+        return state
 
 class UserSession(BaseModel):
     user_id: int
@@ -74,7 +106,7 @@ class SessionManager:
         session = UserState()
         session.user_id = user_id
         self.sessions[user_id] = session
-        logger.info(f"Создана новая сессия для пользователя {user_id}")
+        logger.info("Создана новая сессия для пользователя %s", user_id)
         return session
     
     def get_session(self, user_id):
@@ -107,7 +139,8 @@ class SessionManager:
         else:
             # Иначе обновляем только переданные параметры
             session.update(**kwargs)
-            logger.info(f"Параметры сессии пользователя {user_id} обновлены: {kwargs}")
+            # Только имена полей: значения (тексты постов, история правок) в лог не пишем
+            logger.debug("Параметры сессии пользователя %s обновлены: %s", user_id, ", ".join(kwargs))
         
         return session
     
@@ -138,4 +171,99 @@ class SessionManager:
         if expired_user_ids:
             logger.info(f"Удалено {len(expired_user_ids)} истекших сессий")
         
-        return len(expired_user_ids) 
\ No newline at end of file
+        return len(expired_user_ids)
+    
+    def save_snapshot(self, path):
+        """
+        Сохраняет активные сессии в JSON-файл перед завершением процесса.
+        Файл пишется во временный и переименовывается, так что читатель не увидит его наполовину.
+        
+        :return: Количество сохранённых сессий
+        """
+        self.clean_expired_sessions()
+        data = {
+            "saved_at": datetime.now().isoformat(),
+            "sessions": [session.to_dict() for session in self.sessions.values()]
+        }
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+        logger.info(f"Сохранено {len(data['sessions'])} сессий в {path}")
+        return len(data["sessions"])
+    
+    def load_snapshot(self, path, shard=None):
+        """
+        Загружает сессии, сохранённые предыдущим процессом, и удаляет файл.
+        
+        :param shard: (номер воркера, число воркеров) - загрузить только сессии пользователей
+            этого воркера; файл тогда не удаляется, его удаляет фронт, когда все воркеры загрузились
+        :return: Количество загруженных сессий
+        """
+        if not os.path.exists(path):
+            return 0
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            loaded = 0
+            for item in data.get("sessions", []):
+                try:
+                    session = UserState.from_dict(item)
+                except (KeyError, TypeError, ValueError) as e:
+                    logger.warning(f"Пропущена сессия из снимка: {e}")
+                    continue
+                if shard is not None and session.user_id % shard[1] != shard[0]:
+                    continue
+                self.sessions[session.user_id] = session
+                loaded += 1
+            logger.info(f"Загружено {loaded} сессий из {path} (сохранён {data.get('saved_at')})")
+        except (OSError, ValueError) as e:
+            logger.error(f"Не удалось загрузить снимок сессий {path}: {e}")
+            loaded = 0
+        if shard is not None:
+            return loaded
+        # Снимок одноразовый: повторный запуск не должен вернуть устаревшие сессии
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        return loaded 
+
+def worker_snapshot_path(path, index):
+    """Файл снимка сессий воркера с номером index: sessions_snapshot.json -> sessions_snapshot.worker0.json"""
+    root, ext = os.path.splitext(path)
+    return f"{root}.worker{index}{ext}"
+
+def merge_snapshots(paths, path):
+    """
+    Собирает снимки воркеров в один файл, который загрузят процессы следующего запуска
+    при любом числе воркеров. Исходные файлы удаляются.
+    
+    :param paths: Снимки воркеров; отсутствующие файлы пропускаются
+    :param path: Итоговый файл
+    :return: Количество сессий в итоговом файле
+    """
+    sessions = []
+    saved_at = None
+    merged = 0
+    for source in paths:
+        try:
+            with open(source, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            continue
+        except (OSError, ValueError) as e:
+            logger.error(f"Не удалось прочитать снимок сессий {source}: {e}")
+            continue
+        sessions.extend(data.get("sessions", []))
+        saved_at = max(saved_at or "", data.get("saved_at") or "")
+        merged += 1
+        os.remove(source)
+    if saved_at is None:
+        return 0
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"saved_at": saved_at, "sessions": sessions}, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+    logger.info(f"Объединено снимков: {merged}, в {path} {len(sessions)} сессий")
+    return len(sessions)
@@ -0,0 +1,273 @@
+"""
+Ограничения запросов к LLM, общие для всех процессов бота на одной машине.
+
+RateLimiter и asyncio.Semaphore действуют внутри процесса: воркеры workers.py или
+случайно запущенный второй bot.py умножают частоту запросов к провайдеру. Здесь те же
+ограничения хранятся в файлах, которые видят все процессы с одним ключом API:
+
+- SharedRateLimiter - корзина токенов (GCRA): в файле хранится момент, с которого
+  свободен следующий запрос. Ожидающие внутри процесса стоят в очереди на asyncio.Lock,
+  как у RateLimiter; первый из них под flock резервирует ближайший момент и спит до него
+  без опроса. Так в файле не больше одной резервации на процесс, а ожидающий, которого
+  отменили (таймаут вызывающего), возвращает свою резервацию, если после неё никто не успел
+  зарезервировать следующую.
+- SharedSemaphore - слоты одновременных запросов как блокировки байтов файла (lockf).
+  Ядро снимает блокировки умершего процесса, поэтому упавший воркер не уносит слоты с собой.
+
+API совпадает с RateLimiter и asyncio.Semaphore. Если файлы недоступны (нет fcntl,
+нет прав, другая ошибка ввода-вывода), ограничения работают внутри процесса, как раньше,
+и раз в BACKEND_RETRY_INTERVAL секунд пробуют вернуться к общим.
+
+Настройки окружения:
+    LLM_SHARED_LIMITS    - 0 отключает общие ограничения (1)
+    LLM_LIMITS_DIR       - каталог файлов ограничений (системный каталог временных файлов)
+"""
+import os
+import time
+import errno
+import asyncio
+import hashlib
+import logging
+import tempfile
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger("shared_limiter")
+
+SHARED_LIMITS_ENABLED = os.getenv("LLM_SHARED_LIMITS", "1") == "1"
+LIMITS_DIR = os.getenv("LLM_LIMITS_DIR", tempfile.gettempdir())
+# Через сколько секунд после сбоя снова пробовать общие файлы
+BACKEND_RETRY_INTERVAL = 60
+# Размер записи в файле частоты: число с фиксированной шириной, файл не нужно обрезать
+_RECORD_SIZE = 32
+# flock не блокирует цикл событий: занятый файл опрашивается с этим периодом, секунд
+_LOCK_RETRY_INTERVAL = 0.001
+# Сколько раз без ожидания пробовать flock при возврате резервации отменённым запросом
+_GIVE_BACK_ATTEMPTS = 100
+
+def shared_limits_path(key):
+    """
+    Общий префикс файлов ограничений для ключа API: у разных ключей разные лимиты провайдера.
+
+    :return: Путь без расширения или None, если общие ограничения отключены или недоступны
+    """
+    if not SHARED_LIMITS_ENABLED or fcntl is None:
+        return None
+    digest = hashlib.sha256(str(key).encode("utf-8")).hexdigest()[:16]
+    return os.path.join(LIMITS_DIR, f"rddm-llm-{digest}")
+
+class _SharedFile:
+    """Файл состояния, общий для процессов; при ошибках временно отключается"""
+
+    def __init__(self, path, kind):
+        self.path = path
+        self.kind = kind
+        self.fd = None
+        self.retry_at = 0 if path else float("inf")
+
+    def available(self):
+        return self.fd is not None or time.monotonic() >= self.retry_at
+
+    def open(self):
+        if self.fd is None:
+            self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            logger.info(f"Общее ограничение ({self.kind}): {self.path}")
+        return self.fd
+
+    def degrade(self, error):
+        """Переходит на ограничение внутри процесса до следующей попытки"""
+        logger.error(f"Общее ограничение ({self.kind}) недоступно, действует ограничение процесса: {error}")
+        # Блокировки слотов этого процесса снимаются вместе с дескриптором
+        if self.fd is not None:
+            try:
+                os.close(self.fd)
+            except OSError:
+                pass
+            self.fd = None
+        self.retry_at = time.monotonic() + BACKEND_RETRY_INTERVAL
+
+class SharedRateLimiter:
+    """Ограничение частоты запросов, общее для процессов с одним файлом состояния"""
+
+    def __init__(self, requests_per_minute, path, fallback, burst=1):
+        """
+        :param requests_per_minute: Общий лимит запросов в минуту для всех процессов
+        :param path: Префикс файлов ограничений (shared_limits_path); None - только fallback
+        :param fallback: Ограничитель внутри процесса на случай недоступности файла (RateLimiter)
+        :param burst: Сколько запросов подряд допускается после простоя
+        """
+        self.requests_per_minute = requests_per_minute
+        self.interval = 60 / requests_per_minute
+        self.burst = max(1, burst)
+        self.fallback = fallback
+        self.file = _SharedFile(f"{path}.rate" if path else None, "частота")
+        # Очередь ожидающих внутри процесса: резервирует только тот, чья очередь подошла
+        self.lock = asyncio.Lock()
+
+    def _try_flock(self, fd):
+        """Берёт flock без ожидания; False, если файл занят другим процессом"""
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                return False
+            raise
+        return True
+
+    def _read(self, fd):
+        try:
+            return float(os.pread(fd, _RECORD_SIZE, 0).strip() or 0)
+        except ValueError:
+            return 0.0
+
+    def _write(self, fd, value):
+        os.pwrite(fd, f"{value:.6f}".ljust(_RECORD_SIZE).encode(), 0)
+
+    def _try_reserve(self):
+        """
+        Резервирует ближайший свободный момент для запроса.
+
+        :return: (сколько до него ждать, записанный в файл момент) или None, если файл занят
+        """
+        fd = self.file.open()
+        if not self._try_flock(fd):
+            return None
+        # Под блокировкой только чтение и запись нескольких байт
+        try:
+            now = time.time()
+            theoretical = max(self._read(fd), now)
+            start = max(now, theoretical - (self.burst - 1) * self.interval)
+            reserved = theoretical + self.interval
+            self._write(fd, reserved)
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        return start - now, reserved
+
+    async def _reserve(self):
+        """Резервирует момент для запроса, ожидая flock без блокировки цикла событий"""
+        while True:
+            reservation = self._try_reserve()
+            if reservation is not None:
+                return reservation
+            await asyncio.sleep(_LOCK_RETRY_INTERVAL)
+
+    def _give_back(self, reserved):
+        """
+        Возвращает резервацию отменённого запроса, если она всё ещё последняя в файле.
+
+        Вызывается при отмене, поэтому не ждёт: если файл долго занят, резервация
+        остаётся (это не больше одного интервала на процесс).
+        """
+        try:
+            fd = self.file.open()
+            for _ in range(_GIVE_BACK_ATTEMPTS):
+                if self._try_flock(fd):
+                    break
+            else:
+                return
+            try:
+                if abs(self._read(fd) - reserved) < 1e-6:
+                    self._write(fd, reserved - self.interval)
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        except OSError as e:
+            self.file.degrade(e)
+
+    async def acquire(self):
+        """Ожидает, пока можно выполнить следующий запрос"""
+        async with self.lock:
+            if self.file.available():
+                try:
+                    wait, reserved = await self._reserve()
+                except OSError as e:
+                    self.file.degrade(e)
+                else:
+                    if wait > 0:
+                        try:
+                            await asyncio.sleep(wait)
+                        except asyncio.CancelledError:
+                            self._give_back(reserved)
+                            raise
+                    return
+        await self.fallback.acquire()
+
+    @property
+    def shared(self):
+        return self.file.fd is not None
+
+class SharedSemaphore:
+    """Число одновременных запросов, общее для процессов с одним файлом слотов"""
+
+    def __init__(self, slots, path, poll_interval=0.05):
+        """
+        :param slots: Общее число одновременных запросов
+        :param path: Префикс файлов ограничений (shared_limits_path); None - только внутри процесса
+        :param poll_interval: Период проверки слотов, когда все заняты другими процессами
+        """
+        self.slots = slots
+        self.poll_interval = poll_interval
+        # Очередь ожидающих внутри процесса; она же - ограничение при недоступном файле
+        self.local = asyncio.Semaphore(slots)
+        self.file = _SharedFile(f"{path}.slots" if path else None, "одновременные запросы")
+        self.held = []  # Слоты, занятые этим процессом (None - занят только локальный)
+
+    def _try_lock(self):
+        """Занимает свободный слот, если он есть; блокировки lockf принадлежат процессу, поэтому свои слоты пропускаем"""
+        fd = self.file.open()
+        for slot in range(self.slots):
+            if slot in self.held:
+                continue
+            try:
+                fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, slot, os.SEEK_SET)
+            except OSError as e:
+                if e.errno in (errno.EACCES, errno.EAGAIN):
+                    continue
+                raise
+            return slot
+        return None
+
+    async def acquire(self):
+        await self.local.acquire()
+        try:
+            while self.file.available():
+                try:
+                    slot = self._try_lock()
+                except OSError as e:
+                    self.file.degrade(e)
+                    break
+                if slot is not None:
+                    self.held.append(slot)
+                    return True
+                await asyncio.sleep(self.poll_interval)
+        except BaseException:
+            self.local.release()
+            raise
+        self.held.append(None)
+        return True
+
+    def release(self):
+        # Слоты процесса равноценны: освобождается любой из занятых
+        slot = self.held.pop()
+        if slot is not None and self.file.fd is not None:
+            try:
+                fcntl.lockf(self.file.fd, fcntl.LOCK_UN, 1, slot, os.SEEK_SET)
+            except OSError as e:
+                self.file.degrade(e)
+        self.local.release()
+
+    def locked(self):
+        return self.local.locked()
+
+    async def __aenter__(self):
+        await self.acquire()
+        return None
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.release()
+
+    @property
+    def shared(self):
+        return self.file.fd is not None
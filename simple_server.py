@@ -3,25 +3,22 @@
 Простейший HTTP-сервер для Timeweb Cloud
 Гарантированно работает на порту 8080
 """
-import http.server
-import socketserver
-import json
 import time
 import os
 import sys
+import signal
 import threading
 import logging
-import subprocess
-
-# Настройка логирования в файл и консоль
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler("server.log"),
-        logging.StreamHandler()
-    ]
-)
+import urllib.request
+
+from metrics import Registry, CONTENT_TYPE
+from http_utils import ThreadedHTTPServer, KeepAliveHandler, PrecomputedResponse
+from log_setup import setup_logging, stop_logging
+from supervisor import Supervisor
+from stats_segment import StatsReader, segment_path, remove_segment
+
+# Логирование через очередь: в консоль и в server.log с ротацией по размеру
+setup_logging("server.log")
 logger = logging.getLogger("simple_server")
 
 # Импортируем мониторинг ресурсов
@@ -36,145 +33,202 @@ except ImportError as e:
 # Порт для сервера
 PORT = int(os.environ.get("PORT", 8080))
 
+# Порт HTTP-сервера бота, с которого забираются его метрики
+BOT_HTTP_PORT = int(os.environ.get("BOT_HTTP_PORT", 8081))
+# При плавном перезапуске новый процесс бота поднимает HTTP на соседнем порту, пока старый ещё работает
+BOT_HTTP_PORTS = (BOT_HTTP_PORT, BOT_HTTP_PORT + 1)
+# Сколько бот дожидается начатых генераций при остановке (передаётся ему в окружении)
+DRAIN_TIMEOUT = float(os.environ.get("DRAIN_TIMEOUT", 25))
+# Число процессов бота: больше одного - фронт workers.py раздаёт обновления воркерам по пользователям
+BOT_WORKERS = int(os.environ.get("BOT_WORKERS", 1))
+BOT_COMMAND = [sys.executable, "workers.py" if BOT_WORKERS > 1 else "bot.py"]
+
+# Метрики самого сервера; метрики бота добавляются к ним при запросе /metrics
+supervisor_registry = Registry()
+BOT_UP = supervisor_registry.gauge("supervisor_bot_up", "Процесс бота запущен (1) или нет (0)")
+BOT_STARTS = supervisor_registry.counter("supervisor_bot_starts", "Запуски процесса бота")
+BOT_CRASHES = supervisor_registry.counter("supervisor_bot_crashes", "Неожиданные завершения процесса бота")
+SERVER_UPTIME = supervisor_registry.gauge("supervisor_uptime_seconds", "Время работы сервера")
+HTTP_REQUESTS = supervisor_registry.counter("supervisor_http_requests", "HTTP-запросы к серверу", ["path"])
+
 # Статус бота
 BOT_STATUS = {
     "status": "starting",
     "start_time": time.time(),
     "bot_process": None,
+    "bot_http_port": BOT_HTTP_PORT,
+    "bot_stats": None,  # StatsReader сегмента текущего процесса бота
     "last_error": None
 }
 
-class SimpleHTTPRequestHandler(http.server.BaseHTTPRequestHandler):
+def build_health():
+    """Базовый ответ со статусом; собирается в фоне, а не на каждый запрос"""
+    return {
+        "status": BOT_STATUS["status"],
+        "uptime": int(time.time() - BOT_STATUS["start_time"]),
+        "timestamp": int(time.time())
+    }
+
+# Готовый ответ для проверки здоровья платформой и для всех прочих путей
+HEALTH_RESPONSE = PrecomputedResponse(build_health)
+
+class SimpleHTTPRequestHandler(KeepAliveHandler):
     """Простой обработчик HTTP-запросов"""
     
-    def log_message(self, format, *args):
-        """Переопределяем логирование запросов"""
-        logger.info(f"{self.address_string()} - {format % args}")
-    
     def do_GET(self):
         """Обработка GET-запросов"""
-        # Отвечаем на любой запрос успешным статусом
-        self.send_response(200)
-        self.send_header('Content-type', 'application/json')
-        self.end_headers()
+        known_path = self.path if self.path in ("/", "/reset", "/reload", "/start_bot", "/status", "/monitor", "/metrics") else "other"
+        HTTP_REQUESTS.labels(known_path).inc()
+        
+        if self.path == "/metrics":
+            self.send_body(render_metrics().encode("utf-8"), content_type=CONTENT_TYPE)
+            return
+        
+        if self.path not in ("/reset", "/reload", "/start_bot", "/status", "/monitor"):
+            # Отвечаем на любой запрос успешным статусом без сборки ответа
+            self.send_body(HEALTH_RESPONSE.get())
+            return
         
         # Базовый ответ со статусом
-        response = {
-            "status": BOT_STATUS["status"],
-            "uptime": int(time.time() - BOT_STATUS["start_time"]),
-            "timestamp": int(time.time())
-        }
+        response = build_health()
         
         # Добавляем дополнительную информацию в зависимости от запроса
         if self.path == "/reset":
             response["message"] = "Resetting bot process..."
             threading.Thread(target=restart_bot).start()
+        elif self.path == "/reload":
+            response["message"] = "Reloading bot process without downtime..."
+            threading.Thread(target=reload_bot).start()
         elif self.path == "/start_bot":
             response["message"] = "Starting bot process..."
             threading.Thread(target=start_bot_process).start()
         elif self.path == "/status":
             # Добавляем расширенную информацию о статусе
             if BOT_STATUS["bot_process"] is not None:
-                response["bot_running"] = BOT_STATUS["bot_process"].poll() is None
-                response["bot_pid"] = BOT_STATUS["bot_process"].pid if BOT_STATUS["bot_process"].poll() is None else None
+                response["bot_running"] = bot_supervisor.is_running()
+                response["bot_pid"] = BOT_STATUS["bot_process"].pid if response["bot_running"] else None
+                response["supervisor"] = bot_supervisor.status()
+                # Живые счётчики бота из общей памяти; stale - процесс жив, но не обновляет их
+                response["bot_stats"] = read_bot_stats()
             if BOT_STATUS["last_error"]:
                 response["last_error"] = BOT_STATUS["last_error"]
             
-            # Добавляем информацию о ресурсах, если доступен мониторинг
+            # Добавляем информацию о ресурсах из последней проверки монитора, без ожидания
             if MONITOR_AVAILABLE:
-                try:
-                    import psutil
-                    response["system"] = {
-                        "cpu_percent": psutil.cpu_percent(interval=0.5),
-                        "memory_percent": psutil.virtual_memory().percent,
-                        "memory_available_mb": round(psutil.virtual_memory().available / (1024 * 1024), 2)
-                    }
-                except ImportError:
-                    pass
+                response["system"] = monitor.last_sample()
         elif self.path == "/monitor" and MONITOR_AVAILABLE:
             # Если запрос к /monitor и мониторинг доступен, передаем запрос монитору
-            self.wfile.write(monitor.get_status().encode())
+            self.send_body(monitor.get_status().encode())
             return
         
         # Отправляем ответ
-        self.wfile.write(json.dumps(response, indent=2).encode())
+        self.send_json(response, indent=2)
 
-def start_bot_process():
-    """Запускает бота в отдельном процессе"""
-    global BOT_STATUS
+def read_bot_stats():
+    """Счётчики текущего процесса бота из его сегмента общей памяти (None, если их нет)"""
+    reader = BOT_STATUS["bot_stats"]
+    return reader.read() if reader is not None else None
+
+def render_metrics():
+    """Метрики сервера вместе с метриками процесса бота"""
+    process = BOT_STATUS["bot_process"]
+    BOT_UP.set(1 if process is not None and process.poll() is None else 0)
+    SERVER_UPTIME.set(round(time.time() - BOT_STATUS["start_time"], 1))
+    text = supervisor_registry.render()
     
-    # Если процесс уже запущен, сначала останавливаем его
-    if BOT_STATUS["bot_process"] is not None and BOT_STATUS["bot_process"].poll() is None:
-        logger.info("Останавливаем существующий процесс бота...")
+    if process is not None and process.poll() is None:
         try:
-            BOT_STATUS["bot_process"].terminate()
-            # Даем процессу время на завершение
-            for _ in range(5):
-                if BOT_STATUS["bot_process"].poll() is not None:
-                    break
-                time.sleep(1)
-            # Если процесс не завершился, убиваем его
-            if BOT_STATUS["bot_process"].poll() is None:
-                BOT_STATUS["bot_process"].kill()
+            with urllib.request.urlopen(f"http://127.0.0.1:{BOT_STATUS['bot_http_port']}/metrics", timeout=1) as response:
+                text += response.read().decode("utf-8")
         except Exception as e:
-            logger.error(f"Ошибка при остановке процесса бота: {e}")
-    
-    # Запускаем бота
+            logger.debug(f"Не удалось получить метрики бота: {e}")
+    return text
+
+def on_bot_spawn(process):
+    """Новый процесс бота: монитор отслеживает ресурсы именно его дерева процессов"""
+    BOT_STATUS["bot_process"] = process
+    BOT_STATUS["bot_stats"] = StatsReader(segment_path(process.pid))
+    BOT_STARTS.inc()
+    if MONITOR_AVAILABLE:
+        monitor.target_pid = process.pid
+        monitor.stats_provider = read_bot_stats
+
+def on_bot_exit(exit_code):
+    BOT_CRASHES.inc()
+    # Упавший процесс не удалил свой сегмент счётчиков
+    process = BOT_STATUS["bot_process"]
+    if process is not None:
+        remove_segment(process.pid)
+    BOT_STATUS["last_error"] = f"Bot exited with code {exit_code}"
+
+# Состояния надзора в терминах статуса сервера
+SUPERVISOR_STATES = {
+    "starting": "starting_bot",
+    "ready": "bot_running",
+    "backoff": "bot_crashed",
+    "stopped": "bot_stopped",
+    "failed": "bot_failed"
+}
+
+def on_bot_state(state):
+    BOT_STATUS["status"] = SUPERVISOR_STATES.get(state, state)
+    if state == "failed":
+        # Цикл падений: только теперь переходим в аварийный режим
+        threading.Thread(target=switch_to_emergency, daemon=True).start()
+
+# Процесс бота: падение замечается сразу, перезапуск с растущей задержкой,
+# готовность - по ответу его health-эндпоинта
+bot_supervisor = Supervisor(
+    "bot",
+    BOT_COMMAND,
+    env=os.environ.copy(),  # Передаем все переменные окружения
+    readiness_url=f"http://127.0.0.1:{BOT_HTTP_PORT}/",
+    # Фронту нужно ещё доставить полученные обновления и собрать снимки сессий воркеров
+    stop_timeout=DRAIN_TIMEOUT + (15 if BOT_WORKERS > 1 else 5),
+    on_spawn=on_bot_spawn,
+    on_exit=on_bot_exit,
+    on_state=on_bot_state
+)
+
+def start_bot_process():
+    """Запускает бота под надзором; если он уже запущен - перезапускает"""
     logger.info("Запуск процесса бота...")
-    BOT_STATUS["status"] = "starting_bot"
-    
     try:
-        # Пробуем запустить бота
-        bot_process = subprocess.Popen(
-            ["python", "bot.py"],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-            bufsize=1,  # Построчная буферизация
-            env=os.environ.copy()  # Передаем все переменные окружения
-        )
-        
-        BOT_STATUS["bot_process"] = bot_process
-        BOT_STATUS["status"] = "bot_running"
-        
-        # Запускаем потоки для чтения вывода бота
-        def reader(stream, prefix):
-            for line in stream:
-                logger.info(f"{prefix}: {line.rstrip()}")
-        
-        threading.Thread(target=reader, args=(bot_process.stdout, "BOT_OUT"), daemon=True).start()
-        threading.Thread(target=reader, args=(bot_process.stderr, "BOT_ERR"), daemon=True).start()
-        
-        # Запускаем поток для мониторинга состояния бота
-        def monitor():
-            while True:
-                # Проверяем, работает ли бот
-                if bot_process.poll() is not None:
-                    exit_code = bot_process.poll()
-                    logger.error(f"Процесс бота завершился с кодом {exit_code}")
-                    BOT_STATUS["status"] = "bot_crashed"
-                    BOT_STATUS["last_error"] = f"Bot exited with code {exit_code}"
-                    break
-                time.sleep(5)
-        
-        threading.Thread(target=monitor, daemon=True).start()
-        
+        if not bot_supervisor.start():
+            bot_supervisor.restart()
     except Exception as e:
         logger.error(f"Ошибка при запуске бота: {e}")
         BOT_STATUS["status"] = "bot_start_failed"
         BOT_STATUS["last_error"] = str(e)
-        
+
 def restart_bot():
     """Перезапускает бота"""
     logger.info("Перезапуск бота...")
-    start_bot_process()
+    bot_supervisor.restart()
+
+def reload_bot():
+    """
+    Плавный перезапуск: новый процесс бота стартует на соседнем порту и становится готовым,
+    старый перестаёт принимать обновления, дожидается начатых генераций и передаёт сессии
+    """
+    port = BOT_HTTP_PORTS[1] if BOT_STATUS["bot_http_port"] == BOT_HTTP_PORTS[0] else BOT_HTTP_PORTS[0]
+    env = dict(bot_supervisor.env, BOT_HTTP_PORT=str(port))
+    logger.info(f"Плавный перезапуск бота, новый процесс на порту {port}")
+    if bot_supervisor.reload(env=env, readiness_url=f"http://127.0.0.1:{port}/"):
+        BOT_STATUS["bot_http_port"] = port
+        return True
+    return False
+
+def switch_to_emergency():
+    """Заменяет сервер аварийным на том же порту и с тем же PID"""
+    logger.critical("Бот падает раз за разом, переход в аварийный режим")
+    if os.path.exists("emergency_server.py"):
+        stop_logging()
+        os.execv(sys.executable, [sys.executable, "emergency_server.py"])
 
 def run_server():
     """Запускает HTTP-сервер"""
     try:
-        # Ставим SO_REUSEADDR для предотвращения ошибки "Address already in use"
-        socketserver.TCPServer.allow_reuse_address = True
-        
         # Создаем класс обработчика
         handler_class = SimpleHTTPRequestHandler
         
@@ -182,7 +236,9 @@ def run_server():
         if MONITOR_AVAILABLE:
             handler_class = add_monitor_routes(handler_class)
         
-        with socketserver.TCPServer(("", PORT), handler_class) as httpd:
+        # Поток на соединение: медленный клиент не задерживает проверку здоровья
+        with ThreadedHTTPServer(("", PORT), handler_class) as httpd:
+            HEALTH_RESPONSE.start()
             logger.info(f"Сервер запущен на порту {PORT}")
             httpd.serve_forever()
     except Exception as e:
@@ -211,8 +267,19 @@ if __name__ == "__main__":
         monitor.start()
         logger.info("Мониторинг ресурсов запущен")
     
-    # Запускаем поток для бота
-    threading.Thread(target=start_bot_process, daemon=True).start()
+    # При остановке контейнера завершаем и бота, чтобы он не остался без надзора
+    def signal_handler(sig, frame):
+        logger.info(f"Получен сигнал {sig}, останавливаем бота")
+        bot_supervisor.stop()
+        sys.exit(0)
+    
+    signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGTERM, signal_handler)
+    # SIGHUP - плавный перезапуск бота без остановки сервера
+    signal.signal(signal.SIGHUP, lambda sig, frame: threading.Thread(target=reload_bot).start())
+    
+    # Запускаем бота под надзором
+    start_bot_process()
     
     # Запускаем HTTP-сервер в основном потоке
     run_server() 
\ No newline at end of file
@@ -0,0 +1,182 @@
+"""
+Счётчики процесса бота в общей памяти.
+
+Бот несколько раз в секунду записывает живые счётчики (активные запросы к LLM, очередь
+к LLM, сессии, время последнего обновления, задержку цикла событий) в небольшой файл,
+отображённый в память (mmap, по возможности в /dev/shm). simple_server, монитор ресурсов
+и фронт workers.py читают его без HTTP-запросов и разбора логов: чтение - это
+копирование сотни байт.
+
+Запись защищена счётчиком последовательности (seqlock): писатель делает его нечётным
+перед записью и чётным после, читатель повторяет чтение, если счётчик нечётный или
+изменился за время чтения. Писатель один - цикл событий процесса, блокировок нет.
+Если писатель перестал обновлять сегмент (published_at давно не менялся), процесс
+завис или заблокирован - это видно без сетевых таймаутов.
+
+    writer = StatsWriter(segment_path(os.getpid()))
+    writer.publish(active_requests=2, sessions=10)
+    StatsReader(segment_path(pid)).read()  # {"active_requests": 2, ..., "stale": False}
+"""
+import os
+import mmap
+import time
+import struct
+import logging
+import tempfile
+
+logger = logging.getLogger("stats_segment")
+
+STATS_DIR = os.getenv("BOT_STATS_DIR") or ("/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir())
+# Период публикации счётчиков ботом
+PUBLISH_INTERVAL = int(os.getenv("BOT_STATS_INTERVAL_MS", "250")) / 1000
+# Сегмент, не обновлявшийся дольше этого, считается устаревшим: процесс завис
+STALE_AFTER = 5.0
+
+MAGIC = b"RDBS"
+VERSION = 1
+FLAG_ACCEPTING = 1
+FLAG_DRAINING = 2
+
+# Поля сегмента по порядку; при изменении состава повышается VERSION
+FIELDS = (
+    ("pid", "I"),
+    ("flags", "I"),
+    ("started_at", "d"),
+    ("published_at", "d"),
+    ("last_update_at", "d"),
+    ("updates_total", "Q"),
+    ("active_requests", "I"),
+    ("llm_queue", "I"),
+    ("sessions", "I"),
+    ("in_flight_updates", "I"),
+    ("loop_lag_ms", "d"),
+    ("loop_lag_max_ms", "d"),
+    ("loop_stalls", "I"),
+)
+_HEADER = struct.Struct("<4sI")
+_SEQ = struct.Struct("<Q")
+_BODY = struct.Struct("<" + "".join(fmt for _, fmt in FIELDS))
+_SEQ_OFFSET = _HEADER.size
+_BODY_OFFSET = _SEQ_OFFSET + _SEQ.size
+SEGMENT_SIZE = _BODY_OFFSET + _BODY.size
+_NAMES = tuple(name for name, _ in FIELDS)
+
+def segment_path(pid):
+    """Файл сегмента процесса с данным PID"""
+    return os.path.join(STATS_DIR, f"rddm-bot-stats-{pid}")
+
+def remove_segment(pid):
+    """Удаляет сегмент завершившегося процесса"""
+    try:
+        os.remove(segment_path(pid))
+    except OSError:
+        pass
+
+class StatsWriter:
+    """Публикация счётчиков процесса; вызывается только из одного потока"""
+
+    def __init__(self, path):
+        """
+        :param path: Файл сегмента (segment_path(os.getpid()))
+        """
+        self.path = path
+        self.seq = 0
+        self.values = dict.fromkeys(_NAMES, 0)
+        self.values["pid"] = os.getpid()
+        self.values["started_at"] = time.time()
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, SEGMENT_SIZE)
+            self.map = mmap.mmap(fd, SEGMENT_SIZE)
+        finally:
+            os.close(fd)
+        _HEADER.pack_into(self.map, 0, MAGIC, VERSION)
+        self.publish()
+
+    def publish(self, **values):
+        """
+        Записывает счётчики; не переданные поля сохраняют прежние значения.
+
+        :param values: Значения полей из FIELDS (None - 0)
+        """
+        self.values.update(values)
+        self.values["published_at"] = time.time()
+        body = [self.values[name] or 0 for name in _NAMES]
+        self.seq += 1
+        _SEQ.pack_into(self.map, _SEQ_OFFSET, self.seq)
+        _BODY.pack_into(self.map, _BODY_OFFSET, *body)
+        self.seq += 1
+        _SEQ.pack_into(self.map, _SEQ_OFFSET, self.seq)
+
+    def close(self):
+        """Закрывает и удаляет сегмент при штатном завершении"""
+        self.map.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+class StatsReader:
+    """Чтение сегмента другого процесса; файл открывается, как только появится"""
+
+    def __init__(self, path):
+        self.path = path
+        self.map = None
+        self.last_body = None  # Последний согласованный снимок
+
+    def _open(self):
+        try:
+            fd = os.open(self.path, os.O_RDONLY)
+        except OSError:
+            return False
+        try:
+            if os.fstat(fd).st_size < SEGMENT_SIZE:
+                return False
+            self.map = mmap.mmap(fd, SEGMENT_SIZE, access=mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+        if _HEADER.unpack_from(self.map, 0) != (MAGIC, VERSION):
+            logger.warning(f"Сегмент {self.path} другого формата")
+            self.map.close()
+            self.map = None
+            return False
+        return True
+
+    def read(self, attempts=100):
+        """
+        Согласованный снимок счётчиков.
+
+        :return: Словарь полей с признаками accepting, draining, stale и возрастом данных;
+                 None, если сегмента нет. Если писатель не дал прочитать сегмент за attempts
+                 попыток, возвращается предыдущий снимок.
+        """
+        if self.map is None and not self._open():
+            return None
+        for _ in range(attempts):
+            before = _SEQ.unpack_from(self.map, _SEQ_OFFSET)[0]
+            if before % 2:
+                continue
+            body = _BODY.unpack_from(self.map, _BODY_OFFSET)
+            if _SEQ.unpack_from(self.map, _SEQ_OFFSET)[0] == before:
+                self.last_body = body
+                break
+        else:
+            body = self.last_body
+            if body is None:
+                return None
+        stats = dict(zip(_NAMES, body))
+        now = time.time()
+        flags = stats.pop("flags")
+        stats["accepting"] = bool(flags & FLAG_ACCEPTING)
+        stats["draining"] = bool(flags & FLAG_DRAINING)
+        stats["age_s"] = round(now - stats["published_at"], 3)
+        stats["stale"] = stats["age_s"] > STALE_AFTER
+        stats["last_update_age_s"] = round(now - stats["last_update_at"], 1) if stats["last_update_at"] else None
+        stats["loop_lag_ms"] = round(stats["loop_lag_ms"], 1)
+        stats["loop_lag_max_ms"] = round(stats["loop_lag_max_ms"], 1)
+        return stats
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
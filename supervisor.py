@@ -0,0 +1,308 @@
+"""
+Надзор за дочерним процессом: мгновенное обнаружение падения и перезапуск с задержкой.
+
+Для каждого процесса заводится поток, который блокируется в waitpid (Popen.wait) и
+просыпается в момент завершения процесса, без периодического опроса. Упавший процесс
+перезапускается с экспоненциально растущей задержкой со случайным разбросом; если за
+crash_window секунд процесс упал max_crashes раз, надзор прекращается (состояние
+"failed") и вызывающий код переходит в аварийный режим. Процесс считается готовым
+только после успешного ответа его health-эндпоинта.
+
+    supervisor = Supervisor("bot", [sys.executable, "bot.py"], readiness_url="http://127.0.0.1:8081/")
+    supervisor.start()
+    supervisor.wait()  # Возвращается, когда надзор прекращён
+"""
+import os
+import time
+import random
+import logging
+import threading
+import subprocess
+import urllib.request
+from collections import deque
+
+logger = logging.getLogger("supervisor")
+
+class Supervisor:
+    """Запускает процесс и перезапускает его после падений"""
+
+    def __init__(self, name, command, env=None, readiness_url=None, readiness_timeout=120,
+                 backoff_base=0.5, backoff_max=30.0, max_crashes=5, crash_window=300,
+                 healthy_after=60, stop_timeout=10, on_spawn=None, on_exit=None, on_state=None):
+        """
+        :param name: Имя процесса для логов
+        :param command: Команда запуска для subprocess.Popen
+        :param env: Переменные окружения процесса (None - как у текущего)
+        :param readiness_url: Адрес health-эндпоинта; без него процесс готов сразу после запуска
+        :param readiness_timeout: Сколько ждать готовности, прежде чем считать запуск неудачным
+        :param backoff_base: Задержка перед первым перезапуском, секунды
+        :param backoff_max: Максимальная задержка перед перезапуском
+        :param max_crashes: Сколько падений за crash_window означает цикл падений
+        :param crash_window: Окно подсчёта падений, секунды
+        :param healthy_after: Проработав столько секунд, процесс снова перезапускается без задержки
+        :param stop_timeout: Сколько ждать завершения процесса после SIGTERM (время на плавную остановку)
+        :param on_spawn: Вызывается с объектом Popen после каждого запуска
+        :param on_exit: Вызывается с кодом выхода после каждого неожиданного завершения
+        :param on_state: Вызывается с новым состоянием (starting, ready, backoff, stopped, failed)
+        """
+        self.name = name
+        self.command = command
+        self.env = env
+        self.readiness_url = readiness_url
+        self.readiness_timeout = readiness_timeout
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.max_crashes = max_crashes
+        self.crash_window = crash_window
+        self.healthy_after = healthy_after
+        self.stop_timeout = stop_timeout
+        self.on_spawn = on_spawn
+        self.on_exit = on_exit
+        self.on_state = on_state
+
+        self.state = "stopped"
+        self.process = None
+        self.started_at = None
+        self.ready = False
+        self.starts = 0
+        self.last_exit_code = None
+        self.crash_times = deque()
+        self.consecutive_failures = 0
+        self.thread = None
+        self._stopping = False
+        self._restart_requested = False
+        self._handoff = None  # Новый процесс, который заменит текущий после его завершения
+        self._reload_done = threading.Event()
+        self._reload_done.set()
+        self._wakeup = threading.Event()
+        self.lock = threading.Lock()
+
+    def _set_state(self, state):
+        if state == self.state:
+            return
+        self.state = state
+        logger.info(f"{self.name}: {state}")
+        if self.on_state:
+            try:
+                self.on_state(state)
+            except Exception as e:
+                logger.error(f"{self.name}: ошибка в обработчике состояния: {e}")
+
+    def start(self):
+        """Запускает надзор; повторный вызов ничего не делает"""
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                return False
+            self._stopping = False
+            self.crash_times.clear()
+            self.consecutive_failures = 0
+            self.thread = threading.Thread(target=self._run, name=f"supervisor-{self.name}", daemon=True)
+            self.thread.start()
+            return True
+
+    def _spawn(self):
+        self._set_state("starting")
+        self.ready = False
+        self.process = subprocess.Popen(self.command, env=self.env)
+        self.started_at = time.time()
+        self.starts += 1
+        logger.info(f"{self.name}: запущен процесс PID {self.process.pid}")
+        if self.on_spawn:
+            self.on_spawn(self.process)
+        threading.Thread(target=self._wait_ready, args=(self.process,), name=f"readiness-{self.name}", daemon=True).start()
+
+    def _adopt(self, process):
+        """Принимает под надзор процесс, запущенный и проверенный при плавном перезапуске"""
+        self.process = process
+        self.started_at = time.time()
+        self.starts += 1
+        self.ready = True
+        logger.info(f"{self.name}: работу продолжает процесс PID {process.pid}")
+        if self.on_spawn:
+            self.on_spawn(process)
+        self._set_state("ready")
+
+    def _wait_ready(self, process):
+        """Ждёт успешного ответа health-эндпоинта; если его нет, завершает процесс"""
+        deadline = time.time() + self.readiness_timeout
+        while process.poll() is None and process is self.process:
+            if self.readiness_url is None or self._probe():
+                self.ready = True
+                self._set_state("ready")
+                logger.info(f"{self.name}: готов через {time.time() - self.started_at:.1f} с после запуска")
+                return
+            if time.time() > deadline:
+                logger.error(f"{self.name}: нет ответа health-эндпоинта за {self.readiness_timeout} с, перезапуск")
+                process.kill()
+                return
+            time.sleep(0.2)
+
+    def _probe(self):
+        try:
+            with urllib.request.urlopen(self.readiness_url, timeout=1) as response:
+                return response.status == 200
+        except Exception:
+            return False
+
+    def _backoff_delay(self):
+        delay = min(self.backoff_max, self.backoff_base * 2 ** max(0, self.consecutive_failures - 1))
+        # Разброс, чтобы перезапуски не шли в такт с внешними сбоями
+        return delay * random.uniform(0.5, 1.5)
+
+    def _run(self):
+        handoff = None
+        while not self._stopping:
+            try:
+                if handoff is not None:
+                    self._adopt(handoff)
+                else:
+                    self._spawn()
+            except Exception as e:
+                logger.error(f"{self.name}: не удалось запустить процесс: {e}")
+                exit_code = None
+            else:
+                # Блокируется в waitpid до завершения процесса
+                exit_code = self.process.wait()
+            self.ready = False
+            self.last_exit_code = exit_code
+
+            # Во время плавного перезапуска ждём его исхода: замена уже может быть готова
+            self._reload_done.wait()
+            handoff, self._handoff = self._handoff, None
+            if self._stopping:
+                if handoff is not None:
+                    self._terminate(handoff)
+                break
+            if handoff is not None:
+                logger.info(f"{self.name}: старый процесс завершился с кодом {exit_code}")
+                continue
+            if self._restart_requested:
+                self._restart_requested = False
+                logger.info(f"{self.name}: перезапуск по запросу")
+                continue
+
+            now = time.time()
+            ran_for = now - self.started_at if self.started_at else 0
+            logger.error(f"{self.name}: процесс завершился с кодом {exit_code} через {ran_for:.1f} с")
+            if self.on_exit:
+                try:
+                    self.on_exit(exit_code)
+                except Exception as e:
+                    logger.error(f"{self.name}: ошибка в обработчике завершения: {e}")
+
+            self.crash_times.append(now)
+            while self.crash_times and now - self.crash_times[0] > self.crash_window:
+                self.crash_times.popleft()
+            if len(self.crash_times) >= self.max_crashes:
+                logger.critical(f"{self.name}: {len(self.crash_times)} падений за {self.crash_window} с, надзор прекращён")
+                self._set_state("failed")
+                return
+
+            self.consecutive_failures = 1 if ran_for > self.healthy_after else self.consecutive_failures + 1
+            delay = self._backoff_delay()
+            self._set_state("backoff")
+            logger.info(f"{self.name}: перезапуск через {delay:.2f} с")
+            self._wakeup.wait(delay)
+            self._wakeup.clear()
+        self._set_state("stopped")
+
+    def restart(self):
+        """Перезапускает процесс без задержки и без учёта как падения"""
+        if self.thread is None or not self.thread.is_alive():
+            return self.start()
+        process = self.process
+        if process is not None and process.poll() is None:
+            self._restart_requested = True
+            self._terminate(process)
+        else:
+            # Процесс ждёт перезапуска после падения - будим поток надзора
+            self._wakeup.set()
+        return True
+
+    def reload(self, env=None, readiness_url=None):
+        """
+        Плавный перезапуск: новый процесс запускается рядом со старым и должен стать готовым,
+        только после этого старый получает SIGTERM и завершает начатую работу.
+        Новый процесс получает PID старого в SUPERVISOR_HANDOFF_PID.
+
+        :param env: Новые переменные окружения (например, другой порт health-эндпоинта)
+        :param readiness_url: Адрес health-эндпоинта нового процесса
+        :return: True, если новый процесс принял работу
+        """
+        with self.lock:
+            if not self._reload_done.is_set():
+                logger.warning(f"{self.name}: плавный перезапуск уже выполняется")
+                return False
+            self._reload_done.clear()
+        try:
+            old = self.process
+            if env is not None:
+                self.env = env
+            if readiness_url is not None:
+                self.readiness_url = readiness_url
+            if old is None or old.poll() is not None or self.thread is None or not self.thread.is_alive():
+                self._reload_done.set()
+                return self.restart()
+
+            spawn_env = dict(self.env if self.env is not None else os.environ)
+            spawn_env["SUPERVISOR_HANDOFF_PID"] = str(old.pid)
+            started = time.time()
+            new = subprocess.Popen(self.command, env=spawn_env)
+            logger.info(f"{self.name}: плавный перезапуск, новый процесс PID {new.pid}")
+            while not (self.readiness_url is None or self._probe()):
+                if new.poll() is not None or time.time() - started > self.readiness_timeout:
+                    logger.error(f"{self.name}: новый процесс не стал готовым, работу продолжает PID {old.pid}")
+                    if new.poll() is None:
+                        new.kill()
+                    new.wait()
+                    return False
+                time.sleep(0.2)
+            logger.info(f"{self.name}: новый процесс готов через {time.time() - started:.1f} с, останавливаем PID {old.pid}")
+
+            # Поток надзора заберёт новый процесс, как только старый завершится
+            self._handoff = new
+            self._terminate(old)
+            return True
+        finally:
+            self._reload_done.set()
+
+    def _terminate(self, process, timeout=None):
+        timeout = self.stop_timeout if timeout is None else timeout
+        process.terminate()
+        try:
+            process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            logger.warning(f"{self.name}: процесс не завершился за {timeout} с, принудительное завершение")
+            process.kill()
+
+    def stop(self, timeout=None):
+        """Останавливает процесс и надзор"""
+        self._stopping = True
+        self._wakeup.set()
+        process = self.process
+        if process is not None and process.poll() is None:
+            self._terminate(process, timeout)
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join(self.stop_timeout if timeout is None else timeout)
+
+    def wait(self):
+        """Ждёт прекращения надзора (остановки или цикла падений)"""
+        while self.thread is not None and self.thread.is_alive():
+            self.thread.join(1)
+        return self.state
+
+    def is_running(self):
+        return self.process is not None and self.process.poll() is None
+
+    def status(self):
+        """Состояние для /status"""
+        running = self.is_running()
+        return {
+            "state": self.state,
+            "ready": self.ready,
+            "pid": self.process.pid if running else None,
+            "uptime": int(time.time() - self.started_at) if running and self.started_at else None,
+            "starts": self.starts,
+            "recent_crashes": len(self.crash_times),
+            "last_exit_code": self.last_exit_code
+        }
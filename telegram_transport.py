@@ -0,0 +1,80 @@
+"""
+Единый транспорт к Telegram Bot API для всех процессов.
+
+Адрес Bot API и пул соединений настраиваются в одном месте: бот (сессия aiogram), фронт
+workers.py (прямые вызовы getUpdates и setWebhook), delete_webhook.py и уведомления
+администратору (alerts.py) ходят по одному адресу. Адрес можно направить на собственный
+сервер Bot API (telegram-bot-api): у него выше лимиты и ниже задержка, если он стоит рядом
+с ботом. Можно направить и на локальную заглушку для тестов.
+
+Соединения переиспользуются: пул одного процесса ограничен TELEGRAM_CONNECTION_LIMIT,
+простаивающее соединение живёт TELEGRAM_KEEPALIVE секунд, DNS кэшируется. Так отправка
+сообщения не платит за новое TLS-соединение.
+
+Настройки окружения:
+    TELEGRAM_API_BASE         - адрес Bot API (https://api.telegram.org)
+    TELEGRAM_API_LOCAL        - 1, если сервер Bot API запущен с --local (0)
+    TELEGRAM_CONNECTION_LIMIT - соединений в пуле процесса (100)
+    TELEGRAM_KEEPALIVE        - сколько секунд держать простаивающее соединение (60)
+
+    bot = Bot(token=BOT_TOKEN, session=create_bot_session())
+    async with create_client_session() as session:
+        await session.post(api_method_url(BOT_TOKEN, "getMe"))
+"""
+import os
+import ssl
+import logging
+
+logger = logging.getLogger("telegram_transport")
+
+TELEGRAM_API_BASE = os.environ.get("TELEGRAM_API_BASE", "https://api.telegram.org").rstrip("/")
+TELEGRAM_API_LOCAL = os.environ.get("TELEGRAM_API_LOCAL", "0") == "1"
+CONNECTION_LIMIT = int(os.environ.get("TELEGRAM_CONNECTION_LIMIT", 100))
+KEEPALIVE_TIMEOUT = float(os.environ.get("TELEGRAM_KEEPALIVE", 60))
+# Сколько секунд кэшировать адрес сервера Bot API
+DNS_CACHE_TTL = 300
+
+def api_method_url(token, method):
+    """URL метода Bot API на настроенном сервере"""
+    return f"{TELEGRAM_API_BASE}/bot{token}/{method}"
+
+def _connector_options():
+    # Проверка сертификатов по certifi, как в aiogram: системного хранилища может не быть
+    try:
+        import certifi
+        ssl_context = ssl.create_default_context(cafile=certifi.where())
+    except ImportError:
+        ssl_context = ssl.create_default_context()
+    return {
+        "ssl": ssl_context,
+        "limit": CONNECTION_LIMIT,
+        "keepalive_timeout": KEEPALIVE_TIMEOUT,
+        "ttl_dns_cache": DNS_CACHE_TTL
+    }
+
+def create_client_session(**kwargs):
+    """
+    Сессия aiohttp с пулом соединений транспорта для прямых вызовов Bot API.
+
+    :param kwargs: Дополнительные параметры aiohttp.ClientSession
+    """
+    import aiohttp
+    return aiohttp.ClientSession(connector=aiohttp.TCPConnector(**_connector_options()), **kwargs)
+
+def create_bot_session(timeout=60.0):
+    """
+    Сессия aiogram для Bot: настроенный адрес Bot API и пул соединений транспорта.
+    aiogram и aiohttp импортируются при вызове: процессам, которым нужен только адрес
+    Bot API (simple_server, alerts), не нужно платить за их загрузку.
+
+    :param timeout: Таймаут запроса по умолчанию в секундах (long polling добавляет к нему своё время)
+    """
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+
+    session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_BASE, is_local=TELEGRAM_API_LOCAL), timeout=timeout)
+    # Параметры соединителя aiogram берёт из _connector_init при создании сессии aiohttp
+    session._connector_init.update(_connector_options())
+    if TELEGRAM_API_BASE != "https://api.telegram.org":
+        logger.info(f"Bot API: {TELEGRAM_API_BASE}{' (локальный режим)' if TELEGRAM_API_LOCAL else ''}")
+    return session
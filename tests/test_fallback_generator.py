@@ -0,0 +1,66 @@
+import asyncio
+import json
+
+import pytest
+
+import fallback_generator as fallback_module
+from fallback_generator import Draft, PostArchive
+from llm_client import LLMClient
+from session_manager import PostSize
+
+MODEL_POST = "Ребята из первичного отделения провели турнир по футболу во дворе школы. " * 6 + "\n\n#ДвижениеПервых59"
+
+@pytest.fixture
+def archive(tmp_path, monkeypatch):
+    archive = PostArchive(path=str(tmp_path / "archive.jsonl"))
+    monkeypatch.setattr(fallback_module.fallback_generator, "archive", archive)
+    return archive
+
+def _client(monkeypatch, response):
+    client = LLMClient()
+
+    async def execute_request(*args, **kwargs):
+        return response() if callable(response) else response
+
+    monkeypatch.setattr(client, "_execute_request", execute_request)
+    return client
+
+def _archived(archive):
+    try:
+        with open(archive.path, encoding="utf-8") as f:
+            return [json.loads(line)["text"] for line in f]
+    except FileNotFoundError:
+        return []
+
+def test_model_response_is_archived(archive, monkeypatch):
+    client = _client(monkeypatch, MODEL_POST)
+    result = asyncio.run(client.generate_without_template("турнир по футболу", PostSize.MEDIUM))
+    assert _archived(archive) == [result]
+
+def test_fallback_draft_is_not_archived(archive, monkeypatch):
+    draft = lambda: fallback_module.fallback_generator.generate("турнир по футболу", "medium")
+    client = _client(monkeypatch, draft)
+    result = asyncio.run(client.generate_without_template("турнир по футболу", PostSize.MEDIUM))
+    assert isinstance(draft(), Draft)
+    assert result and _archived(archive) == []
+
+def test_error_text_is_not_archived(archive, monkeypatch):
+    client = _client(monkeypatch, "")
+    result = asyncio.run(client.generate_without_template("турнир по футболу", PostSize.MEDIUM))
+    assert "ошибка" in result and _archived(archive) == []
+
+def test_draft_from_another_process_is_recognized():
+    # Признак черновика - тип текста, а не память генератора
+    generator = fallback_module.FallbackGenerator(archive=PostArchive())
+    assert generator.is_generated(Draft("текст"))
+    assert not generator.is_generated("текст")
+
+def test_archive_is_compacted_on_load(tmp_path):
+    path = tmp_path / "archive.jsonl"
+    with open(path, "w", encoding="utf-8") as f:
+        for i in range(25):
+            f.write(json.dumps({"topic": f"тема {i}", "text": f"пост {i}"}, ensure_ascii=False) + "\n")
+    archive = PostArchive(path=str(path), max_entries=10)
+    assert [entry["text"] for entry in archive.entries.values()][-10:] == [f"пост {i}" for i in range(15, 25)]
+    with open(path, encoding="utf-8") as f:
+        assert [json.loads(line)["text"] for line in f] == [f"пост {i}" for i in range(15, 25)]
@@ -0,0 +1,43 @@
+import asyncio
+import json
+
+from fallback_generator import fallback_generator
+from llm_cassette import Cassette
+from llm_client import LLMClient
+
+def _client(tmp_path, monkeypatch, mode, response):
+    client = LLMClient()
+    client.cassette = Cassette(str(tmp_path / "cassette.jsonl"), mode=mode, speed=0)
+
+    async def execute_attempts(system_prompt, user_prompt, request_id, max_tokens, history, topic, post_size, attempts):
+        attempts.append({"url": "http://llm", "model": "m", "status": 200 if response else 500})
+        return response or fallback_generator.generate(topic, "medium")
+
+    monkeypatch.setattr(client, "_execute_attempts", execute_attempts)
+    return client
+
+def _calls(path):
+    with open(path, encoding="utf-8") as f:
+        return [record for record in map(json.loads, f) if record["type"] == "call"]
+
+def test_model_response_is_recorded_without_prompt(tmp_path, monkeypatch):
+    client = _client(tmp_path, monkeypatch, "record", "Ответ модели")
+    assert asyncio.run(client._execute_request("система", "длинный промпт", 1, topic="тема")) == "Ответ модели"
+    [call] = _calls(client.cassette.path)
+    assert call["r"] == "Ответ модели"
+    assert "u" not in call and "h" not in call
+
+def test_fallback_draft_is_not_recorded(tmp_path, monkeypatch):
+    client = _client(tmp_path, monkeypatch, "record", None)
+    draft = asyncio.run(client._execute_request("система", "промпт", 1, topic="субботник"))
+    assert fallback_generator.is_generated(draft)
+    assert not (tmp_path / "cassette.jsonl").exists() or _calls(client.cassette.path) == []
+
+def test_old_fallback_records_are_not_replayed(tmp_path):
+    path = tmp_path / "cassette.jsonl"
+    key = Cassette.key("система", None, "промпт", 1024)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(json.dumps({"type": "call", "k": key, "ms": 1, "a": [{"status": 500}], "r": "черновик"}) + "\n")
+    cassette = Cassette(str(path), mode="replay", speed=0)
+    assert cassette.skipped == 1
+    assert asyncio.run(cassette.replay(key)) is None
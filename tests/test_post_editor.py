@@ -0,0 +1,87 @@
+import json
+
+import pytest
+
+from post_editor import MAIN_HASHTAG, EditSession, apply_patch, split_paragraphs, try_mechanical_edit
+
+POST = (
+    "Первый абзац о соревнованиях.\n\n"
+    "Во втором абзаце лишняя фраза и дата 12 мая.\n\n"
+    "Последний абзац с итогами.\n\n"
+    f"#спорт {MAIN_HASHTAG}"
+)
+
+@pytest.mark.parametrize("request_text, removed", [
+    ("убери последний абзац", "Последний абзац с итогами."),
+    ("Удали второй абзац.", "Во втором абзаце лишняя фраза и дата 12 мая."),
+    ("удали 1 абзац", "Первый абзац о соревнованиях."),
+    ("удали абзац 2", "Во втором абзаце лишняя фраза и дата 12 мая."),
+])
+def test_delete_paragraph(request_text, removed):
+    edited = try_mechanical_edit(POST, request_text)
+    assert edited is not None
+    assert removed not in split_paragraphs(edited)
+    assert len(split_paragraphs(edited)) == 3
+
+@pytest.mark.parametrize("request_text", [
+    "убери во втором абзаце лишнюю фразу",
+    "удали из последнего абзаца дату",
+    "удали лишний абзац",
+    "добавь абзац про итоги матча #спорт",
+    "убери #спорт и добавь абзац про итоги",
+    "замени во втором абзаце #спорт на #футбол",
+    "добавь ссылку https://example.com и перепиши первый абзац",
+])
+def test_near_miss_requests_go_to_model(request_text):
+    assert try_mechanical_edit(POST, request_text) is None
+
+def test_hashtag_edits():
+    assert "#футбол" in try_mechanical_edit(POST, "замени хэштег #спорт на #футбол")
+    assert "#спорт" not in try_mechanical_edit(POST, "убери #спорт")
+    edited = try_mechanical_edit(POST, "добавь хештеги #лето, #команда")
+    assert split_paragraphs(edited)[-1] == f"#лето #команда #спорт {MAIN_HASHTAG}"
+    # Запрос только из хэштегов - добавление
+    assert "#лето" in split_paragraphs(try_mechanical_edit(POST, "#лето"))[-1]
+
+def test_add_link():
+    edited = try_mechanical_edit(POST, "добавь ссылку на регистрацию: https://example.com/reg")
+    paragraphs = split_paragraphs(edited)
+    assert paragraphs[-2] == "Подробнее: https://example.com/reg"
+    assert paragraphs[-1] == f"#спорт {MAIN_HASHTAG}"
+
+def _patch(*ops):
+    return json.dumps({"ops": list(ops)}, ensure_ascii=False)
+
+def test_multi_paragraph_replacement_keeps_ids_in_sync():
+    session = EditSession()
+    post = f"Вступление.\n\nСтарый второй абзац.\n\nЗаключение.\n\n{MAIN_HASHTAG}"
+
+    history, message, paragraphs, ids = session.prepare_turn(post, "раздели второй абзац на два")
+    post = session.apply_response(
+        "раздели второй абзац на два", message, paragraphs, ids,
+        _patch({"op": "replace", "index": 2, "text": "Новая часть А.\n\nНовая часть Б."})
+    )
+    assert split_paragraphs(post) == ["Вступление.", "Новая часть А.", "Новая часть Б.", "Заключение.", MAIN_HASHTAG]
+    # Вторая часть получила свой номер, номер модель видит в истории
+    assert session.paragraph_ids == [1, 2, 5, 3, 4]
+    assert '"ids":[2,5]' in session.history[-1]["content"]
+
+    # Следующая правка идёт по истории и ссылается на старые и новые номера
+    history, message, paragraphs, ids = session.prepare_turn(post, "убери заключение и перепиши часть Б")
+    assert history and ids == [1, 2, 5, 3, 4]
+    post = session.apply_response(
+        "убери заключение и перепиши часть Б", message, paragraphs, ids,
+        _patch({"op": "delete", "index": 3}, {"op": "replace", "index": 5, "text": "Часть Б короче."})
+    )
+    assert split_paragraphs(post) == ["Вступление.", "Новая часть А.", "Часть Б короче.", MAIN_HASHTAG]
+
+def test_ids_out_of_sync_start_new_window():
+    session = EditSession()
+    post = f"Первый.\n\nВторой.\n\n{MAIN_HASHTAG}"
+    _, message, paragraphs, ids = session.prepare_turn(post, "перепиши второй")
+    post = session.apply_response("перепиши второй", message, paragraphs, ids, _patch({"op": "replace", "index": 2, "text": "Новый второй."}))
+    session.paragraph_ids = session.paragraph_ids[:-1]
+    history, message, paragraphs, ids = session.prepare_turn(post, "ещё правка")
+    assert history == [] and ids == [1, 2, 3]
+    with pytest.raises(ValueError):
+        apply_patch(paragraphs, [{"op": "delete", "index": 1}], [1, 2])
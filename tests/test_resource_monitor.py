@@ -0,0 +1,36 @@
+from resource_monitor import Rollup
+
+FIELDS = ("cpu", "memory")
+
+def test_delta_polls_return_every_bucket():
+    rollup = Rollup(60, 100, FIELDS)
+    seen = {}
+    last_poll = None
+    ts = 1000.0
+    for step in range(60):
+        ts += 13
+        rollup.add(ts, {"cpu": step, "memory": 2 * step})
+        if step % 4 == 3:
+            # Дашборд опрашивает реже, чем приходят точки, и передаёт время прошлого опроса
+            poll_at = ts + 5
+            data = rollup.since(last_poll)
+            for i, bucket in enumerate(data["ts"]):
+                seen[bucket] = (data["cpu_min"][i], data["cpu_max"][i], data["memory_avg"][i])
+            last_poll = poll_at
+
+    data = rollup.since(None)
+    expected = {bucket: (data["cpu_min"][i], data["cpu_max"][i], data["memory_avg"][i]) for i, bucket in enumerate(data["ts"])}
+    assert len(rollup.buffer) > 9
+    # Кроме последнего незавершённого интервала, клиент знает итоговые значения всех интервалов
+    final = sorted(expected)[:-1]
+    assert {bucket: seen[bucket] for bucket in final} == {bucket: expected[bucket] for bucket in final}
+
+def test_partial_bucket_is_last():
+    rollup = Rollup(60, 10, FIELDS)
+    rollup.add(10, {"cpu": 1, "memory": 1})
+    rollup.add(70, {"cpu": 3, "memory": 3})
+    data = rollup.since(55)
+    assert data["partial"] and data["ts"] == [0, 60]
+    assert data["cpu_avg"] == [1, 3]
+    # Интервал [0, 60) закончился до опроса и не повторяется
+    assert rollup.since(65)["ts"] == [60]
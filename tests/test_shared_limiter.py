@@ -0,0 +1,62 @@
+import asyncio
+import fcntl
+import os
+import time
+
+from llm_client import RateLimiter
+from shared_limiter import SharedRateLimiter
+
+def _limiter(tmp_path, rpm=60):
+    return SharedRateLimiter(rpm, str(tmp_path / "limits"), fallback=RateLimiter(rpm))
+
+def test_cancelled_waiters_give_back_reservations(tmp_path):
+    async def scenario():
+        limiter = _limiter(tmp_path)
+        await limiter.acquire()
+        waiters = [asyncio.wait_for(limiter.acquire(), 0.5) for _ in range(20)]
+        results = await asyncio.gather(*waiters, return_exceptions=True)
+        assert all(isinstance(result, asyncio.TimeoutError) for result in results)
+        started = time.monotonic()
+        await limiter.acquire()
+        return time.monotonic() - started
+
+    # Следующий запрос ждёт только остаток интервала, а не 20 интервалов отменённых
+    assert asyncio.run(scenario()) < 1.5
+
+def test_processes_share_one_schedule(tmp_path):
+    async def scenario():
+        first, second = _limiter(tmp_path, rpm=600), _limiter(tmp_path, rpm=600)
+        started = time.monotonic()
+        for limiter in (first, second, first, second):
+            await limiter.acquire()
+        return time.monotonic() - started
+
+    # Четыре запроса при 10 в секунду: три интервала по 0,1 с на двоих
+    assert asyncio.run(scenario()) >= 0.28
+
+def test_busy_lock_does_not_block_event_loop(tmp_path):
+    async def scenario():
+        limiter = _limiter(tmp_path)
+        limiter.file.open()
+        # Другой процесс держит файл: отдельное открытие файла - отдельная блокировка flock
+        fd = os.open(limiter.file.path, os.O_RDWR)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                ticks += 1
+                await asyncio.sleep(0.01)
+
+        ticking = asyncio.create_task(ticker())
+        acquiring = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0.2)
+        assert not acquiring.done()
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+        await asyncio.wait_for(acquiring, 1)
+        ticking.cancel()
+        return ticks
+
+    assert asyncio.run(scenario()) >= 10
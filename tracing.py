@@ -0,0 +1,159 @@
+"""
+Лёгкая трассировка обработки обновлений.
+
+Для каждого обновления создаётся трасса, внутри неё - вложенные интервалы (spans):
+обработчик, ожидание RateLimiter и семафора, попытки запросов к URL, форматирование,
+вызовы Bot API. Текущая трасса хранится в contextvars, поэтому интервалы из задач,
+запущенных внутри обработчика, попадают в ту же трассу. Завершённые трассы лежат в
+ограниченном кольцевом буфере и доступны через /debug/traces?user_id=...
+
+    with start_trace("message", user_id=123):
+        with span("llm.rate_limiter"):
+            await rate_limiter.acquire()
+"""
+import os
+import time
+import itertools
+import contextvars
+from collections import deque
+
+# Сколько последних трасс хранить в памяти
+TRACE_RING_SIZE = int(os.getenv("TRACE_RING_SIZE", "1000"))
+# Интервалов в одной трассе не больше этого числа (защита от циклов повторов)
+MAX_SPANS_PER_TRACE = 200
+
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+_current_span = contextvars.ContextVar("current_span", default=-1)
+_trace_ids = itertools.count(1)
+
+# Кольцевой буфер завершённых трасс
+TRACES = deque(maxlen=TRACE_RING_SIZE)
+
+class Trace:
+    """Трасса обработки одного обновления"""
+
+    __slots__ = ("trace_id", "name", "user_id", "started_at", "started", "duration", "spans", "error")
+
+    def __init__(self, name, user_id=None):
+        self.trace_id = next(_trace_ids)
+        self.name = name
+        self.user_id = user_id
+        self.started_at = time.time()
+        self.started = time.perf_counter()
+        self.duration = None
+        self.spans = []  # [имя, начало от старта трассы, длительность, индекс родителя, атрибуты]
+        self.error = None
+
+    def to_dict(self):
+        return {
+            "trace_id": self.trace_id,
+            "name": self.name,
+            "user_id": self.user_id,
+            "started_at": round(self.started_at, 3),
+            "duration_ms": round(self.duration * 1000, 1) if self.duration is not None else None,
+            "error": self.error,
+            "spans": [
+                {
+                    "name": name,
+                    "start_ms": round(start * 1000, 1),
+                    "duration_ms": round(duration * 1000, 1) if duration is not None else None,
+                    "parent": parent,
+                    **({"attrs": attrs} if attrs else {}),
+                }
+                for name, start, duration, parent, attrs in self.spans
+            ],
+        }
+
+class _TraceContext:
+    __slots__ = ("trace", "trace_token", "span_token")
+
+    def __init__(self, name, user_id):
+        self.trace = Trace(name, user_id)
+
+    def __enter__(self):
+        self.trace_token = _current_trace.set(self.trace)
+        self.span_token = _current_span.set(-1)
+        return self.trace
+
+    def __exit__(self, exc_type, exc, tb):
+        trace = self.trace
+        trace.duration = time.perf_counter() - trace.started
+        if exc_type is not None:
+            trace.error = exc_type.__name__
+        _current_span.reset(self.span_token)
+        _current_trace.reset(self.trace_token)
+        TRACES.append(trace)
+
+class _SpanContext:
+    __slots__ = ("trace", "record", "token")
+
+    def __init__(self, trace, name, attrs):
+        self.trace = trace
+        self.record = [name, time.perf_counter() - trace.started, None, _current_span.get(), attrs]
+
+    def __enter__(self):
+        spans = self.trace.spans
+        spans.append(self.record)
+        self.token = _current_span.set(len(spans) - 1)
+        return self
+
+    def set(self, **attrs):
+        """Добавляет атрибуты к интервалу (например, статус ответа)"""
+        if self.record[4] is None:
+            self.record[4] = {}
+        self.record[4].update(attrs)
+
+    def __exit__(self, exc_type, exc, tb):
+        self.record[2] = time.perf_counter() - self.trace.started - self.record[1]
+        if exc_type is not None:
+            self.set(error=exc_type.__name__)
+        _current_span.reset(self.token)
+
+class _NoopSpan:
+    """Интервал вне трассы: ничего не записывает"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **attrs):
+        pass
+
+_NOOP_SPAN = _NoopSpan()
+
+def start_trace(name, user_id=None):
+    """Начинает новую трассу; по выходе из блока она сохраняется в кольцевой буфер"""
+    return _TraceContext(name, user_id)
+
+def span(name, **attrs):
+    """Интервал внутри текущей трассы; вне трассы ничего не стоит"""
+    trace = _current_trace.get()
+    if trace is None or len(trace.spans) >= MAX_SPANS_PER_TRACE:
+        return _NOOP_SPAN
+    return _SpanContext(trace, name, attrs or None)
+
+def current_trace_id():
+    """Идентификатор текущей трассы (для логов) или None"""
+    trace = _current_trace.get()
+    return trace.trace_id if trace is not None else None
+
+def recent_traces(user_id=None, limit=20, min_ms=0):
+    """
+    Последние завершённые трассы, новые первыми.
+
+    :param user_id: Только трассы этого пользователя
+    :param limit: Максимальное число трасс
+    :param min_ms: Только трассы не короче заданной длительности
+    """
+    result = []
+    for trace in reversed(TRACES):
+        if user_id is not None and trace.user_id != user_id:
+            continue
+        if trace.duration * 1000 < min_ms:
+            continue
+        result.append(trace.to_dict())
+        if len(result) >= limit:
+            break
+    return result
@@ -0,0 +1,152 @@
+"""
+Обновления, накопившиеся у Telegram, пока бот не работал.
+
+Раньше при запуске webhook удалялся с drop_pending_updates=True: сообщения, отправленные
+во время перезапуска, пропадали, и пользователям приходилось повторять запросы (а это лишние
+обращения к LLM). Теперь номер последнего обработанного обновления хранится в файле
+(UpdateOffset), а накопленные обновления после запуска разбираются (prepare_backlog):
+
+- уже обработанные (update_id не больше сохранённого) пропускаются;
+- обновления старше BACKLOG_MAX_AGE секунд отбрасываются: ответ на них уже не ждут;
+- повторные нажатия одной кнопки под одним сообщением схлопываются в первое.
+
+Оставшиеся обновления разных пользователей обрабатываются одновременно, одного пользователя -
+по очереди в исходном порядке. Обновления здесь - словари в формате Bot API.
+
+Настройки окружения:
+    UPDATE_OFFSET_PATH  - файл с номером последнего обработанного обновления (update_offset.json)
+    BACKLOG_MAX_AGE     - максимальный возраст накопленного обновления в секундах (600)
+"""
+import os
+import json
+import time
+import asyncio
+import logging
+
+logger = logging.getLogger("update_backlog")
+
+UPDATE_OFFSET_PATH = os.environ.get("UPDATE_OFFSET_PATH", "update_offset.json")
+BACKLOG_MAX_AGE = float(os.environ.get("BACKLOG_MAX_AGE", 600))
+# После недели без обновлений Telegram выбирает номер следующего случайно,
+# поэтому более старый сохранённый номер не используется
+OFFSET_MAX_AGE = 6 * 24 * 3600
+# Как часто сохранять номер обработанного обновления
+OFFSET_SAVE_INTERVAL = 1.0
+
+def update_user_id(update):
+    """Пользователь, от которого пришло обновление; для обновлений без пользователя - чат или 0"""
+    for key, event in update.items():
+        if key == "update_id" or not isinstance(event, dict):
+            continue
+        user = event.get("from") or event.get("user")
+        if user and "id" in user:
+            return user["id"]
+        chat = event.get("chat") or (event.get("message") or {}).get("chat")
+        if chat and "id" in chat:
+            return chat["id"]
+    return 0
+
+def update_chat_id(update):
+    """Чат, в который можно ответить на обновление, или None"""
+    for key, event in update.items():
+        if key == "update_id" or not isinstance(event, dict):
+            continue
+        chat = event.get("chat") or (event.get("message") or {}).get("chat")
+        if chat and "id" in chat:
+            return chat["id"]
+    return None
+
+def update_date(update):
+    """
+    Время отправки обновления (unixtime) или None.
+
+    У нажатия кнопки времени нет (дата его сообщения - время сообщения с кнопкой),
+    поэтому нажатия по возрасту не отбрасываются.
+    """
+    for key, event in update.items():
+        if key in ("update_id", "callback_query") or not isinstance(event, dict):
+            continue
+        date = event.get("edit_date") or event.get("date")
+        if date:
+            return date
+    return None
+
+def prepare_backlog(updates, last_offset=None, max_age=BACKLOG_MAX_AGE, now=None):
+    """
+    Отбирает накопленные обновления для обработки.
+
+    :param updates: Обновления в порядке update_id
+    :param last_offset: Номер последнего обработанного обновления (UpdateOffset.saved)
+    :param max_age: Обновления старше этого (секунд) отбрасываются
+    :return: (обновления для обработки в исходном порядке, счётчики отброшенных)
+    """
+    now = time.time() if now is None else now
+    stats = {"received": len(updates), "processed_before": 0, "expired": 0, "collapsed": 0}
+    kept = []
+    presses = set()
+    for update in updates:
+        if last_offset is not None and update["update_id"] <= last_offset:
+            stats["processed_before"] += 1
+            continue
+        date = update_date(update)
+        if date is not None and now - date > max_age:
+            stats["expired"] += 1
+            continue
+        query = update.get("callback_query")
+        if query is not None:
+            message = query.get("message") or {}
+            key = ((query.get("from") or {}).get("id"), message.get("message_id") or query.get("inline_message_id"), query.get("data"))
+            if key in presses:
+                stats["collapsed"] += 1
+                continue
+            presses.add(key)
+        kept.append(update)
+    return kept, stats
+
+class UpdateOffset:
+    """Номер последнего обработанного обновления, переживающий перезапуск процесса"""
+
+    def __init__(self, path=UPDATE_OFFSET_PATH):
+        self.path = path
+        self.saved = self._load()
+        self.value = self.saved
+
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            update_id, saved_at = int(data["update_id"]), float(data["saved_at"])
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.error(f"Не удалось прочитать номер обновления из {self.path}: {e}")
+            return None
+        if time.time() - saved_at > OFFSET_MAX_AGE:
+            logger.info(f"Сохранённый номер обновления {update_id} устарел и не используется")
+            return None
+        return update_id
+
+    def advance(self, update_id):
+        """Отмечает, что обновления до update_id включительно обработаны"""
+        if update_id is not None and (self.value is None or update_id > self.value):
+            self.value = update_id
+
+    def save(self):
+        """Записывает номер, если он изменился; файл пишется во временный и переименовывается"""
+        if self.value is None or self.value == self.saved:
+            return
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"update_id": self.value, "saved_at": time.time()}, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.error(f"Не удалось сохранить номер обновления в {self.path}: {e}")
+            return
+        self.saved = self.value
+
+    async def autosave(self, interval=OFFSET_SAVE_INTERVAL):
+        """Сохраняет номер раз в interval секунд, пока задачу не отменят"""
+        while True:
+            await asyncio.sleep(interval)
+            self.save()
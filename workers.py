@@ -0,0 +1,521 @@
+#!/usr/bin/env python
+"""
+Бот в нескольких процессах: фронт получает обновления и раздаёт их воркерам по пользователям.
+
+Обработчики бота (форматирование, поиск по датасету, проверка правок) выполняются в одном
+цикле событий и делят одно ядро. Фронт запускает BOT_WORKERS процессов bot.py в режиме
+воркера, каждый под своим Supervisor, со своим циклом событий и своей частью сессий.
+Обновление уходит воркеру с номером user_id % BOT_WORKERS, так что все обновления
+пользователя обрабатывает один процесс. Для каждого воркера есть очередь и одна задача
+доставки: обновления передаются в POST /update строго по очереди, неудачная доставка
+повторяется, поэтому порядок обновлений пользователя сохраняется и при перезапуске воркера.
+
+Обновления фронт получает через getUpdates или, если задан WEBHOOK_URL, через webhook
+(проверяется заголовок X-Telegram-Bot-Api-Secret-Token при заданном WEBHOOK_SECRET).
+Лимиты запросов к LLM воркеры делят через shared_limiter.
+
+    BOT_WORKERS=4 python workers.py
+"""
+import os
+import sys
+import time
+import socket
+import signal
+import asyncio
+import logging
+from urllib.parse import urlparse
+
+# Отсчёт времени запуска фронта для лога готовности
+STARTUP_STARTED = time.perf_counter()
+
+import aiohttp
+from aiohttp import web
+
+from log_setup import setup_logging
+from metrics import Registry, CONTENT_TYPE
+from supervisor import Supervisor
+from stats_segment import StatsWriter, StatsReader, segment_path, remove_segment, PUBLISH_INTERVAL, FLAG_ACCEPTING, FLAG_DRAINING
+from update_backlog import UpdateOffset, prepare_backlog, update_user_id
+from telegram_transport import api_method_url, create_client_session
+
+setup_logging()
+logger = logging.getLogger("workers")
+
+from config import BOT_TOKEN
+
+BOT_WORKERS = max(1, int(os.environ.get("BOT_WORKERS", os.cpu_count() or 1)))
+# Порт фронта: тот же, что у одиночного bot.py, simple_server опрашивает его так же
+PORT = int(os.environ.get("BOT_HTTP_PORT", 8081))
+DRAIN_TIMEOUT = float(os.environ.get("DRAIN_TIMEOUT", 25))
+SESSION_SNAPSHOT_PATH = os.environ.get("SESSION_SNAPSHOT_PATH", "sessions_snapshot.json")
+# Сколько пытаться доставить обновление воркеру, прежде чем отбросить его
+DELIVERY_TIMEOUT = float(os.environ.get("WORKER_DELIVERY_TIMEOUT", 60))
+# Сколько при остановке ждать доставки уже полученных обновлений
+FLUSH_TIMEOUT = 5
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")
+POLL_TIMEOUT = 25
+
+front_registry = Registry()
+UPDATES_RECEIVED = front_registry.counter("front_updates_received", "Обновления, полученные фронтом от Telegram")
+UPDATES_FORWARDED = front_registry.counter("front_updates_forwarded", "Обновления, переданные воркеру", ["worker"])
+UPDATES_DROPPED = front_registry.counter("front_updates_dropped", "Обновления, которые не удалось доставить воркеру", ["worker"])
+QUEUE_DEPTH = front_registry.gauge("front_queue_depth", "Обновления, ожидающие доставки воркеру", ["worker"])
+WORKER_CRASHES = front_registry.counter("front_worker_crashes", "Неожиданные завершения воркеров", ["worker"])
+BACKLOG_UPDATES = front_registry.counter("front_backlog_updates", "Обновления, накопившиеся за время простоя, по исходу разбора", ["outcome"])
+
+front_state = {"polling": False, "draining": False, "offset": None, "started_at": time.time(), "snapshot_loaded": False,
+               "last_update_at": None, "updates_total": 0, "last_routed_id": None}
+# Номер последнего обновления, переданного воркеру, переживает перезапуск фронта
+update_offset = UpdateOffset()
+UNDELIVERED = set()  # Обновления, полученные, но ещё не переданные воркерам
+
+def _free_port():
+    """Свободный локальный порт для HTTP-сервера воркера"""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+class WorkerShard:
+    """Процесс-воркер под надзором и очередь обновлений его пользователей"""
+
+    def __init__(self, index, workers):
+        """
+        :param index: Номер воркера
+        :param workers: Общее число воркеров
+        """
+        self.index = index
+        self.label = str(index)
+        self.port = _free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.queue = asyncio.Queue()
+        self.stats = {}  # Последние счётчики воркера из его сегмента общей памяти
+        self.reader = None
+        self.sender = None
+        env = dict(
+            os.environ,
+            BOT_WORKER_INDEX=str(index),
+            BOT_WORKERS=str(workers),
+            BOT_HTTP_PORT=str(self.port)
+        )
+        self.supervisor = Supervisor(
+            f"worker-{index}",
+            [sys.executable, "bot.py"],
+            env=env,
+            readiness_url=f"{self.url}/",
+            stop_timeout=DRAIN_TIMEOUT + 5,
+            on_exit=self._on_exit,
+            on_state=self._on_state
+        )
+        QUEUE_DEPTH.labels(self.label).set_function(self.queue.qsize)
+
+    def _on_exit(self, exit_code):
+        WORKER_CRASHES.labels(self.label).inc()
+        # Упавший воркер не удалил свой сегмент
+        if self.supervisor.process is not None:
+            remove_segment(self.supervisor.process.pid)
+
+    def read_stats(self):
+        """Счётчики текущего процесса воркера из общей памяти"""
+        process = self.supervisor.process
+        if process is None or process.poll() is not None:
+            self.stats = {}
+            return self.stats
+        path = segment_path(process.pid)
+        if self.reader is None or self.reader.path != path:
+            if self.reader is not None:
+                self.reader.close()
+            self.reader = StatsReader(path)
+        self.stats = self.reader.read() or {}
+        return self.stats
+
+    def _on_state(self, state):
+        if state == "failed":
+            # Воркер в цикле падений: завершаем фронт, дальше решает его собственный надзор
+            logger.critical(f"Воркер {self.index} падает раз за разом, фронт останавливается")
+            loop.call_soon_threadsafe(request_stop, 1)
+
+    async def deliver(self, session):
+        """Передаёт обновления воркеру по одному, в порядке получения"""
+        while True:
+            update = await self.queue.get()
+            try:
+                await self._send(session, update)
+            finally:
+                UNDELIVERED.discard(update.get("update_id"))
+                advance_update_offset()
+                self.queue.task_done()
+
+    async def _send(self, session, update):
+        deadline = time.monotonic() + DELIVERY_TIMEOUT
+        delay = 0.1
+        while True:
+            try:
+                async with session.post(f"{self.url}/update", json=update, timeout=aiohttp.ClientTimeout(total=5)) as response:
+                    if response.status == 200:
+                        UPDATES_FORWARDED.labels(self.label).inc()
+                        return True
+                    if response.status == 400:
+                        logger.error(f"Воркер {self.index} отклонил обновление {update.get('update_id')}")
+                        break
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                pass  # Воркер перезапускается
+            if time.monotonic() + delay > deadline:
+                logger.error(f"Обновление {update.get('update_id')} не доставлено воркеру {self.index} за {DELIVERY_TIMEOUT} с")
+                break
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 2)
+        UPDATES_DROPPED.labels(self.label).inc()
+        return False
+
+    def status(self):
+        return {
+            **self.supervisor.status(),
+            "index": self.index,
+            "port": self.port,
+            "queued": self.queue.qsize(),
+            "accepting": self.stats.get("accepting", False),
+            "stale": self.stats.get("stale"),
+            "active_sessions": self.stats.get("sessions"),
+            "active_requests": self.stats.get("active_requests"),
+            "llm_queue": self.stats.get("llm_queue"),
+            "loop_lag_ms": self.stats.get("loop_lag_ms")
+        }
+
+shards = []
+loop = None
+stop_event = None
+exit_code = 0
+
+def route(update):
+    """Ставит обновление в очередь воркера его пользователя"""
+    UPDATES_RECEIVED.inc()
+    front_state["updates_total"] += 1
+    front_state["last_update_at"] = time.time()
+    if "update_id" in update:
+        UNDELIVERED.add(update["update_id"])
+        front_state["last_routed_id"] = max(front_state["last_routed_id"] or 0, update["update_id"])
+    shards[update_user_id(update) % len(shards)].queue.put_nowait(update)
+
+def advance_update_offset():
+    """Переданы все обновления до самого раннего из ещё не переданных"""
+    update_offset.advance(min(UNDELIVERED) - 1 if UNDELIVERED else front_state["last_routed_id"])
+
+def request_stop(code=0):
+    global exit_code
+    exit_code = exit_code or code
+    stop_event.set()
+
+async def telegram_call(session, method, **params):
+    async with session.post(api_method_url(BOT_TOKEN, method), json=params,
+                            timeout=aiohttp.ClientTimeout(total=params.get("timeout", 0) + 15)) as response:
+        data = await response.json()
+    if not data.get("ok"):
+        raise RuntimeError(f"{method}: {data.get('description')}")
+    return data["result"]
+
+async def poll_updates(session):
+    """Получает обновления через getUpdates и раздаёт их воркерам"""
+    front_state["polling"] = True
+    try:
+        while not front_state["draining"]:
+            try:
+                params = {"timeout": POLL_TIMEOUT}
+                if front_state["offset"] is not None:
+                    params["offset"] = front_state["offset"]
+                updates = await telegram_call(session, "getUpdates", **params)
+            except (aiohttp.ClientError, asyncio.TimeoutError, RuntimeError) as e:
+                logger.error(f"Ошибка при получении обновлений: {e}, повтор через 5 секунд")
+                await asyncio.sleep(5)
+                continue
+            for update in updates:
+                route(update)
+                front_state["offset"] = update["update_id"] + 1
+    finally:
+        front_state["polling"] = False
+
+async def drain_backlog(session):
+    """
+    Раздаёт воркерам обновления, накопившиеся за время простоя, вместо drop_pending_updates.
+    Уже переданные, устаревшие и повторные нажатия кнопок отбрасываются (update_backlog).
+    """
+    offset = update_offset.saved + 1 if update_offset.saved is not None else None
+    updates = []
+    try:
+        # Запрос со следующим offset подтверждает полученные, последний пустой ответ - конец очереди
+        while True:
+            params = {"timeout": 0, "limit": 100}
+            if offset is not None:
+                params["offset"] = offset
+            batch = await telegram_call(session, "getUpdates", **params)
+            if not batch:
+                break
+            updates.extend(batch)
+            offset = batch[-1]["update_id"] + 1
+    except (aiohttp.ClientError, asyncio.TimeoutError, RuntimeError) as e:
+        logger.error(f"Ошибка при получении накопленных обновлений: {e}")
+    if offset is not None:
+        front_state["offset"] = offset
+    if not updates:
+        return
+
+    kept, stats = prepare_backlog(updates, update_offset.saved)
+    for outcome in ("processed_before", "expired", "collapsed"):
+        BACKLOG_UPDATES.labels(outcome).inc(stats[outcome])
+    BACKLOG_UPDATES.labels("processed").inc(len(kept))
+    # Очереди воркеров сохраняют порядок обновлений каждого пользователя
+    for update in kept:
+        route(update)
+    front_state["last_routed_id"] = max(front_state["last_routed_id"] or 0, updates[-1]["update_id"])
+    advance_update_offset()
+    logger.info(f"Накоплено обновлений: {stats['received']} (уже передано {stats['processed_before']}, "
+                f"устарело {stats['expired']}, повторных нажатий {stats['collapsed']}), передаём воркерам {len(kept)}")
+
+async def webhook_handler(request):
+    if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+        return web.Response(status=403)
+    if front_state["draining"]:
+        # Telegram повторит доставку, её примет новый процесс
+        return web.Response(status=503)
+    route(await request.json())
+    return web.Response()
+
+def _max(values):
+    values = [value for value in values if value is not None]
+    return max(values) if values else None
+
+def aggregate_stats():
+    """Сводка счётчиков воркеров; каждый читается из своего сегмента общей памяти"""
+    stats = [shard.read_stats() for shard in shards]
+    return {
+        "active_requests": sum(item.get("active_requests", 0) for item in stats),
+        "llm_queue": sum(item.get("llm_queue", 0) for item in stats),
+        "sessions": sum(item.get("sessions", 0) for item in stats),
+        "in_flight_updates": sum(item.get("in_flight_updates", 0) for item in stats) + sum(shard.queue.qsize() for shard in shards),
+        # Для монитора ресурсов важен самый загруженный цикл событий
+        "loop_lag_ms": _max(item.get("loop_lag_ms") for item in stats),
+        "loop_lag_max_ms": _max(item.get("loop_lag_max_ms") for item in stats),
+        "loop_stalls": sum(item.get("loop_stalls", 0) for item in stats)
+    }
+
+async def publish_stats(writer):
+    """Публикует сводку воркеров в сегмент фронта, который читает simple_server"""
+    while True:
+        try:
+            totals = aggregate_stats()
+            # Общий снимок сессий удаляется, когда все воркеры взяли из него своих пользователей
+            if not front_state["snapshot_loaded"] and all(shard.stats.get("accepting") for shard in shards):
+                front_state["snapshot_loaded"] = True
+                try:
+                    os.remove(SESSION_SNAPSHOT_PATH)
+                except OSError:
+                    pass
+            if writer is not None:
+                accepting = front_state["polling"] or bool(WEBHOOK_URL and not front_state["draining"])
+                writer.publish(
+                    flags=(FLAG_ACCEPTING if accepting else 0) | (FLAG_DRAINING if front_state["draining"] else 0),
+                    last_update_at=front_state["last_update_at"],
+                    updates_total=front_state["updates_total"],
+                    **totals
+                )
+        except Exception as e:
+            logger.error(f"Ошибка при публикации счётчиков фронта: {e}")
+        await asyncio.sleep(PUBLISH_INTERVAL)
+
+async def health_handler(request):
+    totals = aggregate_stats()
+    statuses = [shard.status() for shard in shards]
+    ready = all(status["ready"] for status in statuses)
+    if not ready and not front_state["snapshot_loaded"]:
+        # Первый запуск: готовность только когда готовы все воркеры
+        return web.json_response({"status": "starting", "workers": statuses}, status=503)
+    return web.json_response({
+        "status": "ok" if ready else "degraded",
+        "mode": "webhook" if WEBHOOK_URL else "polling",
+        "workers_count": len(shards),
+        "timestamp": int(time.time()),
+        "uptime": int(time.time() - front_state["started_at"]),
+        "polling_active": front_state["polling"] or bool(WEBHOOK_URL and not front_state["draining"]),
+        "draining": front_state["draining"],
+        "queued": sum(status["queued"] for status in statuses),
+        "active_sessions": totals["sessions"],
+        "active_requests": totals["active_requests"],
+        "llm_queue": totals["llm_queue"],
+        "loop_lag_ms": totals["loop_lag_ms"],
+        "loop_lag_max_ms": totals["loop_lag_max_ms"],
+        "loop_stalls": totals["loop_stalls"],
+        "workers": statuses
+    })
+
+def merge_worker_metrics(texts):
+    """
+    Объединяет метрики воркеров, добавляя метку worker. Строки одной метрики
+    в формате Prometheus должны идти подряд, поэтому они группируются по метрике.
+
+    :param texts: {номер воркера: текст /metrics}
+    """
+    families = {}  # {имя: [строки HELP и TYPE, образцы...]}
+    for index, text in texts.items():
+        family = None
+        for line in text.splitlines():
+            if line.startswith("# HELP "):
+                name = line.split(" ", 3)[2]
+                family = families.setdefault(name, [line])
+                continue
+            if line.startswith("#"):
+                if family is not None and line not in family:
+                    family.append(line)
+                continue
+            if not line or family is None:
+                continue
+            series, _, value = line.rpartition(" ")
+            if "{" in series:
+                series = series.replace("{", f'{{worker="{index}",', 1)
+            else:
+                series = f'{series}{{worker="{index}"}}'
+            family.append(f"{series} {value}")
+    return "".join(line + "\n" for lines in families.values() for line in lines)
+
+async def metrics_handler(request):
+    session = request.app["session"]
+
+    async def fetch(shard):
+        try:
+            async with session.get(f"{shard.url}/metrics", timeout=aiohttp.ClientTimeout(total=2)) as response:
+                return shard.index, await response.text()
+        except Exception:
+            return shard.index, ""
+
+    texts = dict(await asyncio.gather(*(fetch(shard) for shard in shards)))
+    text = front_registry.render() + merge_worker_metrics(texts)
+    return web.Response(body=text.encode("utf-8"), headers={"Content-Type": CONTENT_TYPE})
+
+async def wait_for_handoff():
+    """При плавном перезапуске ждёт завершения прежнего фронта (SUPERVISOR_HANDOFF_PID)"""
+    handoff_pid = int(os.environ.get("SUPERVISOR_HANDOFF_PID", 0))
+    if not handoff_pid:
+        return
+    logger.info(f"Ожидание завершения прежнего процесса (PID {handoff_pid})")
+    deadline = time.monotonic() + DRAIN_TIMEOUT + 15
+    while time.monotonic() < deadline:
+        try:
+            os.kill(handoff_pid, 0)
+        except ProcessLookupError:
+            return
+        except PermissionError:
+            pass
+        await asyncio.sleep(0.1)
+    logger.warning(f"Прежний процесс {handoff_pid} не завершился за отведённое время")
+
+async def prepare_updates(session):
+    """Polling требует выключенного webhook, режим webhook - зарегистрированного"""
+    try:
+        if WEBHOOK_URL:
+            params = {"url": WEBHOOK_URL}
+            if WEBHOOK_SECRET:
+                params["secret_token"] = WEBHOOK_SECRET
+            await telegram_call(session, "setWebhook", **params)
+            logger.info(f"Webhook установлен: {WEBHOOK_URL}")
+            return
+        info = await telegram_call(session, "getWebhookInfo")
+        if info.get("url"):
+            logger.warning(f"Обнаружен активный webhook: {info['url']}, удаляем")
+            await telegram_call(session, "deleteWebhook")
+    except Exception as e:
+        logger.error(f"Ошибка при настройке получения обновлений: {e}")
+
+async def shutdown(session, poller):
+    """Перестаёт получать обновления, доставляет полученные и плавно останавливает воркеров"""
+    front_state["draining"] = True
+    if poller is not None:
+        poller.cancel()
+        # Подтверждаем полученные обновления, чтобы новый процесс не получил их повторно
+        if front_state["offset"] is not None:
+            try:
+                await telegram_call(session, "getUpdates", offset=front_state["offset"], limit=1, timeout=0)
+            except Exception as e:
+                logger.warning(f"Не удалось подтвердить обновления: {e}")
+
+    queued = sum(shard.queue.qsize() for shard in shards)
+    if queued:
+        logger.info(f"Доставка {queued} полученных обновлений воркерам")
+        try:
+            await asyncio.wait_for(asyncio.gather(*(shard.queue.join() for shard in shards)), FLUSH_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning(f"За {FLUSH_TIMEOUT} с не доставлено {sum(shard.queue.qsize() for shard in shards)} обновлений")
+
+    # Недоставленные за FLUSH_TIMEOUT обновления уже подтверждены в Telegram и не вернутся
+    update_offset.advance(front_state["last_routed_id"])
+    update_offset.save()
+
+    # Воркеры останавливаются одновременно, каждый дожидается своих генераций
+    await asyncio.gather(*(loop.run_in_executor(None, shard.supervisor.stop) for shard in shards))
+    # Один снимок на все воркеры: следующий запуск может быть с другим их числом.
+    # session_manager тянет pydantic, поэтому импортируется только при остановке, а не при запуске фронта
+    from session_manager import worker_snapshot_path, merge_snapshots
+    merge_snapshots([SESSION_SNAPSHOT_PATH] + [worker_snapshot_path(SESSION_SNAPSHOT_PATH, shard.index) for shard in shards],
+                    SESSION_SNAPSHOT_PATH)
+
+async def run_front():
+    global loop, stop_event
+    loop = asyncio.get_running_loop()
+    stop_event = asyncio.Event()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, request_stop)
+
+    logger.info(f"Запуск {BOT_WORKERS} воркеров бота")
+    for index in range(BOT_WORKERS):
+        shard = WorkerShard(index, BOT_WORKERS)
+        shards.append(shard)
+        shard.supervisor.start()
+
+    # Один пул соединений на Bot API и на доставку воркерам
+    session = create_client_session()
+    app = web.Application()
+    app["session"] = session
+    app.router.add_get('/', health_handler)
+    app.router.add_get('/metrics', metrics_handler)
+    if WEBHOOK_URL:
+        app.router.add_post(urlparse(WEBHOOK_URL).path or "/", webhook_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, '0.0.0.0', PORT).start()
+    logger.info(f"Фронт принимает запросы на порту {PORT}")
+
+    for shard in shards:
+        shard.sender = asyncio.create_task(shard.deliver(session))
+    # Сводка воркеров в общей памяти для simple_server
+    stats_writer = None
+    try:
+        stats_writer = StatsWriter(segment_path(os.getpid()))
+    except OSError as e:
+        logger.warning(f"Сегмент счётчиков недоступен: {e}")
+    publisher = asyncio.create_task(publish_stats(stats_writer))
+
+    # Обновления забираем только после завершения прежнего фронта
+    await wait_for_handoff()
+    poller = None
+    if not stop_event.is_set():
+        await prepare_updates(session)
+        if not WEBHOOK_URL:
+            await drain_backlog(session)
+            poller = asyncio.create_task(poll_updates(session))
+        logger.info(f"Фронт получает обновления через {(time.perf_counter() - STARTUP_STARTED) * 1000:.0f} мс после запуска")
+    offset_saver = asyncio.create_task(update_offset.autosave())
+
+    await stop_event.wait()
+    logger.info("Остановка фронта")
+    await shutdown(session, poller)
+    publisher.cancel()
+    offset_saver.cancel()
+    for shard in shards:
+        shard.sender.cancel()
+    await runner.cleanup()
+    await session.close()
+    if stats_writer is not None:
+        stats_writer.close()
+    logger.info("Фронт остановлен")
+
+if __name__ == "__main__":
+    asyncio.run(run_front())
+    sys.exit(exit_code)